@@ -0,0 +1,12 @@
+@echo off
+@echo Starting BurPro watch folder service, press Ctrl-C to stop...
+@echo.
+
+cd /d "%~dp0"
+python ..\burpro.py --watch %*
+
+@echo.
+@echo Press any key to close...
+@echo off
+pause > nul
+exit /b
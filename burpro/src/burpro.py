@@ -14,16 +14,23 @@
 # IMPORT STATEMENTS
 # =============================================================================
 from __future__ import print_function
+import time
+STARTED = time.time()
 
 import datetime
-import logging
-import os
+import importlib
 import sys
 
 
-from burpro_setup import handle_args, setup_output_dir, report_setup_error
-from burpro_setup import setup_logger, takedown_logger
-from burpro_run_mgr import manage_run
+from burpro_setup import handle_args, report_setup_error
+from burpro_batch import run_file, run_batch, report_batch
+from burpro_run_mgr import read_json_params
+from burpro_watch import watch
+
+# modules a processing run loads, the heavy ones only when first needed
+RUN_MODULES = ['numpy', 'pandas', 'openpyxl', 'xlsxwriter', 'burpro_cache',
+               'burpro_engine', 'burpro_reader', 'burpro_writer',
+               'burpro_process']
 # =============================================================================
 # MAIN METHOD AND TESTING AREA
 # =============================================================================
@@ -32,37 +39,99 @@ from burpro_run_mgr import manage_run
 def main(argv=None):
     try:
         version = burpro_version()
-        files = handle_args(version, argv)
+        files, options = handle_args(version, argv)
 #        print(files)
+        if options.startup_profile:
+            startup_profile()
+        if options.clear_cache:
+            from burpro_cache import clear_cache, default_cache_dir
+            cache_dir = read_json_params().get('cache_dir') or \
+                default_cache_dir()
+            print('Removed', clear_cache(cache_dir), 'cached input file(s)')
+        if options.watch:
+            watch(files, version, options.jobs, options.status_file)
+            return
+        if options.inspect:
+            from burpro_inspect import inspect
+            inventory = inspect(files, options.inspect_dir, options.jobs)
+            if any('error' in entry for entry in inventory):
+                sys.exit(3)
+            return
+        if options.merge:
+            from burpro_merge import merged_filename
+            try:
+                run_file(merged_filename(files), version, merge_files=files)
+            except:
+                # the error was logged by run_file, stop processing
+                sys.exit(3)
+            return
+        manifest = None
+        if options.archive_dir:
+            manifest = directory_manifest(options.archive_dir, version)
+            if not options.force:
+                files = skip_current(manifest, files)
+                if not files:
+                    return
+        if options.jobs > 1:
+            results = run_batch(files, version, options.jobs)
+            if manifest is not None:
+                for result in results:
+                    if result['status'] == 'ok':
+                        manifest.record(result['file'], result['output_dir'])
+            if report_batch(results):
+                sys.exit(3)
+            return
         for exo_filename in files:
-            output_dir = setup_output_dir(exo_filename)
-            run_log = 'BurPro'
-            device_log = 'EXOdevices'
-            log_ext = '.log'
-            setup_logger(run_log, os.path.join(output_dir, run_log + log_ext))
-            setup_logger(device_log, os.path.join(output_dir,
-                                                  device_log + log_ext))
-    # TODO: make these log instances more descriptive
-            log = logging.getLogger(run_log)
-            log.info('USGS California Water Science Center')
-            log.info('BurPro Revision ' + version)
             try:
                 # print(exo_filename)
-                manage_run(exo_filename, output_dir)
+                output_dir = run_file(exo_filename, version)
             except:
-                # Logger is set up.  Handle an error by logging it and exiting
-                log.error(logging.Formatter().formatException(sys.exc_info()))
+                # the error was logged by run_file, stop processing
                 sys.exit(3)
-            finally:
-                log.info('BurPro done.')
-                takedown_logger(run_log)
-                takedown_logger(device_log)
+            if manifest is not None:
+                manifest.record(exo_filename, output_dir)
 
     except Exception, setup_error:
         # Logger was not set up.  Report errors to the console.
         report_setup_error(setup_error)
 
 
+def directory_manifest(directory, version):
+    from burpro_manifest import Manifest, run_fingerprint
+    return Manifest(directory, run_fingerprint(read_json_params(), version))
+
+
+def skip_current(manifest, files):
+    """Return the files a directory run still has to process, reporting
+    those already processed with the current run parameters"""
+    files, current = manifest.pending(files)
+    for exo_filename in current:
+        print('unchanged', exo_filename, '->',
+              manifest.output_dir(exo_filename))
+    if current:
+        print('Skipped %d unchanged file(s), use --force to process them '
+              'again' % len(current))
+    return files
+
+
+def startup_profile():
+    """Print the time taken to start BurPro and to import each module a
+    processing run needs, in the order a run loads them"""
+    print('Startup to argument parsing: %.3f s' % (time.time() - STARTED))
+    total = 0.
+    for name in RUN_MODULES:
+        start = time.time()
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            print('  import %-16s not installed' % name)
+            continue
+        elapsed = time.time() - start
+        total += elapsed
+        print('  import %-16s %.3f s' % (name, elapsed))
+    print('Imports for processing: %.3f s' % total)
+
+
 def burpro_version():
     # TODO: Return production code version, not current date when src is stable
     version = '1.1,'
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+:DESCRIPTION: In memory library interface to BurPro for services that
+              already hold the data of a KOR export.  A raw dataframe, or
+              the bytes of a workbook, and a dict of run parameters go in;
+              the filtered burst medians, device table and burst QA
+              statistics come back as objects.  Nothing is read from or
+              written to disk and no global logger is set up, so the
+              functions can be called repeatedly in one long lived process.
+
+:REQUIRES: burpro_process.py
+
+:USAGE: from burpro_api import process_workbook
+        from burpro_run_mgr import read_json_params
+        result = process_workbook(xlsx_bytes, read_json_params())
+        result.exo_mad
+
+:AUTHOR: John Franco Saraceno, John M. Donovan
+:ORGANIZATION: U.S. Geological Survey, United States Department of Interior
+:CONTACT: saraceno@usgs.gov, jmd@usgs.gov
+
+"""
+# =============================================================================
+# IMPORT STATEMENTS
+# =============================================================================
+from __future__ import print_function
+import io
+import logging
+from collections import OrderedDict
+
+from burpro_metrics import RunMetrics
+from burpro_process import (NULL_VALUE, SC_COL, SC_CUTOFF, despike_record,
+                            float_dtype, parse_kor_frame, read_kor_file,
+                            reduce_kor)
+
+# run parameters that only concern files, output_formats, parse_cache,
+# cache_dir, results_db, excel_reader and pipeline, are ignored
+
+
+class BurProResult(object):
+    """Results of an in memory run
+    exo_mad: dataframe of MAD filtered burst medians of the first criteria
+    exo_mads: list of those dataframes, one per criteria
+    criteria: list of the mad criteria
+    rejected: dataframe of the fraction of samples each criteria rejected,
+              None unless mad_criteria is a list
+    burst_completion: dict of the percentage of complete bursts by column
+    qa: OrderedDict of burst QA statistic dataframes by name, None with the
+        groupby mad_engine
+    devices: device table as written to _EXOdevices.json
+    data: the parsed float data the medians were calculated from
+    despiked: full resolution despiked record, None unless despike_window
+              is set"""
+
+    def __init__(self, parsed_kor, exo_mads, criteria, rejected,
+                 burst_completion, qa, despiked=None):
+        self.exo_mad = exo_mads[0]
+        self.exo_mads = exo_mads
+        self.criteria = criteria
+        self.rejected = rejected
+        self.burst_completion = burst_completion
+        self.qa = None if qa is None else OrderedDict(qa)
+        self.devices = parsed_kor.device_table(jsonfile=True)
+        self.data = parsed_kor.data
+        self.despiked = despiked
+
+
+def quiet_logger(name):
+    """Return a logger outside the logging hierarchy that discards its
+    records, so that library calls leave the global logging setup alone"""
+    log = logging.Logger(name)
+    log.addHandler(logging.NullHandler())
+    return log
+
+
+def process_frame(df_exo, params, name='<memory>', log=None):
+    """Run BurPro on a raw KOR export dataframe, as read by
+    pd.read_excel(filename, header=None)
+    INPUT:
+    raw pandas dataframe, dict of run parameters such as read_json_params
+    returns, name of the data in log messages, logger for the run and
+    deployment log messages or None to discard them
+    RETURNS:
+    BurProResult"""
+    parsed_kor = parse_kor_frame(df_exo, params.get('drop_cols', []),
+                                 params.get('index_timezone',
+                                            'Datetime (PST)'),
+                                 float_dtype(params))
+    return process_parsed(parsed_kor, params, name, log)
+
+
+def process_workbook(workbook, params, name='<memory>', log=None):
+    """Run BurPro on a KOR export workbook held in memory
+    INPUT:
+    bytes of an .xlsx file, or a binary file like object, dict of run
+    parameters, name of the data in log messages, logger or None
+    RETURNS:
+    BurProResult"""
+    if isinstance(workbook, bytes):
+        workbook = io.BytesIO(workbook)
+    parsed_kor = read_kor_file(workbook, params.get('drop_cols', []),
+                               params.get('index_timezone',
+                                          'Datetime (PST)'),
+                               float_dtype(params))
+    return process_parsed(parsed_kor, params, name, log)
+
+
+def process_parsed(parsed_kor, params, name='<memory>', log=None):
+    """Run the batch burst reduction of BurPro on a ParsedKorFile
+    RETURNS:
+    BurProResult"""
+    if params.get('incremental', False):
+        raise ValueError('In memory runs do not support incremental mode')
+    if params.get('mad_processes', 1) > 1:
+        raise ValueError('In memory runs do not support mad_processes')
+    log = log or quiet_logger('burpro_api')
+    mad_criteria = params.get('mad_criteria', 2.5)
+    criteria = mad_criteria
+    if not isinstance(mad_criteria, (list, tuple)):
+        criteria = [mad_criteria]
+    parsed_kor, exo_mads, rejected, burst_completion, qa = \
+        reduce_kor(log, log, name, parsed_kor, params, SC_COL, SC_CUTOFF,
+                   NULL_VALUE, RunMetrics())
+    return BurProResult(parsed_kor, exo_mads, list(criteria), rejected,
+                        burst_completion, qa,
+                        despike_record(log, parsed_kor, params, SC_COL,
+                                       SC_CUTOFF))
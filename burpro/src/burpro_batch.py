@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+:DESCRIPTION: Runs BurPro on one input file with its own output directory
+              and log files, and on many input files in a process pool
+
+:REQUIRES: burpro_setup.py, burpro_run_mgr.py
+
+:AUTHOR: John Franco Saraceno, John M. Donovan
+:ORGANIZATION: U.S. Geological Survey, United States Department of Interior
+:CONTACT: saraceno@usgs.gov, jmd@usgs.gov
+
+"""
+# =============================================================================
+# IMPORT STATEMENTS
+# =============================================================================
+from __future__ import print_function
+import logging
+import multiprocessing
+import os
+import sys
+
+from burpro_setup import setup_output_dir, setup_logger, takedown_logger
+from burpro_run_mgr import manage_run
+
+RUN_LOG = 'BurPro'
+DEVICE_LOG = 'EXOdevices'
+LOG_EXT = '.log'
+
+
+def run_file(exo_filename, version, console=True, merge_files=None):
+    """Process one input file, logging to BurPro.log and EXOdevices.log in
+    a new output directory next to the input file.  With merge_files, their
+    merged record is processed under the name exo_filename
+    INPUT:
+    .xlsx filename, BurPro version string, echo the run log to the console,
+    list of .xlsx filenames to merge or None
+    RETURNS:
+    output directory"""
+    output_dir = setup_output_dir(exo_filename)
+    setup_logger(RUN_LOG, os.path.join(output_dir, RUN_LOG + LOG_EXT),
+                 console=console)
+    setup_logger(DEVICE_LOG, os.path.join(output_dir, DEVICE_LOG + LOG_EXT),
+                 console=console)
+    log = logging.getLogger(RUN_LOG)
+    log.info('USGS California Water Science Center')
+    log.info('BurPro Revision ' + version)
+    try:
+        manage_run(exo_filename, output_dir, merge_files)
+    except:
+        # Logger is set up.  Handle an error by logging it and re-raising
+        log.error(logging.Formatter().formatException(sys.exc_info()))
+        raise
+    finally:
+        log.info('BurPro done.')
+        takedown_logger(RUN_LOG)
+        takedown_logger(DEVICE_LOG)
+    return output_dir
+
+
+def batch_worker(task):
+    """Process pool entry point. Never raises, so that one failed file
+    does not stop the rest of the batch
+    INPUT:
+    (filename, version) tuple
+    RETURNS:
+    dict with the file, output directory, status and error message"""
+    exo_filename, version = task
+    result = {'file': exo_filename, 'output_dir': None,
+              'status': 'ok', 'error': None}
+    try:
+        result['output_dir'] = run_file(exo_filename, version, console=False)
+    except Exception as error:
+        result['status'] = 'failed'
+        result['error'] = '%s: %s' % (type(error).__name__, error)
+    return result
+
+
+def run_batch(files, version, jobs):
+    """Process files in a pool of jobs worker processes. Each worker writes
+    its own logs and output directory
+    INPUT:
+    list of .xlsx filenames, BurPro version string, number of processes
+    RETURNS:
+    list of result dicts from batch_worker, in completion order"""
+    tasks = [(exo_filename, version) for exo_filename in files]
+    # a fresh worker per file returns each file's memory to the system
+    pool = multiprocessing.Pool(processes=min(jobs, len(tasks)) or 1,
+                                maxtasksperchild=1)
+    results = []
+    try:
+        for result in pool.imap_unordered(batch_worker, tasks):
+            results.append(result)
+            print('[%d/%d] %s %s' % (len(results), len(tasks),
+                                     result['status'], result['file']))
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return results
+
+
+def report_batch(results):
+    """Print a combined success/failure summary of a batch run
+    RETURNS:
+    number of failed files"""
+    failed = [result for result in results if result['status'] != 'ok']
+    print('BurPro batch summary: %d succeeded, %d failed' %
+          (len(results) - len(failed), len(failed)))
+    for result in results:
+        if result['status'] == 'ok':
+            print('  ok     ', result['file'], '->', result['output_dir'])
+    for result in failed:
+        print('  failed ', result['file'], '-', result['error'])
+    return len(failed)
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+:DESCRIPTION: Local cache of parsed input data keyed by the content hash of
+              the input file.  Entries hold the datetime indexed float
+              matrix and its metadata in an uncompressed .npz file so a
+              repeat run on the same file skips Excel parsing.  The cache is
+              kept under a size limit by evicting the least recently used
+              entries.
+
+:REQUIRES: numpy, pandas
+
+:AUTHOR: John Franco Saraceno, John M. Donovan
+:ORGANIZATION: U.S. Geological Survey, United States Department of Interior
+:CONTACT: saraceno@usgs.gov, jmd@usgs.gov
+
+"""
+# =============================================================================
+# IMPORT STATEMENTS
+# =============================================================================
+from __future__ import print_function
+import hashlib
+import json
+import os
+import os.path
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+# bump when the layout of cached entries or the parsed data changes
+CACHE_VERSION = 2
+CACHE_EXT = '.npz'
+
+
+def default_cache_dir():
+    return os.path.join(os.path.expanduser('~'), '.burpro', 'cache')
+
+
+def file_digest(filename, block_size=1 << 20):
+    """Return the sha256 hex digest of a file's contents"""
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as infile:
+        for block in iter(lambda: infile.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_key(filename, *parse_params):
+    """Return the cache key of an input file parsed with parse_params, any
+    json serializable values that change the parsed result"""
+    fingerprint = json.dumps([CACHE_VERSION] + list(parse_params),
+                             sort_keys=True)
+    digest = hashlib.sha256(file_digest(filename).encode('ascii'))
+    digest.update(fingerprint.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def cache_path(cache_dir, key):
+    return os.path.join(cache_dir, key + CACHE_EXT)
+
+
+def load_frame(cache_dir, key):
+    """Return the (dataframe, metadata dict) stored under key, or None on a
+    cache miss.  A hit marks the entry as recently used
+    INPUT:
+    cache directory, cache key
+    RETURNS:
+    tuple or None"""
+    path = cache_path(cache_dir, key)
+    if not os.path.isfile(path):
+        return None
+    try:
+        data, extra = read_frame(path)
+    except (IOError, ValueError, KeyError):
+        # unreadable or partial entry, parse the input again
+        remove_entry(path)
+        return None
+    os.utime(path, None)
+    return data, extra
+
+
+def store_frame(cache_dir, key, data, extra, max_bytes):
+    """Store a float dataframe with a datetime index and a json serializable
+    dict of extra metadata under key, then evict least recently used
+    entries until the cache fits in max_bytes"""
+    path = cache_path(cache_dir, key)
+    write_frame(path, data, extra)
+    evict_lru(cache_dir, max_bytes, keep=path)
+
+
+def read_frame(path):
+    """Return the (dataframe, metadata dict) of a file written by
+    write_frame"""
+    npz = np.load(path)
+    try:
+        metadata = json.loads(npz['metadata'].tobytes().decode('utf-8'))
+        index = pd.DatetimeIndex(npz['index'], name=metadata['index_name'])
+        data = pd.DataFrame(npz['values'], index=index,
+                            columns=metadata['columns'])
+    finally:
+        npz.close()
+    return data, metadata['extra']
+
+
+def float_values(data):
+    """Return the values of a dataframe as a float array, keeping float32"""
+    values = np.asarray(data.values)
+    if values.dtype.kind != 'f':
+        values = values.astype(np.float64)
+    return values
+
+
+def write_frame(path, data, extra):
+    """Write a float dataframe with a datetime index and a json serializable
+    dict of extra metadata to an uncompressed .npz file.  The file is
+    replaced in one step so readers never see a partial file"""
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    metadata = {'columns': data.columns.tolist(),
+                'index_name': data.index.name,
+                'extra': extra}
+    metadata = np.frombuffer(json.dumps(metadata).encode('utf-8'),
+                             dtype=np.uint8)
+    handle, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(handle, 'wb') as outfile:
+            np.savez(outfile, values=float_values(data),
+                     index=data.index.asi8, metadata=metadata)
+        if os.path.exists(path):
+            # os.rename does not replace files on Windows
+            remove_entry(path)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        remove_entry(tmp_path)
+        raise
+
+
+def list_entries(cache_dir):
+    """Return (last used time, size, path) of each cache entry, oldest
+    first"""
+    entries = []
+    if not os.path.isdir(cache_dir):
+        return entries
+    for name in os.listdir(cache_dir):
+        if name.endswith(CACHE_EXT):
+            path = os.path.join(cache_dir, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+    return sorted(entries)
+
+
+def evict_lru(cache_dir, max_bytes, keep=None):
+    """Remove least recently used entries, other than keep, until the cache
+    fits in max_bytes
+    RETURNS:
+    number of entries removed"""
+    entries = list_entries(cache_dir)
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        remove_entry(path)
+        total -= size
+        removed += 1
+    return removed
+
+
+def clear_cache(cache_dir):
+    """Remove every cache entry
+    RETURNS:
+    number of entries removed"""
+    return evict_lru(cache_dir, -1)
+
+
+def remove_entry(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
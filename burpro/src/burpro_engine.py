@@ -0,0 +1,451 @@
+# -*- coding: utf-8 -*-
+"""
+:DESCRIPTION: Vectorized burst reduction engine.  Bursts are packed into a
+              padded (bursts x samples x parameters) array so the median,
+              median absolute deviation and MAD filtered median of every
+              burst and parameter are computed with a handful of array
+              operations instead of one Python call per burst and column.
+
+:REQUIRES: numpy, pandas
+
+:AUTHOR: John Franco Saraceno, John M. Donovan
+:ORGANIZATION: U.S. Geological Survey, United States Department of Interior
+:CONTACT: saraceno@usgs.gov, jmd@usgs.gov
+
+"""
+# =============================================================================
+# IMPORT STATEMENTS
+# =============================================================================
+from __future__ import print_function
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import pandas as pd
+
+# normal consistency constant of statsmodels.robust.scale.mad, the 0.75
+# quantile of the standard normal distribution, Gaussian.ppf(3 / 4.)
+MAD_NORMAL_CONSTANT = 0.6744897501960817
+NS_PER_SECOND = 10 ** 9
+NS_PER_MINUTE = 60 * NS_PER_SECOND
+# float32 burst medians are within this relative tolerance of float64 ones,
+# except where a sample lies within float32 rounding of a MAD bound
+FLOAT32_RTOL = 1e-6
+# per burst quality statistics of burst_qa, in output order
+QA_STATISTICS = ['samples', 'missing', 'rejected', 'median',
+                 'filtered_median', 'mad', 'min', 'max', 'iqr']
+# QA statistics that are sample counts
+QA_COUNTS = ['samples', 'missing', 'rejected']
+# moving windows of hampel_filter sorted at a time
+HAMPEL_BLOCK_ROWS = 4096
+
+
+def median_abs_deviation(array_like, c=MAD_NORMAL_CONSTANT, axis=0):
+    """Median absolute deviation scaled to be a consistent estimate of the
+    standard deviation of normal data, numerically the same as
+    statsmodels.robust.scale.mad
+    INPUT:
+    array-like, normalization constant, axis
+    RETURNS:
+    float or array"""
+    array_like = np.asarray(array_like)
+    center = np.apply_over_axes(np.median, array_like, axis)
+    return np.median(np.fabs(array_like - center) / c, axis=axis)
+
+
+def interval_bins(index, interval):
+    """Assign timestamps to fixed interval bursts using the same bin edges
+    as pd.TimeGrouper(str(interval) + 'Min'), anchored at midnight of the
+    first day in the record
+    INPUT:
+    pandas DatetimeIndex
+    burst interval in minutes, int
+    RETURNS:
+    order, positions that sort the index into burst order
+    offsets, start of each non-empty burst in the sorted order plus the end
+    labels, DatetimeIndex of each non-empty burst"""
+    stamps = np.asarray(index.asi8)
+    freq = int(interval) * NS_PER_MINUTE
+    origin = index.min().normalize().value
+    codes = (stamps - origin) // freq
+    order = np.argsort(codes, kind='mergesort')
+    sorted_codes = codes[order]
+    starts = np.flatnonzero(np.concatenate(([True],
+                                            sorted_codes[1:] !=
+                                            sorted_codes[:-1])))
+    offsets = np.append(starts, len(sorted_codes))
+    labels = pd.DatetimeIndex(origin + sorted_codes[starts] * freq)
+    return order, offsets, labels
+
+
+def gap_segments(index, interval, max_gap):
+    """Split timestamps into bursts wherever consecutive samples are more
+    than max_gap seconds apart, in one pass over the sorted timestamps.  Each
+    burst is labelled with the interval bin of interval_bins holding its
+    first sample and bursts sharing a label are joined, so a burst running
+    across a bin edge stays whole and outages add no empty bins
+    INPUT:
+    pandas DatetimeIndex
+    burst interval in minutes, int
+    largest gap between samples of one burst in seconds
+    RETURNS:
+    order, offsets and labels as returned by interval_bins"""
+    stamps = np.asarray(index.asi8)
+    if index.is_monotonic_increasing:
+        order = np.arange(len(stamps))
+    else:
+        order = np.argsort(stamps, kind='mergesort')
+        stamps = stamps[order]
+    freq = int(interval) * NS_PER_MINUTE
+    origin = index.min().normalize().value
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(stamps) >
+                                                 max_gap * NS_PER_SECOND) + 1))
+    codes = (stamps[starts] - origin) // freq
+    first = np.concatenate(([True], codes[1:] != codes[:-1]))
+    offsets = np.append(starts[first], len(stamps))
+    labels = pd.DatetimeIndex(origin + codes[first] * freq)
+    return order, offsets, labels
+
+
+def burst_segments(index, interval, max_gap=None):
+    """Return the order, offsets and labels of the bursts of an index, by
+    gap_segments when max_gap is given and by interval_bins otherwise"""
+    if max_gap is None:
+        return interval_bins(index, interval)
+    return gap_segments(index, interval, max_gap)
+
+
+def full_interval_index(labels, interval, name=None):
+    """Return every interval label between the first and last burst,
+    including empty bins, as produced by a TimeGrouper groupby"""
+    if len(labels) == 0:
+        return pd.DatetimeIndex([], name=name)
+    return pd.date_range(labels[0], labels[-1],
+                         freq=str(interval) + 'Min', name=name)
+
+
+def pack_bursts(values, order, offsets, missing=None):
+    """Pack a (samples x parameters) array into a NaN padded
+    (bursts x samples x parameters) array of the same float dtype.  Missing
+    samples take part in the statistics as the value missing when it is
+    given, as the -9999 null value always has in BurPro
+    INPUT:
+    2d float array
+    order and offsets as returned by burst_segments
+    value of missing samples or None to leave them NaN
+    RETURNS:
+    3d float array, number of samples in each burst"""
+    values = np.asarray(values)
+    if values.dtype.kind != 'f':
+        values = values.astype(np.float64)
+    lengths = np.diff(offsets)
+    n_bursts = len(lengths)
+    width = lengths.max() if n_bursts else 0
+    burst_id = np.repeat(np.arange(n_bursts), lengths)
+    position = np.arange(len(order)) - np.repeat(offsets[:-1], lengths)
+    ordered = values[order]
+    if missing is not None:
+        ordered[np.isnan(ordered)] = missing
+    packed = np.full((n_bursts, width, values.shape[1]), np.nan,
+                     dtype=values.dtype)
+    packed[burst_id, position] = ordered
+    return packed, lengths
+
+
+def round_float32(values):
+    """Return float64 results, with float32 results rounded to the 7
+    significant digits float32 holds so that they print as the float64
+    results would.  float32 processing agrees with float64 to a relative
+    tolerance of FLOAT32_RTOL"""
+    if values.dtype != np.float32:
+        return values
+    values = values.astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        exponent = np.floor(np.log10(np.fabs(values)))
+    exponent[~np.isfinite(exponent)] = 0
+    scale = 10. ** (6 - exponent)
+    return np.round(values * scale) / scale
+
+
+def sorted_median(ordered, start, count):
+    """Median of ordered[b, start:start + count, p] for every burst b and
+    parameter p of an array sorted along axis 1.  Matches np.median, which
+    averages the two middle values of an even length slice
+    INPUT:
+    3d float array sorted along axis 1
+    2d int arrays of slice starts and lengths
+    RETURNS:
+    2d float array, NaN where count is zero"""
+    n_bursts, width, n_params = ordered.shape
+    if width == 0:
+        return np.full((n_bursts, n_params), np.nan)
+    rows = np.arange(n_bursts)[:, None]
+    cols = np.arange(n_params)[None, :]
+    low = np.clip(start + (count - 1) // 2, 0, width - 1)
+    high = np.clip(start + count // 2, 0, width - 1)
+    median = (ordered[rows, low, cols] + ordered[rows, high, cols]) / 2.
+    median[count <= 0] = np.nan
+    return median
+
+
+def sorted_quantile(ordered, count, q, start=0):
+    """q quantile of ordered[b, start:start + count, p] for every burst b
+    and parameter p of an array sorted along axis 1, interpolated as
+    np.percentile does
+    INPUT:
+    3d float array sorted along axis 1
+    2d int array of slice lengths, float quantile between 0 and 1, 2d int
+    array of slice starts
+    RETURNS:
+    2d float array, NaN where count is zero"""
+    n_bursts, width, n_params = ordered.shape
+    if width == 0:
+        return np.full((n_bursts, n_params), np.nan)
+    rows = np.arange(n_bursts)[:, None]
+    cols = np.arange(n_params)[None, :]
+    position = start + (count - 1) * q
+    low = np.clip(np.floor(position).astype(int), 0, width - 1)
+    high = np.clip(np.ceil(position).astype(int), 0, width - 1)
+    fraction = position - np.floor(position)
+    quantile = (ordered[rows, low, cols] * (1. - fraction) +
+                ordered[rows, high, cols] * fraction)
+    quantile[count <= 0] = np.nan
+    return quantile
+
+
+def burst_statistics(packed, lengths, missing=None):
+    """Compute the criteria independent statistics of every burst
+    INPUT:
+    3d float array from pack_bursts, burst lengths, value pack_bursts gave
+    missing samples or None
+    RETURNS:
+    dict with the sorted burst values, valid sample counts, medians and
+    median absolute deviations, and the number of missing samples, which
+    sort first when they hold the value missing"""
+    n_valid = (~np.isnan(packed)).sum(axis=1)
+    # np.sort places NaN (padding or missing samples) after every value
+    ordered = np.sort(packed, axis=1)
+    zero = np.zeros_like(n_valid)
+    median = sorted_median(ordered, zero, n_valid)
+    deviation = np.sort(np.fabs(packed - median[:, None, :]) /
+                        MAD_NORMAL_CONSTANT, axis=1)
+    mad = sorted_median(deviation, zero, n_valid)
+    # median_abs_deviation centres with np.median, so a burst holding a NaN
+    # has a NaN median absolute deviation
+    mad[n_valid < lengths[:, None]] = np.nan
+    first = np.zeros_like(n_valid)
+    if missing is not None:
+        first = (packed == missing).sum(axis=1)
+    return {'ordered': ordered,
+            'n_valid': n_valid,
+            'median': median,
+            'mad': mad,
+            'first': first,
+            'n_missing': lengths[:, None] - n_valid + first}
+
+
+def filter_bounds(stats, criteria):
+    """Locate the samples kept by the MAD criteria inside the sorted bursts
+    INPUT:
+    dict from burst_statistics, float criteria
+    RETURNS:
+    2d int arrays of the first kept position and number of kept samples"""
+    ordered = stats['ordered']
+    k = stats['mad'] * criteria
+    high = stats['median'] + k
+    low = stats['median'] - k
+    start = (ordered < low[:, None, :]).sum(axis=1)
+    stop = (ordered <= high[:, None, :]).sum(axis=1)
+    # numpy.ma.masked_outside masks nothing when the bounds are NaN
+    unbounded = np.isnan(k)
+    start[unbounded] = 0
+    stop[unbounded] = stats['n_valid'][unbounded]
+    return start, stop - start
+
+
+def rejected_samples(stats, start, count):
+    """Count the measured samples of every burst and parameter and those of
+    them the MAD criteria rejects, missing samples left out
+    INPUT:
+    dict from burst_statistics
+    2d int arrays of slice starts and lengths from filter_bounds
+    RETURNS:
+    2d int arrays of measured and rejected sample counts"""
+    first = stats['first']
+    present = stats['n_valid'] - first
+    # missing samples kept by the filter lie before first
+    kept_missing = np.clip(np.minimum(start + count, first) - start, 0, None)
+    return present, present - count + kept_missing
+
+
+def burst_qa(stats, start, count):
+    """Quality statistics of every burst and parameter for one MAD
+    criteria, from the arrays the filtered medians are computed from.  Only
+    the filtered median takes missing samples into account as the filter
+    does; the other statistics describe the samples measured
+    INPUT:
+    dict from burst_statistics
+    2d int arrays of slice starts and lengths from filter_bounds
+    RETURNS:
+    dict of 2d arrays keyed by the names in QA_STATISTICS"""
+    ordered = stats['ordered']
+    first = stats['first']
+    present, rejected = rejected_samples(stats, start, count)
+    median = sorted_median(ordered, first, present)
+    mad = stats['mad'].copy()
+    incomplete = np.flatnonzero((stats['n_missing'] > 0).any(axis=1))
+    if len(incomplete):
+        # MAD of the measured samples of bursts with missing samples
+        width = ordered.shape[1]
+        measured = ordered[incomplete]
+        deviation = np.fabs(measured - median[incomplete][:, None, :])
+        deviation[np.arange(width)[None, :, None] <
+                  first[incomplete][:, None, :]] = np.nan
+        deviation = np.sort(deviation / MAD_NORMAL_CONSTANT, axis=1)
+        mad[incomplete] = sorted_median(deviation,
+                                        np.zeros_like(present[incomplete]),
+                                        present[incomplete])
+    return {'samples': present,
+            'missing': stats['n_missing'],
+            'rejected': rejected,
+            'median': median,
+            'filtered_median': sorted_median(ordered, start, count),
+            'mad': mad,
+            'min': sorted_quantile(ordered, present, 0., first),
+            'max': sorted_quantile(ordered, present, 1., first),
+            'iqr': (sorted_quantile(ordered, present, .75, first) -
+                    sorted_quantile(ordered, present, .25, first))}
+
+
+def qa_frames(qa, labels, full_index, columns, null_value):
+    """Return the burst QA statistics of burst_qa as (name, dataframe)
+    pairs, reindexed to every interval.  Intervals without a burst hold zero
+    samples; null values in the other statistics become NaN, as in the
+    burst medians"""
+    frames = []
+    for name in QA_STATISTICS:
+        if name in QA_COUNTS:
+            frame = pd.DataFrame(qa[name], index=labels, columns=columns)
+            frame = frame.reindex(full_index, fill_value=0)
+        else:
+            frame = pd.DataFrame(round_float32(qa[name]), index=labels,
+                                 columns=columns)
+            frame = frame.reindex(full_index)
+            frame.replace(to_replace=null_value, value=np.nan, inplace=True)
+        frames.append((name, frame))
+    return frames
+
+
+def reduce_block(packed, lengths, criteria, missing=None):
+    """Apply each MAD criteria to packed bursts
+    INPUT:
+    3d float array from pack_bursts, burst lengths, list of criteria, value
+    pack_bursts gave missing samples or None
+    RETURNS:
+    dict of the valid and measured sample counts, lists of the rejected
+    measured sample counts and the filtered medians of each criteria and the
+    burst_qa of the first criteria"""
+    stats = burst_statistics(packed, lengths, missing)
+    rejected = []
+    medians = []
+    qa = None
+    for mad_criteria in criteria:
+        start, count = filter_bounds(stats, mad_criteria)
+        if qa is None:
+            qa = burst_qa(stats, start, count)
+            medians.append(qa['filtered_median'])
+        else:
+            medians.append(sorted_median(stats['ordered'], start, count))
+        present, criteria_rejected = rejected_samples(stats, start, count)
+        rejected.append(criteria_rejected)
+    return {'n_valid': stats['n_valid'], 'samples': present,
+            'rejected': rejected, 'medians': medians, 'qa': qa}
+
+
+def reduce_parameters(packed, lengths, criteria, threads=1, missing=None):
+    """reduce_block of every parameter.  With more than one thread each
+    parameter is a separate task on a thread pool.  Tasks only read a view
+    of packed and the NumPy sorts release the GIL, so parameters are reduced
+    in parallel without copies.  Parameters are independent, so results and
+    their column order do not depend on the number of threads
+    INPUT:
+    3d float array from pack_bursts, burst lengths, list of criteria,
+    number of threads, value pack_bursts gave missing samples or None
+    RETURNS:
+    dict as returned by reduce_block"""
+    n_params = packed.shape[2]
+    if threads <= 1 or n_params <= 1:
+        return reduce_block(packed, lengths, criteria, missing)
+    pool = ThreadPool(min(threads, n_params))
+    try:
+        parts = pool.map(lambda i: reduce_block(packed[:, :, i:i + 1],
+                                                lengths, criteria, missing),
+                         range(n_params))
+    finally:
+        pool.close()
+        pool.join()
+    return join_reduced(parts, axis=1)
+
+
+def join_reduced(parts, axis):
+    """Join reduce_block results of slices of parameters (axis 1) or of
+    bursts (axis 0)"""
+    def join(arrays):
+        return np.concatenate(arrays, axis=axis)
+    n_criteria = len(parts[0]['rejected'])
+    return {'n_valid': join([part['n_valid'] for part in parts]),
+            'samples': join([part['samples'] for part in parts]),
+            'rejected': [join([part['rejected'][i] for part in parts])
+                         for i in range(n_criteria)],
+            'medians': [join([part['medians'][i] for part in parts])
+                        for i in range(n_criteria)],
+            'qa': dict((name, join([part['qa'][name] for part in parts]))
+                       for name in QA_STATISTICS)}
+
+
+def hampel_filter(frame, window, criteria, block_rows=HAMPEL_BLOCK_ROWS):
+    """Moving window despike of every column of a record.  A sample further
+    than criteria times the scaled MAD of the window of window samples
+    centred on it from the median of that window is replaced by the median,
+    the rule custom_mad applies to a burst.  The windows of block_rows
+    samples at a time are packed like bursts and sorted, so that the median
+    and the MAD of every window come from sorted_median.  Missing samples
+    are left out of the windows and stay missing, and a window needs more
+    than half of its samples
+    INPUT:
+    float dataframe, window length in samples, float criteria, number of
+    windows sorted at a time
+    RETURNS:
+    time sorted despiked dataframe, boolean dataframe of replaced samples"""
+    if not frame.index.is_monotonic_increasing:
+        frame = frame.iloc[np.argsort(frame.index.asi8, kind='mergesort')]
+    values = frame.values
+    if values.dtype.kind != 'f':
+        values = values.astype(np.float64)
+    n_rows, n_params = values.shape
+    # window i holds samples i - window // 2 to i - window // 2 + window - 1
+    padded = np.full((n_rows + window - 1, n_params), np.nan,
+                     dtype=values.dtype)
+    padded[window // 2:window // 2 + n_rows] = values
+    median = np.full(values.shape, np.nan)
+    mad = np.full(values.shape, np.nan)
+    offsets = np.arange(window)[None, :]
+    for first in range(0, n_rows, block_rows):
+        rows = np.arange(first, min(first + block_rows, n_rows))
+        windows = padded[rows[:, None] + offsets]
+        count = (~np.isnan(windows)).sum(axis=1)
+        zero = np.zeros_like(count)
+        block_median = sorted_median(np.sort(windows, axis=1), zero, count)
+        deviation = np.sort(np.fabs(windows - block_median[:, None, :]) /
+                            MAD_NORMAL_CONSTANT, axis=1)
+        block_mad = sorted_median(deviation, zero, count)
+        short = count <= window // 2
+        block_median[short] = np.nan
+        block_mad[short] = np.nan
+        median[rows] = block_median
+        mad[rows] = block_mad
+    # samples without a window median or MAD are kept
+    with np.errstate(invalid='ignore'):
+        spikes = np.fabs(values - median) > mad * criteria
+    spikes = pd.DataFrame(spikes, index=frame.index, columns=frame.columns)
+    median = pd.DataFrame(median, index=frame.index, columns=frame.columns)
+    return frame.mask(spikes, median), spikes
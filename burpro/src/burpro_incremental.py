@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+:DESCRIPTION: Incremental processing of KOR exports that keep growing.  A
+              per-site state file holds the per burst results of the last
+              run, the last processed burst, a digest of the raw data before
+              it and a fingerprint of the run parameters.  The next run of
+              the same deployment reuses the stored bursts and only computes
+              the bursts from the last processed one on.  If the parameters
+              or the earlier raw data changed, every burst is recomputed.
+
+:REQUIRES: burpro_cache.py, burpro_engine.py
+
+:AUTHOR: John Franco Saraceno, John M. Donovan
+:ORGANIZATION: U.S. Geological Survey, United States Department of Interior
+:CONTACT: saraceno@usgs.gov, jmd@usgs.gov
+
+"""
+# =============================================================================
+# IMPORT STATEMENTS
+# =============================================================================
+from __future__ import print_function
+import hashlib
+import json
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from burpro_cache import read_frame, write_frame
+from burpro_engine import full_interval_index
+
+# bump when the layout of the state file or the per burst results change
+STATE_VERSION = 1
+STATE_EXT = '.npz'
+MINUTES_PER_DAY = 24 * 60
+
+
+def default_state_dir():
+    return os.path.join(os.path.expanduser('~'), '.burpro', 'state')
+
+
+def sonde_serial(devices):
+    """Return the serial number of the sonde of a device table, or of its
+    first device when there is no sonde"""
+    sondes = [device for device in devices
+              if 'sonde' in device['Device Name'].lower()] or devices
+    return sondes[0]['Serial Number'] if sondes else 'unknown'
+
+
+def site_key(devices, first_timestamp):
+    """Name the state of a deployment by the sonde serial number and the
+    first record of the export, which stay the same as the export grows"""
+    serial = re.sub(r'[^\w.-]', '_', str(sonde_serial(devices)))
+    return serial + '_' + first_timestamp.strftime('%Y%m%dT%H%M%S')
+
+
+def state_path(state_dir, key):
+    return os.path.join(state_dir, key + STATE_EXT)
+
+
+def params_fingerprint(*run_params):
+    """Return a digest of any json serializable values that change the per
+    burst results"""
+    fingerprint = json.dumps([STATE_VERSION] + list(run_params),
+                             sort_keys=True)
+    return hashlib.sha256(fingerprint.encode('utf-8')).hexdigest()
+
+
+def data_digest(frame):
+    """Return a digest of the timestamps and values of a float dataframe"""
+    digest = hashlib.sha256(np.ascontiguousarray(frame.index.asi8).tobytes())
+    digest.update(np.ascontiguousarray(frame.values, dtype=float).tobytes())
+    return digest.hexdigest()
+
+
+def load_state(filename):
+    """Return the (per burst results, metadata dict) of a state file, or
+    None when there is no usable state"""
+    if not os.path.isfile(filename):
+        return None
+    try:
+        return read_frame(filename)
+    except (IOError, ValueError, KeyError):
+        return None
+
+
+def resume_point(log, state, df_exo_float, fingerprint, interval):
+    """Return the label of the first burst to compute, or None when every
+    burst has to be computed"""
+    if state is None:
+        log.info('Incremental: no earlier state, processing all bursts')
+        return None
+    results, extra = state
+    if extra.get('fingerprint') != fingerprint:
+        log.info('Incremental: run parameters changed, processing all bursts')
+        return None
+    if MINUTES_PER_DAY % interval:
+        # bursts of a later start day would not line up with the stored ones
+        log.info('Incremental: interval does not divide a day, processing '
+                 'all bursts')
+        return None
+    # the last burst may have been cut short by the earlier export
+    resume = pd.Timestamp(extra['last_burst'])
+    before = df_exo_float[df_exo_float.index < resume]
+    if (len(before) != extra['rows_before'] or
+            data_digest(before) != extra['digest_before']):
+        log.info('Incremental: earlier data changed, processing all bursts')
+        return None
+    return resume
+
+
+def incremental_mad(log, df_exo_float, interval, state_file, fingerprint,
+                    calc):
+    """Compute the per burst results of df_exo_float, reusing the results
+    stored in state_file where the data and run parameters are unchanged,
+    then store the new state
+    INPUT:
+    logger, float dataframe, burst interval in minutes, state filename,
+    run parameter fingerprint, function returning the results of a dataframe
+    RETURNS:
+    pandas dataframe of per burst results"""
+    state = load_state(state_file)
+    resume = resume_point(log, state, df_exo_float, fingerprint, interval)
+    if resume is None:
+        exo_mad = calc(df_exo_float)
+    else:
+        previous = state[0][state[0].index < resume]
+        log.info('Incremental: reusing %d bursts, processing from %s',
+                 len(previous), resume)
+        new = calc(df_exo_float[df_exo_float.index >= resume])
+        exo_mad = pd.concat([previous, new])
+        exo_mad = exo_mad.reindex(full_interval_index(exo_mad.index,
+                                                      interval,
+                                                      new.index.name))
+    if len(exo_mad):
+        last_burst = exo_mad.index[-1]
+        before = df_exo_float[df_exo_float.index < last_burst]
+        write_frame(state_file, exo_mad,
+                    {'fingerprint': fingerprint,
+                     'last_burst': last_burst.isoformat(),
+                     'rows_before': len(before),
+                     'digest_before': data_digest(before)})
+    return exo_mad
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+:DESCRIPTION: Metadata only inspection of KOR-EXO exports.  Reads the
+              device table from the rows above the data header and the
+              first and last timestamps of the record, without reading the
+              data, to build an inventory of an archive of input files.
+
+:REQUIRES: burpro_process.py, burpro_reader.py, burpro_run_mgr.py
+
+:USAGE: python burpro.py --inspect DIRECTORY_OR_FILE [...]
+        python burpro.py --inspect --inspect-dir OUTPUT_DIRECTORY ...
+
+:AUTHOR: John Franco Saraceno, John M. Donovan
+:ORGANIZATION: U.S. Geological Survey, United States Department of Interior
+:CONTACT: saraceno@usgs.gov, jmd@usgs.gov
+
+"""
+# =============================================================================
+# IMPORT STATEMENTS
+# =============================================================================
+from __future__ import print_function
+import json
+import multiprocessing
+import os
+
+from burpro_process import (ParsedKorFile, datetime_index, read_kor_header,
+                            select_kor_columns, write_device_to_json)
+from burpro_reader import SheetXml
+from burpro_run_mgr import read_json_params
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+SITE_COL = u'Site Name'
+
+
+def first_data_row(rows, date_col):
+    """Return the first row of rows with a date, None when there is none"""
+    for row in rows:
+        if len(row) > date_col and row[date_col] is not None:
+            return row
+    return None
+
+
+def row_site_name(columns, row):
+    """Return the Site Name cell of a data row, None when it is blank"""
+    if row is None or SITE_COL not in columns:
+        return None
+    col = columns.index(SITE_COL)
+    value = row[col] if col < len(row) else None
+    if value is None or not unicode(value).strip():
+        return None
+    return unicode(value).strip()
+
+
+def read_site_name(exo_filename, drop_cols):
+    """Return the Site Name of the first data row of a KOR export, None when
+    the export has none.  Only the rows up to the first data row are read"""
+    with SheetXml(exo_filename) as sheet:
+        rows = sheet.rows()
+        _, _, columns = read_kor_header(rows, drop_cols)
+        first = first_data_row(rows, columns.index(drop_cols[0]))
+        rows.close()
+    return row_site_name(columns, first)
+
+
+def inspect_kor_file(exo_filename, drop_cols, index_timezone):
+    """Read the device table and the first and last timestamps of a KOR
+    export.  The Start and End times of every device are those of the whole
+    record, where a full run reports those of each device's data
+    INPUT:
+    .xlsx filename, list of columns to drop, index name
+    RETURNS:
+    dict with the file, site name, first and last timestamps, data columns
+    and the device table as written to _EXOdevices.json"""
+    with SheetXml(exo_filename) as sheet:
+        rows = sheet.rows()
+        devices, device_columns, columns = read_kor_header(rows, drop_cols)
+        date_col = columns.index(drop_cols[0])
+        time_col = columns.index(drop_cols[1])
+        first = first_data_row(rows, date_col)
+        rows.close()
+        last = sheet.last_row(date_col) if first else None
+        start = end = None
+        if first and last:
+            cells = [[sheet.to_datetime(row[col] if col < len(row) else None)
+                      for row in (first, last)]
+                     for col in (date_col, time_col)]
+            stamps = datetime_index(cells[0], cells[1], index_timezone)
+            start, end = [stamp.strftime(DATETIME_FORMAT)
+                          for stamp in stamps]
+    table = ParsedKorFile(devices, device_columns, None).device_table(True)
+    for device in table:
+        device['Start time'] = start
+        device['End time'] = end
+    return {'file': exo_filename,
+            'site': row_site_name(columns, first),
+            'first': start,
+            'last': end,
+            'columns': [columns[i]
+                        for i in select_kor_columns(columns, drop_cols)],
+            'devices': table}
+
+
+def inspect_worker(task):
+    """Process pool entry point. Never raises, so that one unreadable file
+    does not stop the inventory"""
+    exo_filename, drop_cols, index_timezone = task
+    try:
+        return inspect_kor_file(exo_filename, drop_cols, index_timezone)
+    except Exception as error:
+        return {'file': exo_filename,
+                'error': '%s: %s' % (type(error).__name__, error)}
+
+
+def inspect(files, output_dir=None, jobs=1):
+    """Inspect files, jobs at a time, and print the inventory as json, or
+    write each file's _EXOdevices.json to output_dir
+    RETURNS:
+    list of inspect_kor_file results, with an error entry for files that
+    could not be read"""
+    params = read_json_params()
+    tasks = [(exo_filename, params['drop_cols'],
+              params.get('index_timezone', 'Datetime (PST)'))
+             for exo_filename in files]
+    if jobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(processes=min(jobs, len(tasks)))
+        try:
+            inventory = pool.map(inspect_worker, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        inventory = [inspect_worker(task) for task in tasks]
+    if output_dir is None:
+        print(json.dumps(inventory, indent=4, sort_keys=True))
+        return inventory
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    for entry in inventory:
+        if 'error' in entry:
+            print('failed ', entry['file'], entry['error'])
+            continue
+        write_device_to_json(os.path.join(
+                                 output_dir,
+                                 os.path.basename(entry['file']).replace(
+                                     '.xlsx', '_EXOdevices.json')),
+                             entry['devices'])
+    return inventory
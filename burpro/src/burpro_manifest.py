@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+:DESCRIPTION: Manifest of the files a directory run has processed.  For
+              each input file it records the size, modification time and
+              content hash, a fingerprint of the run parameters and the
+              output directory.  A later run of the same directory skips
+              files whose content and run parameters have not changed.
+              Files whose size and modification time are unchanged are not
+              hashed again, so a run with nothing to do only stats the
+              files.
+
+:REQUIRES: burpro_cache.py (only to hash changed files)
+
+:AUTHOR: John Franco Saraceno, John M. Donovan
+:ORGANIZATION: U.S. Geological Survey, United States Department of Interior
+:CONTACT: saraceno@usgs.gov, jmd@usgs.gov
+
+"""
+# =============================================================================
+# IMPORT STATEMENTS
+# =============================================================================
+from __future__ import print_function
+import datetime
+import hashlib
+import json
+import os
+import tempfile
+
+MANIFEST_FILE = 'BurPro_manifest.json'
+# bump when the layout of the manifest changes
+MANIFEST_VERSION = 1
+
+
+def run_fingerprint(params, version):
+    """Return a digest of the run parameters and BurPro version"""
+    fingerprint = json.dumps([MANIFEST_VERSION, version, params],
+                             sort_keys=True)
+    return hashlib.sha256(fingerprint.encode('utf-8')).hexdigest()
+
+
+class Manifest(object):
+    """The processed files of a directory, kept in MANIFEST_FILE at its top.
+    Files are keyed by their path relative to the directory, so that an
+    archive can be moved"""
+
+    def __init__(self, directory, fingerprint):
+        self.directory = os.path.abspath(directory)
+        self.filename = os.path.join(self.directory, MANIFEST_FILE)
+        self.fingerprint = fingerprint
+        self.entries = {}
+        # entries changed since the manifest was written
+        self.modified = False
+        try:
+            with open(self.filename) as infile:
+                manifest = json.load(infile)
+        except (IOError, ValueError):
+            return
+        if manifest.get('version') == MANIFEST_VERSION:
+            self.entries = manifest.get('files', {})
+
+    def key(self, exo_filename):
+        return os.path.relpath(os.path.abspath(exo_filename),
+                               self.directory).replace(os.sep, '/')
+
+    def is_current(self, exo_filename):
+        """True when a file was processed with the current run parameters
+        and its content has not changed since.  The recorded modification
+        time of a file touched without changes is updated"""
+        entry = self.entries.get(self.key(exo_filename))
+        if entry is None or entry['params'] != self.fingerprint:
+            return False
+        stat = os.stat(exo_filename)
+        if (entry['size'], entry['mtime']) == (stat.st_size, stat.st_mtime):
+            return True
+        # touched or copied, compare the content
+        from burpro_cache import file_digest
+        if entry['size'] != stat.st_size or \
+                entry['sha256'] != file_digest(exo_filename):
+            return False
+        entry['mtime'] = stat.st_mtime
+        self.modified = True
+        return True
+
+    def pending(self, files):
+        """Split files into those to process and those already current
+        RETURNS:
+        list of files to process, list of current files"""
+        todo = []
+        current = []
+        for exo_filename in files:
+            if self.is_current(exo_filename):
+                current.append(exo_filename)
+            else:
+                todo.append(exo_filename)
+        if self.modified:
+            self.write()
+        return todo, current
+
+    def output_dir(self, exo_filename):
+        return self.entries[self.key(exo_filename)]['output_dir']
+
+    def record(self, exo_filename, output_dir):
+        """Add a processed file and write the manifest"""
+        from burpro_cache import file_digest
+        stat = os.stat(exo_filename)
+        self.entries[self.key(exo_filename)] = {
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'sha256': file_digest(exo_filename),
+            'params': self.fingerprint,
+            'output_dir': output_dir,
+            'processed': datetime.datetime.now().strftime(
+                '%Y-%m-%dT%H:%M:%S')}
+        self.write()
+
+    def write(self):
+        """Replace the manifest in one step so that an interrupted run never
+        leaves a partial file"""
+        handle, tmp_path = tempfile.mkstemp(suffix='.tmp',
+                                            dir=self.directory)
+        with os.fdopen(handle, 'w') as outfile:
+            json.dump({'version': MANIFEST_VERSION, 'files': self.entries},
+                      outfile, indent=4, sort_keys=True)
+        if os.path.exists(self.filename):
+            # os.rename does not replace files on Windows
+            os.remove(self.filename)
+        os.rename(tmp_path, self.filename)
+        self.modified = False
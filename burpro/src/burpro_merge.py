@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+:DESCRIPTION: Merges overlapping KOR-EXO exports of one site, such as a mid
+              deployment and an end of deployment download of the same
+              sonde, into a single record.  Columns are aligned by name
+              across the device tables of the files and the time sorted
+              records are combined with a k-way merge that drops repeated
+              timestamps, so that the burst reduction runs once over the
+              whole deployment.
+
+:REQUIRES: burpro_process.py
+
+:USAGE: python burpro.py --merge FILE FILE [...]
+
+:AUTHOR: John Franco Saraceno, John M. Donovan
+:ORGANIZATION: U.S. Geological Survey, United States Department of Interior
+:CONTACT: saraceno@usgs.gov, jmd@usgs.gov
+
+"""
+# =============================================================================
+# IMPORT STATEMENTS
+# =============================================================================
+from __future__ import print_function
+import os
+
+import numpy as np
+import pandas as pd
+
+from burpro_process import ParsedKorFile, float_dtype, read_input
+
+
+def merged_filename(files):
+    """Return the name the outputs of a merge run are named after, the first
+    input file with _merged appended"""
+    return files[0].replace('.xlsx', '_merged.xlsx')
+
+
+def merge_two_runs(left, right):
+    """Merge two time sorted runs of (timestamps, row numbers).  Rows of
+    right go after the rows of left with the same timestamp"""
+    left_times, left_rows = left
+    right_times, right_rows = right
+    positions = (np.searchsorted(left_times, right_times, side='right') +
+                 np.arange(len(right_times)))
+    from_right = np.zeros(len(left_times) + len(right_times), dtype=bool)
+    from_right[positions] = True
+    times = np.empty(len(from_right), dtype=left_times.dtype)
+    rows = np.empty(len(from_right), dtype=left_rows.dtype)
+    times[from_right] = right_times
+    times[~from_right] = left_times
+    rows[from_right] = right_rows
+    rows[~from_right] = left_rows
+    return times, rows
+
+
+def merge_sorted_runs(runs):
+    """k-way merge of time sorted int64 timestamp arrays, keeping the first
+    row of each timestamp.  Runs are merged pairwise, neighbours first, so
+    every row is moved log2(k) times and the cost grows linearly with the
+    total number of rows.  A timestamp held by several runs is taken from
+    the first of them
+    INPUT:
+    list of sorted int64 arrays
+    RETURNS:
+    int array of row numbers, in the concatenation of runs, of the rows
+    kept, in time order"""
+    pending = []
+    offset = 0
+    for run in runs:
+        pending.append((run, np.arange(offset, offset + len(run))))
+        offset += len(run)
+    if not pending:
+        return np.arange(0)
+    while len(pending) > 1:
+        merged = [merge_two_runs(pending[i], pending[i + 1])
+                  for i in range(0, len(pending) - 1, 2)]
+        if len(pending) % 2:
+            merged.append(pending[-1])
+        pending = merged
+    times, rows = pending[0]
+    keep = np.ones(len(times), dtype=bool)
+    keep[1:] = times[1:] != times[:-1]
+    return rows[keep]
+
+
+def merge_device_tables(parsed_files):
+    """Combine the devices of several exports, a device being identified by
+    its name and serial number, each with the union of its data columns
+    RETURNS:
+    list of device dicts, list of lists of their data columns"""
+    devices = []
+    device_columns = []
+    keys = []
+    for parsed_kor in parsed_files:
+        for device, columns in zip(parsed_kor.devices,
+                                   parsed_kor.device_columns):
+            key = (device['Device Name'], device['Serial Number'])
+            if key not in keys:
+                keys.append(key)
+                devices.append(dict(device))
+                device_columns.append([])
+            merged_columns = device_columns[keys.index(key)]
+            merged_columns.extend(col for col in columns
+                                  if col not in merged_columns)
+    return devices, device_columns
+
+
+def column_serials(parsed_kor):
+    """Return the serial number of the device measuring each data column"""
+    serials = {}
+    for device, columns in zip(parsed_kor.devices, parsed_kor.device_columns):
+        for col in columns:
+            serials.setdefault(col, device['Serial Number'])
+    return serials
+
+
+def merge_parsed_files(log, parsed_files, names, dtype=np.float64):
+    """Merge ParsedKorFiles into one.  Data columns are the union of the
+    columns of every file, in the order they first appear, and are aligned
+    by name.  A column measured by different sensors in different files,
+    after a sensor swap, is logged and continues as one series
+    INPUT:
+    logger, list of ParsedKorFiles in order of precedence, their filenames,
+    float dtype
+    RETURNS:
+    ParsedKorFile"""
+    columns = []
+    serials = {}
+    for parsed_kor, name in zip(parsed_files, names):
+        for col, serial in column_serials(parsed_kor).items():
+            if col in serials and serials[col][0] != serial:
+                log.info('Column %s is measured by %s in %s and by %s '
+                         'in %s', col, serials[col][0], serials[col][1],
+                         serial, name)
+            serials.setdefault(col, (serial, name))
+        columns.extend(col for col in parsed_kor.data.columns
+                       if col not in columns)
+
+    runs = []
+    orders = []
+    for parsed_kor in parsed_files:
+        times = parsed_kor.data.index.asi8
+        order = np.arange(len(times))
+        if not parsed_kor.data.index.is_monotonic_increasing:
+            order = np.argsort(times, kind='mergesort')
+        runs.append(times[order])
+        orders.append(order)
+    rows = merge_sorted_runs(runs)
+    offsets = np.cumsum([0] + [len(run) for run in runs])
+
+    values = np.full((len(rows), len(columns)), np.nan, dtype=dtype)
+    for parsed_kor, order, start, stop in zip(parsed_files, orders,
+                                              offsets[:-1], offsets[1:]):
+        selected = np.flatnonzero((rows >= start) & (rows < stop))
+        positions = [columns.index(col) for col in parsed_kor.data.columns]
+        values[selected[:, None], positions] = \
+            parsed_kor.data.values[order[rows[selected] - start]]
+    index = pd.DatetimeIndex(np.concatenate(runs)[rows],
+                             name=parsed_files[0].data.index.name)
+    devices, device_columns = merge_device_tables(parsed_files)
+    log.info('Merged %d rows of %d files into %d rows',
+             offsets[-1], len(parsed_files), len(rows))
+    return ParsedKorFile(devices, device_columns,
+                         pd.DataFrame(values, index=index, columns=columns))
+
+
+def merge_kor_files(log, files, params):
+    """Read KOR exports of one site and merge them into a single record.
+    Files earlier in the list take precedence where timestamps repeat
+    INPUT:
+    logger, list of .xlsx filenames, run parameters
+    RETURNS:
+    ParsedKorFile"""
+    parsed_files = []
+    for exo_filename in files:
+        log.info('Merging input file: ' + exo_filename.split(os.sep)[-1])
+        parsed_files.append(read_input(log, exo_filename, params))
+    return merge_parsed_files(log, parsed_files,
+                              [exo_filename.split(os.sep)[-1]
+                               for exo_filename in files],
+                              float_dtype(params))
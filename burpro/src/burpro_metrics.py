@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+:DESCRIPTION: Per-stage run instrumentation.  Each stage of a run records
+              its wall time, cpu time, peak resident memory, row and burst
+              counts and burst throughput, which are written to the run log
+              and to a machine readable _metrics.json file.
+
+:REQUIRES: psutil (optional)
+
+:AUTHOR: John Franco Saraceno, John M. Donovan
+:ORGANIZATION: U.S. Geological Survey, United States Department of Interior
+:CONTACT: saraceno@usgs.gov, jmd@usgs.gov
+
+"""
+# =============================================================================
+# IMPORT STATEMENTS
+# =============================================================================
+from __future__ import print_function
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+MB = 1024. * 1024.
+
+
+def current_rss():
+    """Resident set size of this process in bytes, 0 when unavailable"""
+    try:
+        import psutil
+        return psutil.Process(os.getpid()).memory_info().rss
+    except ImportError:
+        pass
+    if sys.platform == 'win32':
+        return _windows_working_set()
+    try:
+        import resource
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, ImportError):
+        return 0
+
+
+def _windows_working_set():
+    import ctypes
+    from ctypes import wintypes
+
+    class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+        _fields_ = [('cb', wintypes.DWORD),
+                    ('PageFaultCount', wintypes.DWORD),
+                    ('PeakWorkingSetSize', ctypes.c_size_t),
+                    ('WorkingSetSize', ctypes.c_size_t),
+                    ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+                    ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                    ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+                    ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                    ('PagefileUsage', ctypes.c_size_t),
+                    ('PeakPagefileUsage', ctypes.c_size_t)]
+
+    counters = PROCESS_MEMORY_COUNTERS()
+    counters.cb = ctypes.sizeof(counters)
+    process = ctypes.windll.kernel32.GetCurrentProcess()
+    if not ctypes.windll.psapi.GetProcessMemoryInfo(process,
+                                                    ctypes.byref(counters),
+                                                    counters.cb):
+        return 0
+    return counters.WorkingSetSize
+
+
+class PeakRssSampler(threading.Thread):
+    """Polls the resident set size until stopped and keeps the peak"""
+
+    def __init__(self, interval=0.005):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.start_rss = self.peak_rss = current_rss()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.peak_rss = max(self.peak_rss, current_rss())
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.peak_rss = max(self.peak_rss, current_rss())
+
+
+def cpu_seconds():
+    times = os.times()
+    return times[0] + times[1]
+
+
+class RunMetrics(object):
+    """Collects the timing and memory use of each stage of a run. Stages are
+    logged to log as they finish when a logger is given"""
+
+    def __init__(self, log=None):
+        self.log = log
+        self.stages = []
+        self.started = time.time()
+        self.started_cpu = cpu_seconds()
+
+    @contextmanager
+    def stage(self, name, rows=None, bursts=None):
+        """Time the enclosed block.  The yielded record may be updated with
+        rows and bursts once they are known"""
+        record = OrderedDict([('stage', name), ('rows', rows),
+                              ('bursts', bursts)])
+        sampler = PeakRssSampler()
+        sampler.start()
+        cpu = cpu_seconds()
+        wall = time.time()
+        try:
+            yield record
+        finally:
+            wall = time.time() - wall
+            cpu = cpu_seconds() - cpu
+            sampler.stop()
+            record['wall_s'] = round(wall, 4)
+            record['cpu_s'] = round(cpu, 4)
+            record['peak_rss_mb'] = round(sampler.peak_rss / MB, 1)
+            record['bursts_per_s'] = None
+            if record['bursts'] and wall > 0:
+                record['bursts_per_s'] = round(record['bursts'] / wall, 1)
+            self.stages.append(record)
+            if self.log is not None:
+                self.log.info(format_stage(record))
+
+    def summary(self):
+        """Return the totals of the run so far"""
+        return OrderedDict([
+            ('wall_s', round(time.time() - self.started, 4)),
+            ('cpu_s', round(cpu_seconds() - self.started_cpu, 4)),
+            ('peak_rss_mb', max([stage['peak_rss_mb']
+                                 for stage in self.stages] or [0.]))])
+
+    def write_json(self, filename, **extra):
+        report = OrderedDict(sorted(extra.items()))
+        report['total'] = self.summary()
+        report['stages'] = self.stages
+        with open(filename, 'w') as outfile:
+            json.dump(report, outfile, indent=4)
+
+
+def format_stage(record):
+    message = 'Stage %s: %.3f s wall, %.3f s cpu, peak RSS %.1f MB' % (
+        record['stage'], record['wall_s'], record['cpu_s'],
+        record['peak_rss_mb'])
+    if record['rows'] is not None:
+        message += ', %d rows' % record['rows']
+    if record['bursts'] is not None:
+        message += ', %d bursts' % record['bursts']
+    if record['bursts_per_s'] is not None:
+        message += ', %.1f bursts/s' % record['bursts_per_s']
+    return message
@@ -4,9 +4,6 @@
 
 :REQUIRES: .xlsx burst data files in cwd folder "data"
 
-:#TODO:
-1) Add support to write mad files to csv format
-
 :AUTHOR: John Franco Saraceno, John M. Donovan
 :ORGANIZATION: U.S. Geological Survey, United States Department of Interior
 :CONTACT: saraceno@usgs.gov, jmd@usgs.gov
@@ -18,67 +15,260 @@
 from __future__ import print_function
 import datetime
 import getpass
+import itertools
 import json
 import logging
 import os
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 import pandas as pd
 import numpy.ma as ma
-import statsmodels.robust.scale as smc
 
-def fetch_file_metadata(dataframe, drop_cols, jsonfile=False):
-    frame = dataframe.copy()
+from burpro_cache import cache_key, default_cache_dir, load_frame, store_frame
+from burpro_engine import (QA_STATISTICS, burst_segments,
+                           full_interval_index, gap_segments, hampel_filter,
+                           median_abs_deviation, pack_bursts, qa_frames,
+                           reduce_parameters, round_float32)
+from burpro_incremental import (default_state_dir, incremental_mad,
+                                params_fingerprint, site_key, state_path)
+from burpro_metrics import RunMetrics
+from burpro_reader import (iter_data_chunks, iter_sheet_rows,
+                           read_data_columns, read_header_block)
+from burpro_shared import reduce_shared
+from burpro_stream import (BurstReducer, RecordSummary, cut_chunks,
+                           iter_burst_blocks, iter_bursts)
+from burpro_writer import (check_output_formats, fit_formats, output_base,
+                           write_frames)
+
+# rows read at a time by the streaming pipeline
+CHUNK_ROWS = 10000
+MIN_BURST_LEN = 20
+# bursts are cut where specific conductance is at or below SC_CUTOFF
+SC_COL = u'SpCond µS/cm'
+SC_CUTOFF = 60
+NULL_VALUE = -9999
+LOG_DATETIME_FORMAT = "%Y-%m-%d %H:%M"
+
+
+class ParsedKorFile(object):
+    """A KOR export parsed once: the device table, the data columns that
+    belong to each device and the datetime indexed float data"""
+
+    def __init__(self, devices, device_columns, data):
+        self.devices = devices
+        self.device_columns = device_columns
+        self.data = data
+
+    def device_table(self, jsonfile=False):
+        """Return the device metadata with each device's data columns as a
+        comma separated string for the log file, or as a list for json"""
+        table = []
+        for device, columns in zip(self.devices, self.device_columns):
+            entry = dict(device)
+            if jsonfile is False:
+                entry['Corresponding Data Column(s)'] = ', '.join(columns)
+            else:
+                entry['Corresponding Data Column(s)'] = list(columns)
+            table.append(entry)
+        return table
+
+
+def parse_kor_frame(df_exo, drop_cols, index_timezone, dtype=np.float64):
+    """Parse a raw KOR export read with header=None in a single pass.
+    Missing values are left as NaN
+    INPUT:
+    raw pandas dataframe, list of columns to drop, index name, float dtype
+    RETURNS:
+    ParsedKorFile"""
     date_col = drop_cols[0]
     time_col = drop_cols[1]
-    # find starting row by locating Sonde model indicator field
-    nrow = frame.iloc[:, 0].isin([date_col]).idxmax(axis=0, skipna=True)
+    # find starting row by locating indicator date field
+    nrow = df_exo.iloc[:, 0].isin([date_col]).idxmax(axis=0, skipna=True)
+
+    devices = extract_sensor_metadata(df_exo, nrow)
+    dev_col_nums = extract_data_cols(df_exo, nrow)
+    # rename duplicate columns of sensor swaps
+    columns = rename_duplicate_columns(df_exo.iloc[nrow, :].tolist())
+    body = df_exo.iloc[nrow + 1:, :]
 
-    devices = extract_sensor_metadata(frame, nrow)
-    dev_col_nums = extract_data_cols(frame, nrow)
-    dev_cols = return_col_names(dev_col_nums, frame.columns.tolist())
+    device_columns = map_device_columns(dev_col_nums, columns, drop_cols)
+
+    index = datetime_index(body.iloc[:, columns.index(date_col)],
+                           body.iloc[:, columns.index(time_col)],
+                           index_timezone)
+
+    # only copy the parameter columns, less sensor swap duplicates
+    keep = select_kor_columns(columns, drop_cols)
+    data = body.iloc[:, keep].astype(dtype)
+    data.columns = [columns[i] for i in keep]
+    data.index = index
+
+    return ParsedKorFile(devices, device_columns, data)
+
+
+def read_kor_file(exo_filename, drop_cols, index_timezone, dtype=np.float64):
+    """Stream a KOR export workbook straight into a ParsedKorFile. Only the
+    metadata block, the date and time columns and the kept parameter columns
+    are materialized, missing values as NaN
+    INPUT:
+    .xlsx filename, list of columns to drop, index name, float dtype
+    RETURNS:
+    ParsedKorFile"""
+    rows = iter_sheet_rows(exo_filename)
+    devices, device_columns, columns = read_kor_header(rows, drop_cols)
+    keep = select_kor_columns(columns, drop_cols)
+    (dates, times), values = read_data_columns(rows,
+                                               [columns.index(drop_cols[0]),
+                                                columns.index(drop_cols[1])],
+                                               keep, dtype)
+    data = kor_data_frame(dates, times, values, [columns[i] for i in keep],
+                          index_timezone, dtype)
+
+    return ParsedKorFile(devices, device_columns, data)
+
+
+def stream_kor_file(exo_filename, drop_cols, index_timezone,
+                    chunk_rows=CHUNK_ROWS, dtype=np.float64):
+    """Open a KOR export workbook for the streaming pipeline. Only the
+    metadata block is read up front
+    INPUT:
+    .xlsx filename, list of columns to drop, index name, rows per chunk,
+    float dtype
+    RETURNS:
+    ParsedKorFile whose data is an empty frame with the data columns
+    generator of float dataframes of up to chunk_rows rows, missing values
+    as NaN"""
+    rows = iter_sheet_rows(exo_filename)
+    devices, device_columns, columns = read_kor_header(rows, drop_cols)
+    keep = select_kor_columns(columns, drop_cols)
+    chunks = iter_data_chunks(rows, [columns.index(drop_cols[0]),
+                                     columns.index(drop_cols[1])],
+                              keep, chunk_rows, dtype)
+    names = [columns[i] for i in keep]
+    empty = pd.DataFrame(columns=names, dtype=dtype,
+                         index=pd.DatetimeIndex([], name=index_timezone))
+    return (ParsedKorFile(devices, device_columns, empty),
+            (kor_data_frame(dates, times, values, names, index_timezone,
+                            dtype)
+             for (dates, times), values in chunks))
+
+
+def read_kor_header(rows, drop_cols):
+    """Consume the metadata block and the data header row of a KOR export
+    INPUT:
+    row iterator from iter_sheet_rows, list of columns to drop
+    RETURNS:
+    list of device dicts, data columns of each device, data column names"""
+    df_meta = pd.DataFrame(read_header_block(rows, drop_cols[0]))
+    nrow = len(df_meta) - 1
 
-    frame = frame.iloc[nrow:, :]
-    frame.columns = frame.iloc[0, :]
+    devices = extract_sensor_metadata(df_meta, nrow)
+    dev_col_nums = extract_data_cols(df_meta, nrow)
     # rename duplicate columns of sensor swaps
-    cols = pd.Series(frame.columns)  # change to: cols= frame.columns.tolist()
-    for dup in frame.columns.get_duplicates():
-        cols[frame.columns.get_loc(dup)] = [dup + '.' + str(d_idx)
-                                            if d_idx != 0 else dup
-                                            for d_idx in range(
-                                            frame.columns.get_loc(dup).sum())]
-    frame.columns = cols
-    frame.drop(frame.index[0], inplace=True)  # drop header row
-
-    frame_drop_col = drop_columns(frame, drop_cols)
-    frame_drop_cols = frame_drop_col.columns.tolist()
-
-    dev_cols = return_col_names(dev_col_nums, frame.columns.tolist())
-    test_cols = dev_cols
-    final_dev_cols = []
-    tmp = []
-    for item in test_cols:
-        for itm in item:
-            if itm in frame_drop_cols:
-                tmp.append(itm)
-        final_dev_cols.append(tmp)
-        tmp = []
-
-    for counter, entry in enumerate(devices):
-        if jsonfile is False:
-            devices[counter]['Corresponding Data Column(s)'] = ', '.join(final_dev_cols[counter])
-        else:
-            devices[counter]['Corresponding Data Column(s)'] = final_dev_cols[counter]
+    columns = rename_duplicate_columns(df_meta.iloc[nrow, :].tolist())
+    device_columns = map_device_columns(dev_col_nums, columns, drop_cols)
+    return devices, device_columns, columns
 
-    df_time = frame[time_col].copy()
-    df_time = df_time.astype(str)
-    frame['date'] = frame[date_col].apply(
-                    lambda x: datetime.datetime.strftime(x, "%Y-%m-%d"))
-    frame.index = pd.to_datetime(frame['date'] + ' ' + df_time)
-    frame.drop(['date'], axis=1, inplace=True)
-    frame = drop_columns(frame, drop_cols)
 
-    return devices
+def kor_data_frame(dates, times, values, names, index_timezone,
+                   dtype=np.float64):
+    index = datetime_index(dates, times, index_timezone)
+    return pd.DataFrame(np.column_stack(values) if values
+                        else np.empty((len(index), 0), dtype=dtype),
+                        index=index, columns=names)
+
+
+def datetime_index(dates, times, index_timezone):
+    """Combine the KOR date and time columns into a DatetimeIndex. Each
+    distinct date and time cell is converted once and the index is built
+    with datetime64 plus timedelta arithmetic
+    INPUT:
+    list like of dates, list like of times, index name
+    RETURNS:
+    pandas DatetimeIndex"""
+    date_codes, date_cells = pd.factorize(np.asarray(dates, dtype=object))
+    time_codes, time_cells = pd.factorize(np.asarray(times, dtype=object))
+    try:
+        if (date_codes < 0).any() or (time_codes < 0).any():
+            raise ValueError('Blank date or time cells')
+        days = date_values(date_cells)
+        offsets = time_offsets(time_cells)
+    except (TypeError, ValueError):
+        return string_datetime_index(dates, times, index_timezone)
+    return pd.DatetimeIndex(days[date_codes] + offsets[time_codes],
+                            name=index_timezone)
+
+
+def date_values(cells):
+    """Return the midnight datetime64 values of date cells, which may be
+    datetimes or date strings"""
+    if not all(isinstance(cell, (datetime.date, basestring))
+               for cell in cells):
+        raise TypeError('Unrecognized date cells')
+    return pd.to_datetime(cells).normalize().values
+
+
+def time_offsets(cells):
+    """Return the timedelta64 offsets from midnight of time cells, which may
+    be times, datetimes, timedeltas or time strings"""
+    offsets = np.empty(len(cells), dtype='m8[ns]')
+    for i, cell in enumerate(cells):
+        if isinstance(cell, datetime.datetime):
+            cell = cell.time()
+        if isinstance(cell, datetime.time):
+            cell = datetime.timedelta(hours=cell.hour, minutes=cell.minute,
+                                      seconds=cell.second,
+                                      microseconds=cell.microsecond)
+        offsets[i] = pd.Timedelta(cell).to_timedelta64()
+    return offsets
+
+
+def string_datetime_index(dates, times, index_timezone):
+    """Build the index by joining the date and time cells as strings and
+    parsing the result, for cells the vectorized path does not recognize"""
+    df_time = pd.Series(np.asarray(times, dtype=object)).astype(str)
+    df_date = pd.Series(np.asarray(dates, dtype=object)).apply(
+                    lambda x: datetime.datetime.strftime(x, "%Y-%m-%d")
+                    if isinstance(x, datetime.date) else str(x))
+    return pd.DatetimeIndex(pd.to_datetime(df_date + ' ' + df_time),
+                            name=index_timezone)
+
+
+def select_kor_columns(columns, drop_cols):
+    """Return the positions of the parameter columns kept for processing,
+    less the columns in drop_cols and sensor swap duplicates"""
+    return [i for i, col in enumerate(columns)
+            if col not in drop_cols and not has_numbers(col)]
+
+
+def map_device_columns(dev_col_nums, columns, drop_cols):
+    """Return the data column names of each device, less drop_cols"""
+    kept_cols = [col for col in columns if col not in drop_cols]
+    return [[col for col in cols if col in kept_cols]
+            for cols in return_col_names(dev_col_nums, columns)]
+
+
+def fetch_file_metadata(dataframe, drop_cols, jsonfile=False):
+    parsed_kor = parse_kor_frame(dataframe, drop_cols, None)
+    return parsed_kor.device_table(jsonfile)
+
+
+def rename_duplicate_columns(names):
+    """Append .1, .2, ... to repeated column names from sensor swaps
+    INPUT:
+    list of column names
+    RETURNS:
+    list of unique column names"""
+    seen = {}
+    renamed = []
+    for name in names:
+        count = seen.get(name, 0)
+        seen[name] = count + 1
+        if count and isinstance(name, basestring):
+            name = name + '.' + str(count)
+        renamed.append(name)
+    return renamed
 
 
 def extract_sensor_metadata(frame, nrow):
@@ -100,59 +290,59 @@ def extract_sensor_metadata(frame, nrow):
     return devices
 
 
-def process(exo_filename, output_dir, params):
-    sc_col = u'SpCond µS/cm'
-    sc_cutoff = 60
+def process(exo_filename, output_dir, params, merge_files=None):
+    sc_col = SC_COL
+    sc_cutoff = SC_CUTOFF
     interval = params.get('interval', 15)
-    drop_cols = params.get('drop_cols', [])
-    index_timezone = params.get('index_timezone', 'Datetime (PST)')
     mad_criteria = params.get('mad_criteria', 2.5)
-
-    date_col = drop_cols[0]
-    time_col = drop_cols[1]
+    output_formats = params.get('output_formats', ['xlsx'])
+    pipeline = params.get('pipeline', 'batch')
     # end constants
+    check_output_formats(output_formats)
     log = logging.getLogger('BurPro')
-    log.info('Reading input file:' + exo_filename.split(os.sep)[-1])
-    log.info('Please wait...')
-    null_value = -9999
-    try:
-        # if .xlsx file exists, then read it into a dataframe
-        df_exo = pd.read_excel(exo_filename, header=None)
-    except IOError, ioerr:
-        # otherwise, break out of the script with an error message
-        log.info(ioerr.message)
-        log.info("The file could not be read into a datframe")
-#        report_setup_error(ioerr)
-
-    log.info('Fetching file metatdata...')
-    file_metadata = fetch_file_metadata(df_exo, drop_cols, False)
-    file_metadata_json = fetch_file_metadata(df_exo, drop_cols, True)
-    log.info('Processing...')
     logger = logging.getLogger('EXOdevices')
-    # make a copy of the read in dataframe for processing
-    df_exo_float, grouped, cut_burst_completion = process_data_frame(df_exo,
-                                                                     date_col,
-                                                                     time_col,
-                                                                     drop_cols,
-                                                                     null_value,
-                                                                     index_timezone,
-                                                                     interval,
-                                                                     sc_col,
-                                                                     sc_cutoff,
-                                                                     file_metadata,
-                                                                     exo_filename,
-                                                                     logger)
-
+    null_value = NULL_VALUE
+    metrics = RunMetrics(log)
+    if merge_files and pipeline == 'streaming':
+        raise ValueError('Merging input files requires the batch pipeline')
+    if pipeline == 'streaming':
+        parsed_kor, exo_mads, rejected, cut_burst_completion, qa = \
+            process_streaming(log, logger, exo_filename, params, sc_col,
+                              sc_cutoff, null_value, metrics)
+    else:
+        parsed_kor, exo_mads, rejected, cut_burst_completion, qa = \
+            process_batch(log, logger, exo_filename, params, sc_col,
+                          sc_cutoff, null_value, metrics, merge_files)
+    despiked = None
+    if params.get('despike_window', 0):
+        with metrics.stage('despike', rows=len(parsed_kor.data)):
+            despiked = despike_record(log, parsed_kor, params, sc_col,
+                                      sc_cutoff)
+    qa_sheets = []
+    if params.get('qa_sheets', False):
+        qa_sheets = [('qa_' + name, frame) for name, frame in qa]
+    with metrics.stage('metadata'):
+        file_metadata = parsed_kor.device_table(jsonfile=False)
+        file_metadata_json = parsed_kor.device_table(jsonfile=True)
 
     exo_filename_only = exo_filename.split(os.sep)[-1]
 
-    # calc median absolute deviation
-    exo_mad = calc_med_abs_dev(log,
-                               df_exo_float,
-                               grouped,
-                               mad_criteria,
-                               null_value)
-    write_output(log, output_dir, exo_filename, exo_mad)
+    if isinstance(mad_criteria, (list, tuple)):
+        # criteria sweep, device times follow the first criteria
+        write_rejected_to_log_file(log, rejected)
+        with metrics.stage('output write'):
+            write_sweep_output(log, output_dir, exo_filename, exo_mads,
+                               mad_criteria, rejected, output_formats,
+                               qa_sheets)
+    else:
+        with metrics.stage('output write', rows=len(exo_mads[0])):
+            write_output(log, output_dir, exo_filename, exo_mads[0],
+                         output_formats, qa_sheets)
+    if despiked is not None:
+        with metrics.stage('despike write', rows=len(despiked)):
+            write_despiked(log, output_dir, exo_filename, despiked,
+                           output_formats)
+    exo_mad = exo_mads[0]
 
     start_times, end_times = get_start_end_times(exo_mad)
     times_to_devices(start_times, end_times, file_metadata)
@@ -161,19 +351,295 @@ def process(exo_filename, output_dir, params):
 
     write_burst_completion_to_log_file(logger, cut_burst_completion)
 
-    write_device_to_json(os.sep.join(
-                         [output_dir,
-                          exo_filename_only.replace('.xlsx',
-                                                    '_EXOdevices.json')
-                          ]),
-                         file_metadata_json)
-
+    with metrics.stage('json write'):
+        write_device_to_json(os.sep.join(
+                             [output_dir,
+                              exo_filename_only.replace('.xlsx',
+                                                        '_EXOdevices.json')
+                              ]),
+                             file_metadata_json)
+
+    results_db = params.get('results_db')
+    if results_db:
+        # imported here, burpro_store reads site names with burpro_inspect
+        from burpro_store import store_run
+        criteria = mad_criteria
+        if isinstance(mad_criteria, (list, tuple)):
+            criteria = mad_criteria[0]
+        with metrics.stage('results store', rows=len(exo_mad)):
+            site, stored = store_run(results_db,
+                                     (merge_files or [exo_filename])[0],
+                                     output_dir, exo_mad, file_metadata_json,
+                                     criteria, params.get('drop_cols', []))
+        log.info('Stored %d burst medians of site %s in %s', stored, site,
+                 results_db)
+
+    total = metrics.summary()
+    log.info('Total: %.3f s wall, %.3f s cpu, peak RSS %.1f MB',
+             total['wall_s'], total['cpu_s'], total['peak_rss_mb'])
+    metrics.write_json(os.path.join(output_dir,
+                                    exo_filename_only.replace(
+                                        '.xlsx', '_metrics.json')),
+                       file=exo_filename_only, pipeline=pipeline,
+                       mad_engine=params.get('mad_engine', 'vectorized'))
     log.info('Processing complete.')
 
 
+def process_batch(log, logger, exo_filename, params, sc_col, sc_cutoff,
+                  null_value, metrics, merge_files=None):
+    """Read the whole input file, or merge the records of merge_files, then
+    calculate the MAD filtered burst medians of every burst
+    RETURNS:
+    as reduce_kor"""
+    # check before the input file is read
+    check_batch_params(params)
+    with metrics.stage('read') as stage:
+        if merge_files:
+            # burpro_merge reads its files with read_input
+            from burpro_merge import merge_kor_files
+            parsed_kor = merge_kor_files(log, merge_files, params)
+        else:
+            parsed_kor = read_input(log, exo_filename, params)
+        stage['rows'] = len(parsed_kor.data)
+    return reduce_kor(log, logger, exo_filename, parsed_kor, params, sc_col,
+                      sc_cutoff, null_value, metrics)
+
+
+def check_batch_params(params):
+    """Raise ValueError for run parameters the batch pipeline cannot combine"""
+    mad_engine = params.get('mad_engine', 'vectorized')
+    if params.get('mad_processes', 1) > 1 and mad_engine == 'groupby':
+        raise ValueError('mad_processes requires the vectorized mad_engine')
+    if burst_gap(params) is not None and mad_engine == 'groupby':
+        raise ValueError('Gap segmentation requires the vectorized '
+                         'mad_engine')
+    if params.get('qa_sheets', False) and (mad_engine == 'groupby' or
+                                           params.get('incremental', False)):
+        raise ValueError('QA sheets require the vectorized mad_engine '
+                         'without incremental mode')
+    if isinstance(params.get('mad_criteria', 2.5), (list, tuple)) and \
+            params.get('incremental', False):
+        raise ValueError('A list of mad_criteria cannot be combined with '
+                         'incremental mode')
+
+
+def reduce_kor(log, logger, exo_filename, parsed_kor, params, sc_col,
+               sc_cutoff, null_value, metrics):
+    """Calculate the MAD filtered burst medians of every burst of a
+    ParsedKorFile
+    INPUT:
+    run logger, device logger, input filename, ParsedKorFile, run
+    parameters, SpCond column, SpCond cutoff, null value, RunMetrics
+    RETURNS:
+    ParsedKorFile, list of dataframes of MAD filtered burst medians, one per
+    criteria, dataframe of rejected fractions or None, dict of burst
+    completeness, list of (name, dataframe) burst QA statistics or None"""
+    check_batch_params(params)
+    interval = params.get('interval', 15)
+    mad_criteria = params.get('mad_criteria', 2.5)
+    mad_engine = params.get('mad_engine', 'vectorized')
+    incremental = params.get('incremental', False)
+    threads = params.get('mad_threads', 1)
+    processes = params.get('mad_processes', 1)
+    scratch_dir = params.get('scratch_dir') or None
+    max_gap = burst_gap(params)
+    log.info('Processing...')
+    with metrics.stage('frame processing') as stage:
+        df_exo_float, grouped = process_data_frame(parsed_kor, interval,
+                                                   sc_col, sc_cutoff,
+                                                   exo_filename, logger)
+        stage['rows'] = len(df_exo_float)
+        # bursts holding samples, as the grouping stage counts them
+        stage['bursts'] = int((grouped.size() > 0).sum())
+
+    # calc median absolute deviation
+    rejected = None
+    qa = None
+    if isinstance(mad_criteria, (list, tuple)):
+        if mad_engine == 'groupby':
+            raise ValueError('A list of mad_criteria requires the '
+                             'vectorized mad_engine')
+        exo_mads, rejected, qa = calc_med_abs_dev_sweep(log,
+                                                        df_exo_float,
+                                                        interval,
+                                                        mad_criteria,
+                                                        null_value,
+                                                        metrics,
+                                                        max_gap,
+                                                        threads,
+                                                        processes,
+                                                        scratch_dir)
+    elif incremental and len(df_exo_float):
+        state_dir = params.get('state_dir') or default_state_dir()
+        state_file = state_path(state_dir,
+                                site_key(parsed_kor.devices,
+                                         parsed_kor.data.index[0]))
+        fingerprint = params_fingerprint(interval, mad_criteria, sc_col,
+                                         sc_cutoff, null_value, max_gap,
+                                         params.get('drop_cols', []),
+                                         df_exo_float.index.name,
+                                         df_exo_float.columns.tolist())
+        exo_mads = [incremental_mad(log, df_exo_float, interval, state_file,
+                                    fingerprint,
+                                    lambda df: calc_mad(log, df, None,
+                                                        interval,
+                                                        mad_criteria,
+                                                        mad_engine,
+                                                        null_value,
+                                                        metrics,
+                                                        max_gap,
+                                                        threads,
+                                                        processes,
+                                                        scratch_dir))]
+    elif mad_engine == 'groupby':
+        exo_mads = [calc_med_abs_dev(log, df_exo_float, grouped,
+                                     mad_criteria, null_value, metrics,
+                                     threads)]
+    else:
+        exo_mads, _, qa = calc_med_abs_dev_sweep(log, df_exo_float, interval,
+                                                 [mad_criteria], null_value,
+                                                 metrics, max_gap, threads,
+                                                 processes, scratch_dir)
+
+    # the QA sample and missing counts add up to the length of every burst
+    if qa is None:
+        cut_count = burst_sizes(df_exo_float, grouped, interval, max_gap)
+    else:
+        cut_count = dict(qa)['samples'] + dict(qa)['missing']
+    cut_burst_completion = count_min_n_bursts(cut_count, MIN_BURST_LEN)
+    return parsed_kor, exo_mads, rejected, cut_burst_completion, qa
+
+
+def process_streaming(log, logger, exo_filename, params, sc_col, sc_cutoff,
+                      null_value, metrics):
+    """Stream the input file through the bounded memory burst pipeline of
+    burpro_stream.  Results are the same as process_batch with the
+    vectorized mad_engine
+    RETURNS:
+    ParsedKorFile without data, list of dataframes of MAD filtered burst
+    medians, one per criteria, dataframe of rejected fractions, dict of
+    burst completeness, list of (name, dataframe) burst QA statistics or
+    None"""
+    interval = params.get('interval', 15)
+    mad_criteria = params.get('mad_criteria', 2.5)
+    criteria = mad_criteria
+    if not isinstance(mad_criteria, (list, tuple)):
+        criteria = [mad_criteria]
+    if params.get('incremental', False):
+        raise ValueError('Incremental mode requires the batch pipeline')
+    if burst_gap(params) is not None:
+        raise ValueError('Gap segmentation requires the batch pipeline')
+    if params.get('despike_window', 0):
+        raise ValueError('Despiking requires the batch pipeline')
+    if params.get('mad_processes', 1) > 1:
+        raise ValueError('mad_processes requires the batch pipeline')
+    log.info('Reading input file:' + exo_filename.split(os.sep)[-1])
+    log.info('Processing in streaming mode...')
+    with metrics.stage('stream') as stage:
+        parsed_kor, chunks = stream_kor_file(exo_filename,
+                                             params.get('drop_cols', []),
+                                             params.get('index_timezone',
+                                                        'Datetime (PST)'),
+                                             params.get('chunk_rows',
+                                                        CHUNK_ROWS),
+                                             float_dtype(params))
+        columns = parsed_kor.data.columns
+        for col in columns:
+            log.info('Parameter: ' + col)
+        record = RecordSummary(interval)
+        record_cut = RecordSummary(interval)
+        reducer = BurstReducer(criteria, len(columns), MIN_BURST_LEN,
+                               null_value, params.get('qa_sheets', False),
+                               params.get('mad_threads', 1))
+        cut = cut_chunks(chunks, sc_col, sc_cutoff, record)
+        for block in iter_burst_blocks(iter_bursts(cut, record_cut)):
+            reducer.reduce(block)
+        stage['rows'] = record.rows
+        stage['bursts'] = len(reducer.codes)
+
+    write_log_file(logger, getpass.getuser(), exo_filename.split(os.sep)[-1],
+                   interval, MIN_BURST_LEN, sc_cutoff, LOG_DATETIME_FORMAT,
+                   record.as_dict(), record_cut.as_dict())
+    exo_mads, rejected, qa = reducer.results(record_cut, interval,
+                                             parsed_kor.data.index.name,
+                                             columns, null_value)
+    return (parsed_kor, exo_mads, rejected,
+            reducer.burst_completion(record_cut, columns), qa)
+
+
+def burst_gap(params):
+    """Return the largest gap within a burst in seconds when the
+    segmentation run parameter is gaps, None when bursts follow fixed
+    interval bins"""
+    if params.get('segmentation', 'interval') == 'gaps':
+        return params.get('burst_gap_sec', 60)
+    return None
+
+
+def float_dtype(params):
+    """Return the dtype input data is processed in, float64 unless the
+    float_dtype run parameter is float32"""
+    return np.dtype(params.get('float_dtype', 'float64'))
+
+
+def read_input(log, exo_filename, params):
+    """Return the ParsedKorFile of an input file.  When parse_cache is set
+    in params, a file already parsed with the same drop_cols and index name
+    is loaded from the cache instead of being read again
+    INPUT:
+    logger, .xlsx filename, run parameters
+    RETURNS:
+    ParsedKorFile"""
+    drop_cols = params.get('drop_cols', [])
+    index_timezone = params.get('index_timezone', 'Datetime (PST)')
+    excel_reader = params.get('excel_reader', 'streaming')
+    dtype = float_dtype(params)
+    use_cache = params.get('parse_cache', False)
+    cache_dir = params.get('cache_dir') or default_cache_dir()
+    cache_bytes = params.get('cache_size_mb', 500) * 1024 * 1024
+
+    log.info('Reading input file:' + exo_filename.split(os.sep)[-1])
+    if use_cache:
+        key = cache_key(exo_filename, drop_cols, index_timezone,
+                        np.dtype(dtype).name)
+        cached = load_frame(cache_dir, key)
+        if cached is not None:
+            log.info('Using cached input data')
+            data, extra = cached
+            return ParsedKorFile(extra['devices'], extra['device_columns'],
+                                 data)
+    log.info('Please wait...')
+    try:
+        # if .xlsx file exists, then read it into a dataframe
+        if excel_reader == 'pandas':
+            df_exo = pd.read_excel(exo_filename, header=None)
+        else:
+            parsed_kor = read_kor_file(exo_filename, drop_cols,
+                                       index_timezone, dtype)
+    except IOError, ioerr:
+        # otherwise, break out of the script with an error message
+        log.info(ioerr.message)
+        log.info("The file could not be read into a datframe")
+        raise
+
+    log.info('Fetching file metatdata...')
+    if excel_reader == 'pandas':
+        parsed_kor = parse_kor_frame(df_exo, drop_cols, index_timezone,
+                                     dtype)
+        del df_exo
+    if use_cache:
+        try:
+            store_frame(cache_dir, key, parsed_kor.data,
+                        {'devices': parsed_kor.devices,
+                         'device_columns': parsed_kor.device_columns},
+                        cache_bytes)
+        except (IOError, OSError) as cache_error:
+            log.info('Could not write the input cache: ' + str(cache_error))
+    return parsed_kor
+
+
 def write_log_file(logger, user_id, fname, interval, min_burst_len,
-                   sc_cutoff, datetime_format, exo, exo_cut,
-                   grouped, grouped_cut):
+                   sc_cutoff, datetime_format, record, record_cut):
 
     logger.info("~~~~~~~~~~~~~~~~~~~~~~EXO Deployment log file~~~~~~~~~~~~~~")
     logger.info("User: %s", user_id)
@@ -184,19 +650,26 @@ def write_log_file(logger, user_id, fname, interval, min_burst_len,
     logger.info("Specific conductance cutoff level: %d", sc_cutoff)
     logger.info("~~~~~~~~~~~~~~~~~~~~~~Deployment metadata~~~~~~~~~~~~~~~~~~")
     logger.info("First record timestamp: %s",
-                exo.index[0].strftime(datetime_format))
+                record['first'].strftime(datetime_format))
     logger.info("Last record timestamp: %s",
-                exo.index[-1].strftime(datetime_format))
-    logger.info("Starting number of measurements: %d", len(exo))
-    logger.info("Number of bursts: %d", grouped.ngroups)
+                record['last'].strftime(datetime_format))
+    logger.info("Starting number of measurements: %d", record['rows'])
+    logger.info("Number of bursts: %d", record['bursts'])
     logger.info("First cut record timestamp: %s",
-                exo_cut.index[0].strftime(datetime_format))
+                record_cut['first'].strftime(datetime_format))
     logger.info("Last cut record timestamp: %s",
-                exo_cut.index[-1].strftime(datetime_format))
-    logger.info("Ending number of measurements: %d", len(exo_cut))
-    logger.info("Number of cut bursts: %d", grouped_cut.ngroups)
+                record_cut['last'].strftime(datetime_format))
+    logger.info("Ending number of measurements: %d", record_cut['rows'])
+    logger.info("Number of cut bursts: %d", record_cut['bursts'])
     logger.info("Number of bursts cut from record: %d",
-                grouped.ngroups - grouped_cut.ngroups)
+                record['bursts'] - record_cut['bursts'])
+
+
+def record_summary(frame, grouped):
+    """Return the first and last timestamps, number of rows and number of
+    burst intervals of a record"""
+    return {'first': frame.index[0], 'last': frame.index[-1],
+            'rows': len(frame), 'bursts': grouped.ngroups}
 
 
 def write_devices_to_log_file(logger, devices):
@@ -229,70 +702,21 @@ def write_burst_completion_to_log_file(logger, cut_burst_completion):
                     entry, cut_burst_completion[entry])
 
 
-def process_data_frame(df_exo,
-                       date_col,
-                       time_col,
-                       drop_cols,
-                       null_value,
-                       index_timezone,
+def process_data_frame(parsed_kor,
                        interval,
                        sc_col,
                        sc_cutoff,
-                       file_metadata,
                        exofilename,
                        logger):
     fname = exofilename.split(os.sep)[-1] #TODO:split this
-    min_burst_len = 20
-    datetime_format = "%Y-%m-%d %H:%M"
+    min_burst_len = MIN_BURST_LEN
+    datetime_format = LOG_DATETIME_FORMAT
     user_id = getpass.getuser()
 
-    frame = df_exo.copy()
+    # dataframe contents are already floats for stat. analysis
+    df_exo_float = parsed_kor.data
 
-    # find starting row by locating indicator date field
-    nrow = frame.iloc[:, 0].isin([date_col]).idxmax(axis=0,
-                                                    skipna=True)
-
-    # lasso sensor data located in the dataframe
-    frame = frame.iloc[nrow:, :]
-    # set the dataframe column keys to the first row in the dataframe
-    frame.columns = frame.iloc[0, :]
-    # rename duplicate columns for sensor swaps
-    cols = pd.Series(frame.columns)
-    for dup in frame.columns.get_duplicates():
-        cols[frame.columns.get_loc(dup)] = [dup + "." + str(d_idx)
-                                            if d_idx != 0 else dup
-                                            for d_idx in
-                                            range(
-                                            frame.columns.get_loc(dup).sum())]
-    frame.columns = cols
-    frame.drop(frame.index[0], inplace=True)
-
-    df_time = frame[time_col].copy()
-    # convert time data to a string
-    df_time = df_time.astype(str)
-    # create a new date + time column from date and time dataframes
-    frame["date"] = frame[date_col].apply(
-                           lambda x: datetime.datetime.strftime(x, "%Y-%m-%d"))
-    # convert new date + time colum to date time index and set a df"s index
-    frame.index = pd.to_datetime(frame["date"] + " " + df_time)
-    # remove columns that arent needed
-
-    # drop unnecessary cols from data frame, frame
-    frame = drop_columns(frame, drop_cols)
-    # concat like columns with different serials from sensor swaps
-    params = list(frame)
-    for i in params:
-        if has_numbers(i):
-            frame.drop(i, axis=1, inplace=True)
-    frame.fillna(null_value, inplace=True)
-    # rename index axis
-    frame.index.name = index_timezone
-    # convert dataframe contents to floats for stat. analysis
-    df_exo_float = frame.astype("float", copy=True)
-
-    df_exo_float_cut = pd.DataFrame()
-    if sc_col in df_exo_float.columns:
-        df_exo_float_cut = df_exo_float[df_exo_float[sc_col] > sc_cutoff]
+    df_exo_float_cut = spcond_cut(df_exo_float, sc_col, sc_cutoff)
     # group bursts by interval
     grouped = df_exo_float.groupby(pd.TimeGrouper(str(interval) + "Min"),
                                    sort=False)
@@ -301,47 +725,267 @@ def process_data_frame(df_exo,
                                            "Min"), sort=False)
 
 
-    cut_count = grouped_cut.count()
-    cut_burst_completion = count_min_n_bursts(cut_count, min_burst_len)
 
     write_log_file(logger, user_id, fname, interval, min_burst_len,
-                   sc_cutoff, datetime_format, df_exo_float, df_exo_float_cut,
-                   grouped, grouped_cut)
+                   sc_cutoff, datetime_format,
+                   record_summary(df_exo_float, grouped),
+                   record_summary(df_exo_float_cut, grouped_cut))
 
-    return df_exo_float_cut, grouped_cut, cut_burst_completion
+    return df_exo_float_cut, grouped_cut
 
 
-def calc_med_abs_dev(log, df_exo_float, grouped, mad_criteria, null_value):
+def spcond_cut(df_exo_float, sc_col, sc_cutoff):
+    """Return the rows above the SpCond cutoff, none without an SpCond
+    column"""
+    if sc_col in df_exo_float.columns:
+        return df_exo_float[df_exo_float[sc_col] > sc_cutoff]
+    return pd.DataFrame()
+
+
+def despike_record(log, parsed_kor, params, sc_col, sc_cutoff):
+    """Hampel filter the full resolution record kept by the SpCond cutoff
+    with a window of despike_window samples and the first mad criteria
+    RETURNS:
+    time sorted despiked dataframe, None when despike_window is 0"""
+    window = params.get('despike_window', 0)
+    if not window:
+        return None
+    criteria = params.get('mad_criteria', 2.5)
+    if isinstance(criteria, (list, tuple)):
+        criteria = criteria[0]
+    despiked, spikes = hampel_filter(spcond_cut(parsed_kor.data, sc_col,
+                                                sc_cutoff),
+                                     window, criteria)
+    for col, count in spikes.sum().iteritems():
+        log.info('%s despiked samples: %d', col, count)
+    return despiked
+
+
+def burst_sizes(df_exo_float, grouped, interval, max_gap=None):
+    """Return the number of samples of every burst and column, with a zero
+    for every interval without a burst.  Missing values count toward the
+    length of a burst
+    INPUT:
+    float dataframe, its TimeGrouper groupby, burst interval in minutes,
+    largest gap within a burst in seconds or None for interval bins
+    RETURNS:
+    pandas dataframe of burst lengths"""
+    if max_gap is None:
+        sizes = grouped.size()
+    elif len(df_exo_float) == 0:
+        sizes = pd.Series([], dtype=int)
+    else:
+        _, offsets, labels = gap_segments(df_exo_float.index, interval,
+                                          max_gap)
+        sizes = pd.Series(np.diff(offsets), index=labels).reindex(
+                    full_interval_index(labels, interval), fill_value=0)
+    return pd.DataFrame(dict((col, sizes) for col in df_exo_float.columns))
+
+
+def calc_mad(log, df_exo_float, grouped, interval, mad_criteria, mad_engine,
+             null_value, metrics=None, max_gap=None, threads=1, processes=1,
+             scratch_dir=None):
+    """Calculate the filtered burst medians with the configured mad_engine.
+    grouped may be None, the groupby engine then groups df_exo_float.
+    Bursts are segmented by gaps when max_gap is given"""
+    if mad_engine == 'groupby':
+        if grouped is None:
+            grouped = df_exo_float.groupby(pd.TimeGrouper(str(interval) +
+                                           "Min"), sort=False)
+        return calc_med_abs_dev(log, df_exo_float, grouped, mad_criteria,
+                                null_value, metrics, threads)
+    return calc_med_abs_dev_vectorized(log, df_exo_float, interval,
+                                       mad_criteria, null_value, metrics,
+                                       max_gap, threads, processes,
+                                       scratch_dir)
+
+
+def calc_med_abs_dev(log, df_exo_float, grouped, mad_criteria, null_value,
+                     metrics=None, threads=1):
+    """Apply custom_mad to every burst, a column at a time.  With more than
+    one thread the columns are reduced concurrently on a thread pool that
+    shares df_exo_float; results are collected, logged and stored in column
+    order
+    INPUT:
+    logger, float dataframe, its TimeGrouper groupby, mad criteria,
+    null value, run metrics, number of threads
+    RETURNS:
+    pandas dataframe of MAD filtered burst medians"""
+    metrics = metrics or RunMetrics()
     exo_mad = pd.DataFrame()
-    # apply the mad calculation column wise to data frame
-    for i in np.arange(0, len(df_exo_float.columns), 1):
-        step_number = 'Parameter: ' + df_exo_float.columns[i]
-        log.info(step_number)
-        exo_mad[df_exo_float.columns[i]] = grouped[
-                                           df_exo_float.columns[i]].apply(
-                                           custom_mad, criteria=mad_criteria)
+    columns = df_exo_float.columns
+    # build the groups once, before any worker uses them
+    bursts = int((grouped.size() > 0).sum())
+
+    def column_mad(col):
+        return grouped[col].apply(custom_mad, criteria=mad_criteria,
+                                  null_value=null_value)
+
+    pool = None
+    if threads > 1 and len(columns) > 1:
+        pool = ThreadPool(min(threads, len(columns)))
+        results = pool.imap(column_mad, columns)
+    else:
+        results = itertools.imap(column_mad, columns)
+    try:
+        # apply the mad calculation column wise to data frame
+        for col in columns:
+            log.info('Parameter: ' + col)
+            with metrics.stage('mad ' + col, rows=len(df_exo_float),
+                               bursts=bursts):
+                exo_mad[col] = next(results)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
     exo_mad.replace(to_replace=null_value, value=np.nan, inplace=True)
 
     return exo_mad
 
 
-def write_output(log, output_dir, exo_filename, exo_mad):
+def calc_med_abs_dev_vectorized(log, df_exo_float, interval, mad_criteria,
+                                null_value, metrics=None, max_gap=None,
+                                threads=1, processes=1, scratch_dir=None):
+    """Batched equivalent of calc_med_abs_dev.  All bursts and parameters
+    are reduced at once by burpro_engine instead of a groupby apply per column
+    INPUT:
+    logger, float dataframe, burst interval in minutes, mad criteria,
+    null value, run metrics, largest gap within a burst in seconds or None
+    for interval bins, number of threads, number of processes and their
+    scratch directory
+    RETURNS:
+    pandas dataframe of MAD filtered burst medians"""
+    exo_mads, rejected, qa = calc_med_abs_dev_sweep(log, df_exo_float,
+                                                    interval, [mad_criteria],
+                                                    null_value, metrics,
+                                                    max_gap, threads,
+                                                    processes, scratch_dir)
+    return exo_mads[0]
+
+
+def calc_med_abs_dev_sweep(log, df_exo_float, interval, criteria,
+                           null_value, metrics=None, max_gap=None,
+                           threads=1, processes=1, scratch_dir=None):
+    """Apply several mad criteria in one pass.  The burst medians and median
+    absolute deviations are computed once and each criteria only selects a
+    different slice of the already sorted bursts.  With more than one
+    process, slices of bursts are reduced by burpro_shared worker processes
+    sharing a memory mapped copy of the data in scratch_dir
+    INPUT:
+    logger, float dataframe, burst interval in minutes, list of mad criteria,
+    null value, run metrics, largest gap within a burst in seconds or None
+    for interval bins, number of threads reducing parameters concurrently,
+    number of processes, scratch directory or None
+    RETURNS:
+    list of dataframes of MAD filtered burst medians, one per criteria
+    dataframe of the fraction of samples rejected by each criteria
+    list of (name, dataframe) burst QA statistics of the first criteria"""
+    columns = df_exo_float.columns
+    for col in columns:
+        log.info('Parameter: ' + col)
+    rejected_index = pd.Index(criteria, name='mad_criteria')
+    if df_exo_float.empty:
+        return ([pd.DataFrame(columns=columns) for _ in criteria],
+                pd.DataFrame(index=rejected_index, columns=columns),
+                [(name, pd.DataFrame(columns=columns))
+                 for name in QA_STATISTICS])
+    metrics = metrics or RunMetrics()
+    with metrics.stage('grouping', rows=len(df_exo_float)) as stage:
+        order, offsets, labels = burst_segments(df_exo_float.index, interval,
+                                                max_gap)
+        if processes <= 1:
+            packed, lengths = pack_bursts(df_exo_float.values, order,
+                                          offsets, missing=null_value)
+        stage['bursts'] = len(labels)
+    with metrics.stage('mad', rows=len(df_exo_float), bursts=len(labels)):
+        if processes > 1:
+            reduced = reduce_shared(df_exo_float.values, order, offsets,
+                                    criteria, null_value, processes,
+                                    scratch_dir, threads)
+        else:
+            reduced = reduce_parameters(packed, lengths, criteria, threads,
+                                        null_value)
+            del packed
+        full_index = full_interval_index(labels, interval,
+                                         df_exo_float.index.name)
+        # rejected fractions of the measured samples, as in the QA sheets
+        samples = reduced['samples'].sum(axis=0).astype(float)
+
+        exo_mads = []
+        rejected = []
+        for median, count in zip(reduced['medians'], reduced['rejected']):
+            exo_mad = pd.DataFrame(round_float32(median), index=labels,
+                                   columns=columns)
+            exo_mad = exo_mad.reindex(full_index)
+            exo_mad.replace(to_replace=null_value, value=np.nan, inplace=True)
+            exo_mads.append(exo_mad)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                rejected.append(count.sum(axis=0) / samples)
+
+    return (exo_mads, pd.DataFrame(rejected, index=rejected_index,
+                                   columns=columns),
+            qa_frames(reduced['qa'], labels, full_index, columns,
+                      null_value))
+
+
+def write_rejected_to_log_file(log, rejected):
+    for mad_criteria, fractions in rejected.iterrows():
+        for col in rejected.columns:
+            log.info("MAD criteria %s rejected %3.2f%% of %s samples",
+                     mad_criteria, fractions[col] * 100., col)
+
+
+def write_output(log, output_dir, exo_filename, exo_mad, formats=('xlsx',),
+                 extra_sheets=()):
+    log.info('Writing output...')
+    write_frames(output_base(output_dir, exo_filename),
+                 [('Sheet1', exo_mad)] + list(extra_sheets), formats)
+    return
+
+
+def write_despiked(log, output_dir, exo_filename, despiked,
+                   formats=('xlsx',)):
+    """Write the despiked record next to the burst medians, named with
+    _mad_despiked so that later directory runs do not take it for input.
+    A record too long for an Excel worksheet is written as csv instead"""
+    fitted = fit_formats(formats, len(despiked))
+    if fitted != list(formats):
+        log.info('Despiked record has %d rows, more than an Excel worksheet '
+                 'holds, writing it as %s', len(despiked), ', '.join(fitted))
+    log.info('Writing despiked record...')
+    write_frames(output_base(output_dir, exo_filename) + '_despiked',
+                 [('despiked', despiked)], fitted)
+
+
+def write_sweep_output(log, output_dir, exo_filename, exo_mads, criteria,
+                       rejected, formats=('xlsx',), extra_sheets=()):
+    """Write one workbook with a sheet of MAD filtered burst medians for each
+    criteria and a sheet of the fraction of samples each criteria rejected,
+    followed by any extra (sheet name, dataframe) sheets"""
     log.info('Writing output...')
-    input_path, input_name_only = os.path.split(exo_filename)
-    output_name_only = input_name_only.replace(".xlsx", "_mad.xlsx")
-    output_filename = os.path.join(output_dir, output_name_only)
-    exo_mad.to_excel(output_filename)
+    sheets = [(criteria_sheet_name(mad_criteria), exo_mad)
+              for mad_criteria, exo_mad in zip(criteria, exo_mads)]
+    sheets.append(('rejected', rejected))
+    sheets.extend(extra_sheets)
+    write_frames(output_base(output_dir, exo_filename), sheets, formats)
     return
 
 
-def custom_mad(array_like, criteria=2.5,):
+def criteria_sheet_name(mad_criteria):
+    return 'mad_' + str(float(mad_criteria))
+
+
+def custom_mad(array_like, criteria=2.5, null_value=None):
     # TODO: Add support for all NAN arrays
-    """Function to calculate the median absoilute deviation of an array
+    """Function to calculate the median absoilute deviation of an array.
+    Missing samples take part as null_value when it is given
     INPUT:
     array-like
     RETURNS:
     float"""
-    MAD = smc.mad(array_like)
+    if null_value is not None:
+        array_like = np.where(np.isnan(array_like), null_value, array_like)
+    MAD = median_abs_deviation(array_like)
     k = (MAD*criteria)
     M = np.nanmedian(array_like)
     high = M + k
@@ -441,9 +1085,12 @@ def extract_data_cols(frame, nrow):
 
 
 def count_min_n_bursts(count, min_burst_len=20):
-    stats = dict()
-    for col in count.columns:
-        counted = count[col]
-        stat = sum(counted > min_burst_len)/float(len(counted))*100.
-        stats[col] = stat
-    return stats
+    """Return the percentage of the bursts of each column holding more
+    than min_burst_len samples
+    INPUT:
+    pandas dataframe of burst lengths, int
+    RETURNS:
+    dict of percentages keyed by column"""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return ((count > min_burst_len).sum() /
+                float(len(count)) * 100.).to_dict()
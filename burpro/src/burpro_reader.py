@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""
+:DESCRIPTION: Streams rows of a KOR export workbook with openpyxl in
+              read-only mode so the sheet is never loaded as a whole
+              object dataframe.  Only the metadata block, the datetime
+              columns and the kept parameter columns are materialized.
+              A few rows, or the last row, of a sheet can be read straight
+              from the worksheet xml when the data is not needed.
+
+:REQUIRES: numpy, openpyxl >= 2.6
+
+:AUTHOR: John Franco Saraceno, John M. Donovan
+:ORGANIZATION: U.S. Geological Survey, United States Department of Interior
+:CONTACT: saraceno@usgs.gov, jmd@usgs.gov
+
+"""
+# =============================================================================
+# IMPORT STATEMENTS
+# =============================================================================
+from __future__ import print_function
+import codecs
+import re
+import zipfile
+from array import array
+from itertools import islice
+from xml.etree import cElementTree as ElementTree
+
+import numpy as np
+import openpyxl
+from openpyxl.utils import column_index_from_string
+from openpyxl.utils.datetime import (CALENDAR_MAC_1904, CALENDAR_WINDOWS_1900,
+                                     from_excel)
+
+ARRAY_TYPECODES = {'float64': 'd', 'float32': 'f'}
+MAIN_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+REL_NS = ('{http://schemas.openxmlformats.org/officeDocument/2006/'
+          'relationships}')
+PACKAGE_REL_NS = ('{http://schemas.openxmlformats.org/package/2006/'
+                  'relationships}')
+# bytes at the end of a worksheet searched for its last row
+TAIL_BYTES = 1 << 16
+ROW_RE = re.compile(r'<(?:\w+:)?row\b([^>]*?)(?:/>|>(.*?)</(?:\w+:)?row>)',
+                    re.S)
+CELL_RE = re.compile(r'<(?:\w+:)?c\b([^>]*?)(?:/>|>(.*?)</(?:\w+:)?c>)', re.S)
+ROW_NUMBER_RE = re.compile(r'\br="(\d+)"')
+CELL_ATTR_RE = re.compile(r'\b(r|t)="([^"]*)"')
+CELL_VALUE_RE = re.compile(r'<(?:\w+:)?[vt]\b[^>]*>(.*?)</', re.S)
+COLUMN_RE = re.compile(r'[A-Z]+')
+ENTITY_RE = re.compile(r'&(#x[0-9a-fA-F]+|#[0-9]+|amp|lt|gt|quot|apos);')
+XML_ENTITIES = {'amp': u'&', 'lt': u'<', 'gt': u'>', 'quot': u'"',
+                'apos': u"'"}
+
+
+def iter_sheet_rows(filename):
+    """Yield the cell values of each row of the first worksheet
+    INPUT:
+    .xlsx filename
+    RETURNS:
+    generator of tuples"""
+    workbook = openpyxl.load_workbook(filename, read_only=True,
+                                      data_only=True)
+    try:
+        sheet = workbook.worksheets[0]
+        # KOR does not always write the sheet dimensions correctly
+        sheet.reset_dimensions()
+        for row in sheet.iter_rows(values_only=True):
+            yield row
+    finally:
+        workbook.close()
+
+
+def read_header_block(rows, header_field):
+    """Consume rows up to and including the data header row, the first row
+    whose first cell is header_field
+    INPUT:
+    row iterator from iter_sheet_rows, header field name
+    RETURNS:
+    list of equal length lists, the header row last"""
+    block = []
+    for row in rows:
+        block.append(list(row))
+        if row and row[0] == header_field:
+            break
+    else:
+        raise ValueError('Header row "%s" not found' % header_field)
+    width = max(len(row) for row in block)
+    for row in block:
+        row.extend([None] * (width - len(row)))
+    return block
+
+
+def read_data_columns(rows, object_cols, float_cols, dtype=np.float64):
+    """Consume the remaining data rows, keeping only the requested columns.
+    Blank rows are skipped and blank cells become NaN
+    INPUT:
+    row iterator positioned after the header row
+    list of column positions to return as python objects
+    list of column positions to return as floats
+    float dtype, float64 or float32
+    RETURNS:
+    list of lists for object_cols, list of float arrays for float_cols"""
+    objects = [[] for _ in object_cols]
+    dtype = np.dtype(dtype)
+    floats = [array(ARRAY_TYPECODES[dtype.name]) for _ in float_cols]
+    nan = float('nan')
+    for row in rows:
+        if not any(value is not None for value in row):
+            continue
+        width = len(row)
+        for values, col in zip(objects, object_cols):
+            values.append(row[col] if col < width else None)
+        for values, col in zip(floats, float_cols):
+            value = row[col] if col < width else None
+            values.append(nan if value is None else float(value))
+    return objects, [np.frombuffer(values, dtype=dtype)
+                     if len(values) else np.array([], dtype=dtype)
+                     for values in floats]
+
+
+def iter_data_chunks(rows, object_cols, float_cols, chunk_rows,
+                     dtype=np.float64):
+    """Read the remaining data rows chunk_rows at a time, as read_data_columns
+    does for the whole sheet.  Chunks of only blank rows are skipped
+    INPUT:
+    row iterator positioned after the header row
+    list of column positions to return as python objects
+    list of column positions to return as floats
+    rows per chunk, float dtype
+    RETURNS:
+    generator of read_data_columns results"""
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_rows))
+        if not chunk:
+            return
+        objects, floats = read_data_columns(chunk, object_cols, float_cols,
+                                            dtype)
+        if objects and objects[0]:
+            yield objects, floats
+
+
+
+class SheetXml(object):
+    """Reads rows of the first worksheet of a workbook straight from its xml,
+    for when only a few rows are needed.  openpyxl's read only mode parses a
+    sheet without a dimension element twice and the last row of a sheet can
+    be found from the end of its xml without parsing the rows before it.
+    Cells are typed as openpyxl types them, except that date formatted
+    numbers stay numbers, to_datetime converts them"""
+
+    def __init__(self, filename):
+        self.archive = zipfile.ZipFile(filename)
+        workbook = ElementTree.fromstring(self.archive.read('xl/workbook.xml'))
+        properties = workbook.find(MAIN_NS + 'workbookPr')
+        self.offset = CALENDAR_WINDOWS_1900
+        if properties is not None and \
+                properties.get('date1904') in ('1', 'true'):
+            self.offset = CALENDAR_MAC_1904
+        self.sheet_path = first_sheet_path(self.archive, workbook)
+        self.shared_strings = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.archive.close()
+
+    def rows(self):
+        """Yield the cell values of each row as a tuple, an empty tuple for
+        each row missing from the xml"""
+        sheet = self.archive.open(self.sheet_path)
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        try:
+            text = u''
+            number = 0
+            for block in iter(lambda: sheet.read(1 << 16), b''):
+                text += decoder.decode(block)
+                end = 0
+                for match in ROW_RE.finditer(text):
+                    row_number, values = self.row_values(match)
+                    for _ in range(number + 1, row_number or number + 1):
+                        yield ()
+                    number = row_number or number + 1
+                    yield values
+                    end = match.end()
+                text = text[end:]
+        finally:
+            sheet.close()
+
+    def last_row(self, col):
+        """Return the cell values of the last row with a value in column
+        position col, None if there is none.  The sheet is decompressed but
+        only its last TAIL_BYTES are kept and parsed"""
+        sheet = self.archive.open(self.sheet_path)
+        try:
+            tail = b''
+            for block in iter(lambda: sheet.read(1 << 20), b''):
+                tail = (tail + block)[-TAIL_BYTES:]
+        finally:
+            sheet.close()
+        for match in reversed(list(ROW_RE.finditer(
+                tail.decode('utf-8', 'ignore')))):
+            values = self.row_values(match)[1]
+            if len(values) > col and values[col] is not None:
+                return values
+        return None
+
+    def row_values(self, match):
+        """Return the row number, or None, and the cell values of a ROW_RE
+        match"""
+        row_number = ROW_NUMBER_RE.search(match.group(1))
+        row_number = int(row_number.group(1)) if row_number else None
+        cells = {}
+        for position, (attrs, content) in enumerate(
+                CELL_RE.findall(match.group(2) or u'')):
+            attrs = dict(CELL_ATTR_RE.findall(attrs))
+            if 'r' in attrs:
+                position = column_index_from_string(
+                               COLUMN_RE.match(attrs['r']).group()) - 1
+            value = CELL_VALUE_RE.search(content)
+            if value is not None:
+                cells[position] = self.cell_value(attrs.get('t', 'n'),
+                                                  xml_unescape(
+                                                      value.group(1)))
+        values = [None] * (max(cells) + 1 if cells else 0)
+        for position, value in cells.items():
+            values[position] = value
+        return row_number, tuple(values)
+
+    def cell_value(self, kind, value):
+        if kind == 'n':
+            if '.' in value or 'E' in value or 'e' in value:
+                return float(value)
+            return int(value)
+        if kind == 's':
+            if self.shared_strings is None:
+                self.shared_strings = read_shared_strings(self.archive)
+            return self.shared_strings[int(value)]
+        if kind == 'b':
+            return value == '1'
+        return value
+
+    def to_datetime(self, value):
+        """Convert an Excel date number to a datetime, or time below one
+        day, as openpyxl does for date formatted cells"""
+        if isinstance(value, (int, float)):
+            return from_excel(value, self.offset)
+        return value
+
+
+def xml_unescape(text):
+    """Replace the entity and character references of xml text"""
+    def replace(match):
+        name = match.group(1)
+        if name.startswith('#x'):
+            return unichr(int(name[2:], 16))
+        if name.startswith('#'):
+            return unichr(int(name[1:]))
+        return XML_ENTITIES[name]
+    return ENTITY_RE.sub(replace, text)
+
+
+def first_sheet_path(archive, workbook):
+    """Return the archive path of the first worksheet of a workbook"""
+    rel_id = workbook.find(MAIN_NS + 'sheets').find(MAIN_NS + 'sheet').get(
+                 REL_NS + 'id')
+    rels = ElementTree.fromstring(archive.read('xl/_rels/workbook.xml.rels'))
+    for rel in rels.iter(PACKAGE_REL_NS + 'Relationship'):
+        if rel.get('Id') == rel_id:
+            target = rel.get('Target')
+            if target.startswith('/'):
+                return target[1:]
+            return 'xl/' + target
+    raise ValueError('First worksheet not found')
+
+
+def read_shared_strings(archive):
+    """Return the shared strings table of a workbook as a list"""
+    if 'xl/sharedStrings.xml' not in archive.namelist():
+        return []
+    strings = []
+    source = archive.open('xl/sharedStrings.xml')
+    try:
+        for _, element in ElementTree.iterparse(source):
+            if element.tag == MAIN_NS + 'si':
+                strings.append(u''.join(text.text or u'' for text in
+                                        element.iter(MAIN_NS + 't')))
+                element.clear()
+    finally:
+        source.close()
+    return strings
@@ -21,18 +21,17 @@ import os
 import os.path
 import logging
 import json
-import validictory
 
-from burpro_process import process
 
-
-def manage_run(exo_filename, output_dir):
+def manage_run(exo_filename, output_dir, merge_files=None):
 
     log = logging.getLogger('BurPro')
     log.info('Reading configuration...')
 
     run_params = read_json_params()
-    process(exo_filename, output_dir, run_params)
+    # imported here so that reading run parameters does not load pandas
+    from burpro_process import process
+    process(exo_filename, output_dir, run_params, merge_files)
 
 
 def read_json_params():
@@ -70,10 +69,106 @@ def schema_json():
                 "required": True
             },
             "mad_criteria": {
-                "type": "number",
+                "type": ["number", "array"],
                 "required": False,
                 "minimum": 2,
                 "maximum": 3,
+                "items": {
+                    "type": "number",
+                    "minimum": 2,
+                    "maximum": 3
+                }
+            },
+            "mad_engine": {
+                "type": "string",
+                "required": False,
+                "enum": ["vectorized", "groupby"]
+            },
+            "excel_reader": {
+                "type": "string",
+                "required": False,
+                "enum": ["streaming", "pandas"]
+            },
+            "pipeline": {
+                "type": "string",
+                "required": False,
+                "enum": ["batch", "streaming"]
+            },
+            "segmentation": {
+                "type": "string",
+                "required": False,
+                "enum": ["interval", "gaps"]
+            },
+            "burst_gap_sec": {
+                "type": "number",
+                "required": False,
+                "minimum": 0
+            },
+            "mad_threads": {
+                "type": "integer",
+                "required": False,
+                "minimum": 1
+            },
+            "mad_processes": {
+                "type": "integer",
+                "required": False,
+                "minimum": 1
+            },
+            "scratch_dir": {
+                "type": "string",
+                "required": False
+            },
+            "qa_sheets": {
+                "type": "boolean",
+                "required": False
+            },
+            "float_dtype": {
+                "type": "string",
+                "required": False,
+                "enum": ["float64", "float32"]
+            },
+            "chunk_rows": {
+                "type": "integer",
+                "required": False,
+                "minimum": 1
+            },
+            "output_formats": {
+                "type": "array",
+                "required": False,
+                "items": {
+                    "type": "string",
+                    "enum": ["xlsx", "csv", "parquet"]
+                }
+            },
+            "parse_cache": {
+                "type": "boolean",
+                "required": False
+            },
+            "cache_dir": {
+                "type": "string",
+                "required": False
+            },
+            "incremental": {
+                "type": "boolean",
+                "required": False
+            },
+            "state_dir": {
+                "type": "string",
+                "required": False
+            },
+            "despike_window": {
+                "type": "integer",
+                "required": False,
+                "minimum": 0
+            },
+            "results_db": {
+                "type": "string",
+                "required": False
+            },
+            "cache_size_mb": {
+                "type": "number",
+                "required": False,
+                "minimum": 0
             },
             "interval": {
                 "type": "integer",
@@ -18,7 +18,6 @@ from __future__ import print_function
 import argparse
 import datetime
 import getpass
-from itertools import chain
 import logging
 import os
 import os.path
@@ -32,16 +31,17 @@ class BurProArgumentParser(argparse.ArgumentParser):
         raise Exception(message)
 
 
-def setup_logger(logger_name, log_file, level=logging.INFO):
+def setup_logger(logger_name, log_file, level=logging.INFO, console=True):
     l = logging.getLogger(logger_name)
     formatter = logging.Formatter('%(asctime)s : %(message)s')
     fileHandler = logging.FileHandler(log_file, mode='w')
     fileHandler.setFormatter(formatter)
-    streamHandler = logging.StreamHandler()
-    streamHandler.setFormatter(formatter)
     l.setLevel(level)
     l.addHandler(fileHandler)
-    l.addHandler(streamHandler)
+    if console:
+        streamHandler = logging.StreamHandler()
+        streamHandler.setFormatter(formatter)
+        l.addHandler(streamHandler)
 
 
 def takedown_logger(logger_name):
@@ -60,21 +60,75 @@ def report_setup_error(error):
 def handle_args(version, argv=None):
     if argv is None:
         argv = sys.argv
-    if len(sys.argv) < 2:
+    if len(argv) < 2:
         raise Exception('BurPro must be given an input file for processing')
     print('USGS California Water Science Center')
     print('BurPro Revision', version, sep=' ')
     print('Reading run parameters...')
     parser = BurProArgumentParser(
              description="KOR exo file")
-    parser.add_argument('nargs', nargs='+')
-
-    args = []
-    for _, value in parser.parse_args()._get_kwargs():
-        if value is not None:
-            args.append(value)
-#    print(args)
-    args = list(chain.from_iterable(args))
+    parser.add_argument('nargs', nargs='*')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of files to process in parallel')
+    parser.add_argument('--clear-cache', action='store_true',
+                        help='remove all cached input data')
+    parser.add_argument('--startup-profile', action='store_true',
+                        help='report the time taken by startup and imports')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running and process new files that '
+                             'appear in the given directories')
+    parser.add_argument('--inspect', action='store_true',
+                        help='print the device table and first and last '
+                             'timestamps of each file without processing '
+                             'it')
+    parser.add_argument('--inspect-dir',
+                        help='with --inspect, write each file\'s '
+                             '_EXOdevices.json to this directory instead')
+    parser.add_argument('--force', action='store_true',
+                        help='process every file of a directory, including '
+                             'files the manifest lists as processed')
+    parser.add_argument('--merge', action='store_true',
+                        help='merge overlapping exports of one site and '
+                             'process them as a single record')
+    parser.add_argument('--status-file',
+                        help='watch status file, by default '
+                             'BurPro_watch_status.json in the first '
+                             'watched directory')
+
+    options = parser.parse_args(argv[1:])
+    # directory runs keep a manifest of the files processed
+    options.archive_dir = None
+    if options.jobs < 1:
+        raise Exception('--jobs must be at least 1')
+    args = options.nargs
+    if not args:
+        if options.clear_cache or options.startup_profile:
+            return [], options
+        raise Exception('BurPro must be given an input file for processing')
+    if options.watch:
+        missing = [arg for arg in args if not os.path.isdir(arg)]
+        if missing:
+            raise Exception('--watch needs existing directories, not: ' +
+                            ', '.join(missing))
+        return args, options
+    if options.inspect:
+        files = []
+        for arg in args:
+            if os.path.isdir(arg):
+                files.extend(find_kor_files(arg))
+            else:
+                files.append(arg)
+        return files, options
+    if options.merge:
+        files = []
+        for arg in args:
+            if os.path.isdir(arg):
+                files.extend(sorted(find_kor_files(arg)))
+            else:
+                files.append(arg)
+        if len(files) < 2:
+            raise Exception('--merge needs at least two input files')
+        return files, options
     for arg in args:
         list_of_args = arg.split(' ')
 
@@ -84,11 +138,12 @@ def handle_args(version, argv=None):
         if os.path.isdir(list_of_args[0]):  # its a directory
             direc = list_of_args[0]
             lof = find_kor_files(direc)
+            options.archive_dir = direc
         else:  # its a file or list of files
             lof = list_of_args
     else:  # its a file or its multiple files or multiple directories or a combo!
         lof = list_of_args
-    return lof
+    return lof, options
 
 #def handle_args(version, argv=None):
 #    if argv is None:
@@ -131,6 +186,17 @@ def setup_output_dir(exo_filename):
     base_path = os.path.dirname(exo_filename)
     output_dir = os.path.join(base_path, dir_name)
     # print('Writing output to', output_dir, sep=' ')
-    os.makedirs(output_dir)
-
-    return output_dir
+    # files in one directory started in the same second each get their own
+    # output directory, including files processed in parallel
+    suffix = 0
+    while True:
+        try:
+            os.makedirs(output_dir)
+        except OSError:
+            if not os.path.isdir(output_dir):
+                raise
+            suffix += 1
+            output_dir = os.path.join(base_path,
+                                      dir_name + '_' + str(suffix))
+        else:
+            return output_dir
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+:DESCRIPTION: Multi-process burst reduction over a shared scratch array.
+              The cleaned samples, in burst order, and the burst offsets are
+              written once to memory mapped .npy files.  Worker processes
+              map the files read only, so the operating system shares one
+              copy of the data between them, and each worker packs and
+              reduces a slice of bursts at a time.  A scratch directory on a
+              tmpfs such as /dev/shm keeps the files in POSIX shared memory.
+
+:REQUIRES: burpro_engine.py
+
+:AUTHOR: John Franco Saraceno, John M. Donovan
+:ORGANIZATION: U.S. Geological Survey, United States Department of Interior
+:CONTACT: saraceno@usgs.gov, jmd@usgs.gov
+
+"""
+# =============================================================================
+# IMPORT STATEMENTS
+# =============================================================================
+from __future__ import print_function
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from burpro_engine import join_reduced, pack_bursts, reduce_parameters
+
+# bursts packed and reduced at a time by a worker
+SLICE_BURSTS = 512
+
+
+def burst_slices(n_bursts, processes, slice_bursts=SLICE_BURSTS):
+    """Split bursts into contiguous slices of at most slice_bursts bursts,
+    and at least one slice per process
+    RETURNS:
+    list of (first burst, last burst + 1)"""
+    n_slices = max(processes, -(-n_bursts // slice_bursts))
+    edges = np.linspace(0, n_bursts, min(n_slices, n_bursts) + 1)
+    edges = edges.astype(int).tolist()
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def write_scratch(scratch_dir, values, order, offsets, missing=None):
+    """Write values in burst order and the burst offsets to memory mapped
+    .npy files without another in memory copy of values
+    RETURNS:
+    filenames of the ordered values and of the offsets"""
+    values_file = os.path.join(scratch_dir, 'ordered.npy')
+    offsets_file = os.path.join(scratch_dir, 'offsets.npy')
+    values = np.asarray(values)
+    if values.dtype.kind != 'f':
+        values = values.astype(np.float64)
+    ordered = np.lib.format.open_memmap(values_file, mode='w+',
+                                        dtype=values.dtype,
+                                        shape=(len(order), values.shape[1]))
+    np.take(values, order, axis=0, out=ordered, mode='clip')
+    if missing is not None:
+        ordered[np.isnan(ordered)] = missing
+    ordered.flush()
+    del ordered
+    np.save(offsets_file, np.asarray(offsets))
+    return values_file, offsets_file
+
+
+def reduce_slice(task):
+    """Process pool entry point.  Maps the scratch files and reduces the
+    bursts first to last - 1
+    RETURNS:
+    dict as returned by burpro_engine.reduce_block"""
+    values_file, offsets_file, first, last, criteria, threads, missing = task
+    offsets = np.load(offsets_file)[first:last + 1]
+    ordered = np.load(values_file, mmap_mode='r')
+    values = ordered[offsets[0]:offsets[-1]]
+    packed, lengths = pack_bursts(values, np.arange(len(values)),
+                                  offsets - offsets[0])
+    del values, ordered
+    return reduce_parameters(packed, lengths, criteria, threads, missing)
+
+
+def reduce_shared(values, order, offsets, criteria, missing, processes,
+                  scratch_dir=None, threads=1):
+    """Equivalent of pack_bursts followed by reduce_parameters, with the
+    bursts reduced by processes worker processes sharing one memory mapped
+    copy of values.  Bursts are independent, so the results do not depend on
+    the number of processes
+    INPUT:
+    2d float array, order and offsets as returned by burst_segments, list of
+    criteria, value of missing samples or None, number of processes,
+    directory of the scratch files or None for the system temporary
+    directory, number of threads of each process
+    RETURNS:
+    dict as returned by burpro_engine.reduce_block"""
+    if multiprocessing.current_process().daemon:
+        # a worker of a batch or watch pool cannot start processes of its
+        # own, reduce in this process instead
+        packed, lengths = pack_bursts(values, order, offsets, missing)
+        return reduce_parameters(packed, lengths, criteria, threads, missing)
+    work_dir = tempfile.mkdtemp(prefix='burpro_', dir=scratch_dir or None)
+    try:
+        values_file, offsets_file = write_scratch(work_dir, values, order,
+                                                  offsets, missing)
+        tasks = [(values_file, offsets_file, first, last, criteria, threads,
+                  missing)
+                 for first, last in burst_slices(len(offsets) - 1,
+                                                 processes)]
+        pool = multiprocessing.Pool(processes=min(processes, len(tasks)))
+        try:
+            parts = pool.map(reduce_slice, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return join_reduced(parts, axis=0)
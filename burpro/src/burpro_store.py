@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+:DESCRIPTION: Optional SQLite store of BurPro results across deployments.
+              Each run adds its MAD filtered burst medians and device table
+              to one local database, keyed by site, parameter and
+              timestamp, so that a parameter at a site can be read back for
+              any time range without opening the output workbooks.  A site
+              is the Site Name of the export, or the sonde serial number
+              when the export has none.  Later runs replace the medians of
+              the same site, parameter and timestamp.
+
+:REQUIRES: sqlite3, burpro_incremental.py, burpro_inspect.py
+
+:USAGE: python burpro_store.py DATABASE --list
+        python burpro_store.py DATABASE SITE [-p PARAMETER ...]
+                               [--start DATE] [--end DATE] [--csv FILE]
+
+:AUTHOR: John Franco Saraceno, John M. Donovan
+:ORGANIZATION: U.S. Geological Survey, United States Department of Interior
+:CONTACT: saraceno@usgs.gov, jmd@usgs.gov
+
+"""
+# =============================================================================
+# IMPORT STATEMENTS
+# =============================================================================
+from __future__ import print_function
+import argparse
+import datetime
+import json
+import os
+import sqlite3
+import sys
+
+import numpy as np
+import pandas as pd
+
+from burpro_engine import NS_PER_SECOND
+from burpro_incremental import sonde_serial
+from burpro_inspect import read_site_name
+
+# medians written per executemany call
+BATCH_ROWS = 50000
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS sites (
+           site_id INTEGER PRIMARY KEY,
+           name TEXT UNIQUE NOT NULL)''',
+    '''CREATE TABLE IF NOT EXISTS parameters (
+           parameter_id INTEGER PRIMARY KEY,
+           name TEXT UNIQUE NOT NULL)''',
+    '''CREATE TABLE IF NOT EXISTS runs (
+           run_id INTEGER PRIMARY KEY,
+           site_id INTEGER NOT NULL REFERENCES sites,
+           file TEXT NOT NULL,
+           output_dir TEXT,
+           processed TEXT NOT NULL,
+           mad_criteria REAL,
+           first INTEGER,
+           last INTEGER,
+           devices TEXT)''',
+    # the primary key is the (site, parameter, timestamp) index
+    '''CREATE TABLE IF NOT EXISTS medians (
+           site_id INTEGER NOT NULL,
+           parameter_id INTEGER NOT NULL,
+           timestamp INTEGER NOT NULL,
+           value REAL NOT NULL,
+           run_id INTEGER NOT NULL,
+           PRIMARY KEY (site_id, parameter_id, timestamp)) WITHOUT ROWID''']
+
+
+def connect(db_path):
+    """Open a results database, creating its tables when they are missing"""
+    conn = sqlite3.connect(db_path)
+    for statement in SCHEMA:
+        conn.execute(statement)
+    conn.commit()
+    return conn
+
+
+def name_id(conn, table, id_col, name):
+    """Return the id of a site or parameter name, adding it when new"""
+    conn.execute('INSERT OR IGNORE INTO %s (name) VALUES (?)' % table,
+                 (name,))
+    return conn.execute('SELECT %s FROM %s WHERE name = ?' % (id_col, table),
+                        (name,)).fetchone()[0]
+
+
+def run_site(exo_filename, devices, drop_cols):
+    """Return the site of an export, its Site Name or else the sonde serial
+    number"""
+    site = None
+    if os.path.isfile(exo_filename) and drop_cols:
+        site = read_site_name(exo_filename, drop_cols)
+    return site or unicode(sonde_serial(devices))
+
+
+def median_rows(exo_mad, site_id, parameter_ids, run_id):
+    """Generate a (site, parameter, timestamp, value, run) row for every
+    non missing burst median.  Timestamps are seconds since 1970 of the
+    naive burst times"""
+    seconds = exo_mad.index.asi8 // NS_PER_SECOND
+    values = exo_mad.values
+    for col, parameter_id in enumerate(parameter_ids):
+        kept = ~np.isnan(values[:, col])
+        for timestamp, value in zip(seconds[kept].tolist(),
+                                    values[kept, col].tolist()):
+            yield site_id, parameter_id, timestamp, value, run_id
+
+
+def store_run(db_path, exo_filename, output_dir, exo_mad, devices,
+              mad_criteria, drop_cols):
+    """Add the burst medians and device table of a run to the database, in
+    one transaction written BATCH_ROWS rows at a time
+    INPUT:
+    database filename, input .xlsx filename, output directory, dataframe of
+    MAD filtered burst medians, device table as written to _EXOdevices.json,
+    mad criteria, list of columns to drop
+    RETURNS:
+    site name, number of medians stored"""
+    site = run_site(exo_filename, devices, drop_cols)
+    conn = connect(db_path)
+    try:
+        with conn:
+            site_id = name_id(conn, 'sites', 'site_id', site)
+            parameter_ids = [name_id(conn, 'parameters', 'parameter_id',
+                                     unicode(col))
+                             for col in exo_mad.columns]
+            bounds = [None, None]
+            if len(exo_mad):
+                bounds = [int(exo_mad.index[0].value // NS_PER_SECOND),
+                          int(exo_mad.index[-1].value // NS_PER_SECOND)]
+            run_id = conn.execute(
+                'INSERT INTO runs (site_id, file, output_dir, processed, '
+                'mad_criteria, first, last, devices) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [site_id, os.path.basename(exo_filename), output_dir,
+                 datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+                 mad_criteria] + bounds +
+                [json.dumps(devices, sort_keys=True)]).lastrowid
+            stored = 0
+            batch = []
+            for row in median_rows(exo_mad, site_id, parameter_ids, run_id):
+                batch.append(row)
+                if len(batch) == BATCH_ROWS:
+                    stored += insert_medians(conn, batch)
+                    batch = []
+            stored += insert_medians(conn, batch)
+    finally:
+        conn.close()
+    return site, stored
+
+
+def insert_medians(conn, rows):
+    conn.executemany('INSERT OR REPLACE INTO medians '
+                     'VALUES (?, ?, ?, ?, ?)', rows)
+    return len(rows)
+
+
+def to_seconds(value):
+    if value is None:
+        return None
+    return pd.Timestamp(value).value // NS_PER_SECOND
+
+
+def query(db_path, site, parameters=None, start=None, end=None):
+    """Read the burst medians of a site between start and end, inclusive
+    INPUT:
+    database filename, site name, list of parameter names or None for all,
+    first and last timestamps as anything pd.Timestamp accepts, or None
+    RETURNS:
+    pandas dataframe of burst medians indexed by timestamp, a column per
+    parameter"""
+    sql = ('SELECT m.timestamp, p.name, m.value FROM medians m '
+           'JOIN sites s ON s.site_id = m.site_id '
+           'JOIN parameters p ON p.parameter_id = m.parameter_id '
+           'WHERE s.name = ?')
+    args = [site]
+    if parameters:
+        sql += ' AND p.name IN (%s)' % ', '.join('?' * len(parameters))
+        args.extend(parameters)
+    if start is not None:
+        sql += ' AND m.timestamp >= ?'
+        args.append(to_seconds(start))
+    if end is not None:
+        sql += ' AND m.timestamp <= ?'
+        args.append(to_seconds(end))
+    conn = connect(db_path)
+    try:
+        rows = conn.execute(sql, args).fetchall()
+    finally:
+        conn.close()
+    columns = list(parameters or [])
+    if not rows:
+        return pd.DataFrame(columns=columns,
+                            index=pd.DatetimeIndex([], name='timestamp'))
+    seconds, names, values = zip(*rows)
+    frame = pd.DataFrame({'timestamp': pd.to_datetime(seconds, unit='s'),
+                          'parameter': names, 'value': values})
+    frame = frame.pivot(index='timestamp', columns='parameter',
+                        values='value')
+    frame.columns.name = None
+    if columns:
+        frame = frame.reindex(columns=columns)
+    return frame
+
+
+def list_sites(db_path):
+    """Return a dataframe of each site and parameter with its number of
+    medians and first and last timestamps"""
+    conn = connect(db_path)
+    try:
+        rows = conn.execute(
+            'SELECT s.name, p.name, COUNT(*), MIN(m.timestamp), '
+            'MAX(m.timestamp) FROM medians m '
+            'JOIN sites s ON s.site_id = m.site_id '
+            'JOIN parameters p ON p.parameter_id = m.parameter_id '
+            'GROUP BY m.site_id, m.parameter_id '
+            'ORDER BY s.name, p.name').fetchall()
+    finally:
+        conn.close()
+    frame = pd.DataFrame(rows, columns=['site', 'parameter', 'medians',
+                                        'first', 'last'])
+    for col in ['first', 'last']:
+        frame[col] = pd.to_datetime(frame[col], unit='s')
+    return frame
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Query the BurPro results database')
+    parser.add_argument('database')
+    parser.add_argument('site', nargs='?')
+    parser.add_argument('-p', '--parameter', action='append',
+                        help='parameter to read, all when not given')
+    parser.add_argument('--start', help='first timestamp, e.g. 2016-01-01')
+    parser.add_argument('--end', help='last timestamp')
+    parser.add_argument('--csv', help='write the results to this file')
+    parser.add_argument('--list', action='store_true',
+                        help='list the sites and parameters stored')
+    options = parser.parse_args(argv)
+    if not os.path.isfile(options.database):
+        parser.error('no database ' + options.database)
+    if options.list or options.site is None:
+        frame = list_sites(options.database)
+    else:
+        frame = query(options.database, options.site.decode('utf-8'),
+                      [p.decode('utf-8') for p in options.parameter or []],
+                      options.start, options.end)
+    if options.csv:
+        frame.to_csv(options.csv, encoding='utf-8')
+    else:
+        print(frame.to_string().encode('utf-8'))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+:DESCRIPTION: Bounded memory burst pipeline.  Chunks of rows flow through
+              generators that apply the SpCond cutoff and assemble
+              bursts.  Completed bursts are reduced a block at a
+              time with burpro_engine and then discarded, so peak memory
+              depends on the burst and chunk sizes rather than on the length
+              of the deployment.  Rows must arrive in time order, as KOR
+              exports them.
+
+:REQUIRES: burpro_engine.py
+
+:AUTHOR: John Franco Saraceno, John M. Donovan
+:ORGANIZATION: U.S. Geological Survey, United States Department of Interior
+:CONTACT: saraceno@usgs.gov, jmd@usgs.gov
+
+"""
+# =============================================================================
+# IMPORT STATEMENTS
+# =============================================================================
+from __future__ import print_function
+
+import numpy as np
+import pandas as pd
+
+from burpro_engine import (NS_PER_MINUTE, QA_STATISTICS,
+                           full_interval_index, pack_bursts, qa_frames,
+                           reduce_parameters, round_float32)
+
+# completed bursts reduced together
+BLOCK_BURSTS = 512
+
+
+class RecordSummary(object):
+    """First and last timestamps, number of rows and number of burst
+    intervals of a record, updated a chunk at a time.  Burst intervals use
+    the bin edges of pd.TimeGrouper, anchored at midnight of the first day"""
+
+    def __init__(self, interval):
+        self.freq = int(interval) * NS_PER_MINUTE
+        self.origin = None
+        self.first = None
+        self.last = None
+        self.rows = 0
+        self.first_bin = None
+        self.last_bin = None
+
+    def update(self, index):
+        """Add the timestamps of a chunk and return their burst codes"""
+        if self.origin is None:
+            self.origin = index[0].normalize().value
+            self.first = index[0]
+        codes = (index.asi8 - self.origin) // self.freq
+        low, high = codes.min(), codes.max()
+        if self.first_bin is None or low < self.first_bin:
+            self.first_bin = low
+        if self.last_bin is None or high > self.last_bin:
+            self.last_bin = high
+        self.last = index[-1]
+        self.rows += len(index)
+        return codes
+
+    def label(self, code):
+        return pd.Timestamp(self.origin + code * self.freq)
+
+    def as_dict(self):
+        bursts = 0
+        if self.rows:
+            bursts = int(self.last_bin - self.first_bin) + 1
+        return {'first': self.first, 'last': self.last, 'rows': self.rows,
+                'bursts': bursts}
+
+
+def cut_chunks(chunks, sc_col, sc_cutoff, summary):
+    """Drop rows at or below the SpCond cutoff, recording the uncut record
+    in summary.  Without an SpCond column every row is cut, as in batch
+    mode"""
+    for chunk in chunks:
+        summary.update(chunk.index)
+        if sc_col in chunk.columns:
+            yield chunk[chunk[sc_col].values > sc_cutoff]
+
+
+def iter_bursts(chunks, summary):
+    """Assemble rows into bursts, recording the record in summary
+    RETURNS:
+    generator of (burst code, 2d float array) for each non-empty burst
+    interval, once the interval is complete"""
+    open_code = None
+    parts = []
+    for chunk in chunks:
+        if chunk.empty:
+            continue
+        codes = summary.update(chunk.index)
+        if ((open_code is not None and codes[0] < open_code) or
+                (np.diff(codes) < 0).any()):
+            raise ValueError('The streaming pipeline needs rows in time '
+                             'order, use the batch pipeline for this file')
+        starts = np.flatnonzero(np.diff(codes)) + 1
+        for part_codes, part in zip(np.split(codes, starts),
+                                    np.split(chunk.values, starts)):
+            if open_code is not None and part_codes[0] != open_code:
+                yield open_code, np.concatenate(parts)
+                parts = []
+            open_code = part_codes[0]
+            parts.append(part)
+    if parts:
+        yield open_code, np.concatenate(parts)
+
+
+def iter_burst_blocks(bursts, block_bursts=BLOCK_BURSTS):
+    block = []
+    for burst in bursts:
+        block.append(burst)
+        if len(block) == block_bursts:
+            yield block
+            block = []
+    if block:
+        yield block
+
+
+class BurstReducer(object):
+    """Applies each MAD criteria to blocks of bursts, keeping only one row of
+    results per burst, and the burst QA statistics of the first criteria
+    when qa is set.  Parameters are reduced on threads threads"""
+
+    def __init__(self, criteria, n_columns, min_burst_len, null_value,
+                 qa=False, threads=1):
+        self.criteria = criteria
+        self.threads = threads
+        self.min_burst_len = min_burst_len
+        self.null_value = null_value
+        self.codes = []
+        self.medians = [[] for _ in criteria]
+        self.qa = [] if qa else None
+        self.rejected = np.zeros((len(criteria), n_columns), dtype=int)
+        # measured samples, missing samples left out
+        self.samples = np.zeros(n_columns, dtype=int)
+        self.complete = np.zeros(n_columns, dtype=int)
+
+    def reduce(self, block):
+        lengths = [len(values) for _, values in block]
+        values = np.concatenate([values for _, values in block])
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        packed, lengths = pack_bursts(values, np.arange(len(values)),
+                                      offsets, missing=self.null_value)
+        reduced = reduce_parameters(packed, lengths, self.criteria,
+                                    self.threads, self.null_value)
+        del packed
+        self.samples += reduced['samples'].sum(axis=0)
+        self.complete += (reduced['n_valid'] >
+                          self.min_burst_len).sum(axis=0)
+        for i, (median, count) in enumerate(zip(reduced['medians'],
+                                                reduced['rejected'])):
+            self.medians[i].append(round_float32(median))
+            self.rejected[i] += count.sum(axis=0)
+        if self.qa is not None:
+            self.qa.append(reduced['qa'])
+        self.codes.extend(code for code, _ in block)
+
+    def results(self, summary, interval, index_name, columns, null_value):
+        """Return the dataframes calc_med_abs_dev_sweep returns, the QA
+        statistics being None unless qa was set"""
+        rejected_index = pd.Index(self.criteria, name='mad_criteria')
+        qa = None
+        if not self.codes:
+            if self.qa is not None:
+                qa = [(name, pd.DataFrame(columns=columns))
+                      for name in QA_STATISTICS]
+            return ([pd.DataFrame(columns=columns) for _ in self.criteria],
+                    pd.DataFrame(index=rejected_index, columns=columns), qa)
+        labels = pd.DatetimeIndex([summary.label(code)
+                                   for code in self.codes])
+        full_index = full_interval_index(labels, interval, index_name)
+        exo_mads = []
+        for medians in self.medians:
+            exo_mad = pd.DataFrame(np.vstack(medians), index=labels,
+                                   columns=columns)
+            exo_mad = exo_mad.reindex(full_index)
+            exo_mad.replace(to_replace=null_value, value=np.nan, inplace=True)
+            exo_mads.append(exo_mad)
+        if self.qa is not None:
+            qa = qa_frames(dict((name, np.vstack([block[name]
+                                                  for block in self.qa]))
+                                for name in QA_STATISTICS),
+                           labels, full_index, columns, null_value)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            rejected = self.rejected / self.samples.astype(float)
+        return (exo_mads, pd.DataFrame(rejected, index=rejected_index,
+                                       columns=columns), qa)
+
+    def burst_completion(self, summary, columns):
+        """Return the percentage of burst intervals of each column holding
+        more than min_burst_len samples, as count_min_n_bursts does"""
+        bursts = float(summary.as_dict()['bursts'])
+        return dict((col, complete / bursts * 100.)
+                    for col, complete in zip(columns, self.complete))
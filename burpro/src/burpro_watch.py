@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+:DESCRIPTION: Long running watch folder service.  BurPro stays warm, polls
+              one or more directories for new KOR-EXO .xlsx files (the same
+              files find_kor_files picks up), waits until each file is fully
+              written and processes it in a pool of worker processes.  The
+              queued, running and finished jobs are kept in a small json
+              status file.
+
+:REQUIRES: burpro_batch.py, burpro_setup.py
+
+:USAGE: python burpro.py --watch DIRECTORY [DIRECTORY ...] --jobs 2
+
+:AUTHOR: John Franco Saraceno, John M. Donovan
+:ORGANIZATION: U.S. Geological Survey, United States Department of Interior
+:CONTACT: saraceno@usgs.gov, jmd@usgs.gov
+
+"""
+# =============================================================================
+# IMPORT STATEMENTS
+# =============================================================================
+from __future__ import print_function
+import datetime
+import importlib
+import json
+import multiprocessing
+import os
+import signal
+import tempfile
+import time
+import zipfile
+from collections import deque
+
+from burpro_batch import batch_worker
+from burpro_setup import find_kor_files
+
+STATUS_FILE = 'BurPro_watch_status.json'
+# finished jobs kept in the status file
+STATUS_HISTORY = 100
+
+
+def now_string():
+    return datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def ignore_interrupt():
+    """Ctrl-C stops the watcher which stops the workers"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def start_worker():
+    """Pool initializer.  Workers ignore Ctrl-C and load the processing
+    modules as they start, so that a file queued later does not wait for
+    them; workers started by spawn, as on Windows, share nothing with the
+    watcher"""
+    ignore_interrupt()
+    importlib.import_module('burpro_process')
+
+
+def file_signature(filename):
+    """Return (size, modification time) of a file, None if it is gone"""
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime
+
+
+def is_complete(filename):
+    """True when a file can be opened for reading and holds a whole .xlsx
+    (zip) archive.  Files still being copied are locked on Windows and lack
+    the zip central directory everywhere"""
+    try:
+        with open(filename, 'rb'):
+            pass
+    except IOError:
+        return False
+    return zipfile.is_zipfile(filename)
+
+
+class FolderWatcher(object):
+    """Finds new input files in directories and runs them through a worker
+    pool, at most jobs files at a time.  Files present when the watcher
+    starts are not processed; a file that changes after it was queued is
+    processed again"""
+
+    def __init__(self, directories, version, jobs=1, status_file=None,
+                 poll=2., settle=2.):
+        self.directories = [os.path.abspath(d) for d in directories]
+        self.version = version
+        self.jobs = jobs
+        self.status_file = status_file or os.path.join(self.directories[0],
+                                                       STATUS_FILE)
+        self.poll = poll
+        self.settle = settle
+        # filename -> signature of files already queued or present at start
+        self.known = {}
+        # filename -> (signature, time it was first seen with it)
+        self.candidates = {}
+        self.queued = deque()
+        # filename -> (job record, AsyncResult)
+        self.running = {}
+        self.finished = deque(maxlen=STATUS_HISTORY)
+        self.pool = None
+        for filename in self.list_files():
+            self.known[filename] = file_signature(filename)
+
+    def list_files(self):
+        files = []
+        for direc in self.directories:
+            files.extend(find_kor_files(direc) or [])
+        return files
+
+    def scan(self, now=None):
+        """Queue files that are new or changed and have been unchanged for
+        settle seconds
+        RETURNS:
+        list of newly queued job records"""
+        now = time.time() if now is None else now
+        queued = []
+        for filename in self.list_files():
+            signature = file_signature(filename)
+            if signature is None or self.known.get(filename) == signature:
+                continue
+            candidate = self.candidates.get(filename)
+            if candidate is None or candidate[0] != signature:
+                # new or still growing, look again on the next scan
+                self.candidates[filename] = (signature, now)
+                continue
+            if now - candidate[1] < self.settle or not is_complete(filename):
+                continue
+            del self.candidates[filename]
+            self.known[filename] = signature
+            job = {'file': filename, 'status': 'queued',
+                   'queued': now_string(), 'started': None, 'finished': None,
+                   'output_dir': None, 'error': None}
+            self.queued.append(job)
+            queued.append(job)
+            print('queued  ', filename)
+        return queued
+
+    def dispatch(self):
+        """Hand queued files to the pool while workers are free"""
+        while self.queued and len(self.running) < self.jobs:
+            job = self.queued.popleft()
+            job['status'] = 'running'
+            job['started'] = now_string()
+            result = self.pool.apply_async(batch_worker,
+                                           ((job['file'], self.version),))
+            self.running[job['file']] = (job, result)
+            print('running ', job['file'])
+
+    def collect(self):
+        """Move completed jobs from running to finished
+        RETURNS:
+        number of jobs collected"""
+        done = [filename for filename, (_, result) in self.running.items()
+                if result.ready()]
+        for filename in done:
+            job, result = self.running.pop(filename)
+            job.update(result.get())
+            job['finished'] = now_string()
+            self.finished.appendleft(job)
+            print(job['status'].ljust(8), filename)
+        return len(done)
+
+    def status(self):
+        return {'updated': now_string(),
+                'pid': os.getpid(),
+                'directories': self.directories,
+                'jobs': self.jobs,
+                'queued': list(self.queued),
+                'running': [job for job, _ in self.running.values()],
+                'finished': list(self.finished)}
+
+    def write_status(self):
+        """Replace the status file in one step so readers never see a
+        partial file"""
+        directory = os.path.dirname(os.path.abspath(self.status_file))
+        handle, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+        with os.fdopen(handle, 'w') as outfile:
+            json.dump(self.status(), outfile, indent=4)
+        if os.path.exists(self.status_file):
+            # os.rename does not replace files on Windows
+            os.remove(self.status_file)
+        os.rename(tmp_path, self.status_file)
+
+    def run(self):
+        """Watch until interrupted with Ctrl-C"""
+        self.pool = multiprocessing.Pool(processes=self.jobs,
+                                         initializer=start_worker)
+        print('Watching', ', '.join(self.directories))
+        print('Status file', self.status_file)
+        self.write_status()
+        try:
+            while True:
+                queued = self.scan()
+                collected = self.collect()
+                self.dispatch()
+                if queued or collected:
+                    self.write_status()
+                time.sleep(self.poll)
+        except KeyboardInterrupt:
+            print('Stopping, running jobs are abandoned')
+        finally:
+            # a pool must be stopped before it is joined, whatever ended
+            # the loop
+            self.pool.terminate()
+            self.pool.join()
+            for job, _ in self.running.values():
+                job['status'] = 'abandoned'
+                self.finished.appendleft(job)
+            self.running.clear()
+            self.write_status()
+
+
+def watch(directories, version, jobs=1, status_file=None):
+    FolderWatcher(directories, version, jobs, status_file).run()
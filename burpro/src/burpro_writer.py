@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+:DESCRIPTION: Writes BurPro results to .xlsx, .csv and .parquet files from
+              the same in memory dataframes.  Excel workbooks are streamed
+              row by row so that large outputs are not held in memory a
+              second time.
+
+:REQUIRES: pandas, XlsxWriter (optional) or openpyxl,
+           pyarrow (parquet output only)
+
+:AUTHOR: John Franco Saraceno, John M. Donovan
+:ORGANIZATION: U.S. Geological Survey, United States Department of Interior
+:CONTACT: saraceno@usgs.gov, jmd@usgs.gov
+
+"""
+# =============================================================================
+# IMPORT STATEMENTS
+# =============================================================================
+from __future__ import print_function
+import datetime
+import os
+
+import pandas as pd
+
+OUTPUT_FORMATS = ['xlsx', 'csv', 'parquet']
+CSV_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+EXCEL_DATE_FORMAT = 'yyyy-mm-dd hh:mm:ss'
+# rows of an Excel worksheet, the header row included
+EXCEL_MAX_ROWS = 1048576
+
+
+def check_output_formats(formats):
+    """Raise before processing starts if an output format is unknown or its
+    optional dependency is not installed"""
+    unknown = [fmt for fmt in formats if fmt not in OUTPUT_FORMATS]
+    if unknown:
+        raise ValueError('Unknown output format(s): ' + ', '.join(unknown))
+    if 'parquet' in formats:
+        import_pyarrow()
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('The parquet output format requires pyarrow, '
+                          'install it with: pip install pyarrow')
+    return pyarrow
+
+
+def fit_formats(formats, rows):
+    """Return formats with xlsx left out when a frame of rows rows does not
+    fit an Excel worksheet, csv taking its place when nothing else is left"""
+    if 'xlsx' not in formats or rows < EXCEL_MAX_ROWS:
+        return list(formats)
+    return [fmt for fmt in formats if fmt != 'xlsx'] or ['csv']
+
+
+def write_frames(output_base, sheets, formats):
+    """Write each (sheet name, dataframe) in sheets in every format.  All
+    sheets go into one workbook named output_base + '.xlsx'; csv and parquet
+    get a file per sheet, the first named output_base and the others by
+    suffix_name(output_base, sheet name)
+    RETURNS:
+    list of filenames written"""
+    if 'xlsx' in formats:
+        for name, frame in sheets:
+            if len(frame) >= EXCEL_MAX_ROWS:
+                raise ValueError('Sheet %s has %d rows, more than an Excel '
+                                 'worksheet holds, use the csv or parquet '
+                                 'output format' % (name, len(frame)))
+    written = []
+    for fmt in formats:
+        if fmt == 'xlsx':
+            written.append(output_base + '.xlsx')
+            write_excel(written[-1], sheets)
+            continue
+        for position, (name, frame) in enumerate(sheets):
+            base = output_base
+            if position:
+                base = suffix_name(output_base, name)
+            written.append(base + '.' + fmt)
+            if fmt == 'csv':
+                write_csv(written[-1], frame)
+            else:
+                write_parquet(written[-1], frame)
+    return written
+
+
+def suffix_name(output_base, sheet_name):
+    """Sheets after the first of a workbook become files named after the
+    sheet in place of the trailing _mad"""
+    return output_base[:-len('_mad')] + '_' + sheet_name
+
+
+def write_excel(filename, sheets):
+    """Stream (sheet name, dataframe) pairs to a workbook laid out like
+    DataFrame.to_excel: a header row, the index in the first column and
+    missing values as blank cells.  XlsxWriter's constant memory mode is
+    used when it is installed, openpyxl's write only mode otherwise"""
+    try:
+        import xlsxwriter
+    except ImportError:
+        write_excel_openpyxl(filename, sheets)
+        return
+    workbook = xlsxwriter.Workbook(filename, {'constant_memory': True})
+    date_format = workbook.add_format({'num_format': EXCEL_DATE_FORMAT})
+    for name, frame in sheets:
+        sheet = workbook.add_worksheet(name)
+        sheet.write_row(0, 0, [frame.index.name] + frame.columns.tolist())
+        for row_number, (label, row) in enumerate(
+                zip(excel_labels(frame.index), frame.values.tolist()), 1):
+            if isinstance(label, datetime.datetime):
+                sheet.write_datetime(row_number, 0, label, date_format)
+            else:
+                sheet.write(row_number, 0, label)
+            for col_number, value in enumerate(row, 1):
+                if value == value:
+                    sheet.write_number(row_number, col_number, value)
+    workbook.close()
+
+
+def write_excel_openpyxl(filename, sheets):
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    for name, frame in sheets:
+        sheet = workbook.create_sheet(title=name)
+        sheet.append([frame.index.name] + frame.columns.tolist())
+        for label, row in zip(excel_labels(frame.index),
+                              frame.values.tolist()):
+            sheet.append([label] + [None if value != value else value
+                                    for value in row])
+    workbook.save(filename)
+
+
+def excel_labels(index):
+    if isinstance(index, pd.DatetimeIndex):
+        return index.to_pydatetime()
+    return index.tolist()
+
+
+def write_csv(filename, frame):
+    frame.to_csv(filename, date_format=CSV_DATE_FORMAT, encoding='utf-8')
+
+
+def write_parquet(filename, frame):
+    pyarrow = import_pyarrow()
+    pyarrow.parquet.write_table(pyarrow.Table.from_pandas(frame), filename)
+
+
+def output_base(output_dir, exo_filename):
+    """Return the output filename, less its extension, of an input file"""
+    input_name_only = os.path.split(exo_filename)[1]
+    return os.path.join(output_dir,
+                        input_name_only.replace('.xlsx', '_mad'))
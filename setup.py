@@ -18,7 +18,7 @@ setup(name='burpro',
       author_email='saraceno@usgs.gov',
       url=url,
       download_url=url,
-      install_requires=['numpy', 'pandas', 'statsmodels'],
+      install_requires=['numpy', 'openpyxl>=2.6', 'pandas'],
       license=license,
       packages=pkgs,
       include_package_data=True,
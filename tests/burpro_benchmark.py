@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+:DESCRIPTION: Times and memory profiles each BurPro processing stage on
+              synthetic KOR files from one week to several years long.
+              Results are written to a json file so runs can be compared
+              over time.  The work of fetch_file_metadata happens in
+              parse_kor_frame (or read_kor_file when streaming).
+
+:REQUIRES: kor_generator.py, numpy, pandas, openpyxl
+
+:USAGE: python burpro_benchmark.py --sizes week month year
+        python burpro_benchmark.py --compare old_results.json
+
+:AUTHOR: John Franco Saraceno, John M. Donovan
+:ORGANIZATION: U.S. Geological Survey, United States Department of Interior
+:CONTACT: saraceno@usgs.gov, jmd@usgs.gov
+
+"""
+# =============================================================================
+# IMPORT STATEMENTS
+# =============================================================================
+from __future__ import print_function
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'burpro', 'src'))
+import burpro_process
+from burpro_metrics import MB, PeakRssSampler
+from burpro_run_mgr import read_json_params
+from kor_generator import write_kor_file
+
+SIZES = OrderedDict([('week', 7), ('month', 30), ('season', 91),
+                     ('year', 365), ('3years', 1095)])
+
+
+def measure(records, size, stage, func, *args):
+    """Run func(*args), append its wall time, cpu time and memory use to
+    records and return its result"""
+    sampler = PeakRssSampler()
+    sampler.start()
+    cpu = os.times()
+    wall = time.time()
+    try:
+        result = func(*args)
+    finally:
+        wall = time.time() - wall
+        cpu_end = os.times()
+        sampler.stop()
+    record = OrderedDict(size)
+    record['stage'] = stage
+    record['wall_s'] = round(wall, 4)
+    record['cpu_s'] = round(cpu_end[0] + cpu_end[1] - cpu[0] - cpu[1], 4)
+    record['peak_rss_mb'] = round(sampler.peak_rss / MB, 1)
+    record['rss_increase_mb'] = round((sampler.peak_rss -
+                                       sampler.start_rss) / MB, 1)
+    records.append(record)
+    print('%-8s %-28s %9.3f s %9.1f MB' % (size['size'], stage,
+                                            record['wall_s'],
+                                            record['peak_rss_mb']))
+    return result
+
+
+def benchmark_file(records, size, exo_filename, params, output_dir,
+                   groupby):
+    drop_cols = params['drop_cols']
+    index_timezone = params['index_timezone']
+    interval = params.get('interval', 15)
+    mad_criteria = params.get('mad_criteria', 2.5)
+    null_value = -9999
+    log = logging.getLogger('burpro_benchmark')
+
+    df_exo = measure(records, size, 'read_excel',
+                     lambda: pd.read_excel(exo_filename, header=None))
+    parsed_kor = measure(records, size, 'parse_kor_frame',
+                         burpro_process.parse_kor_frame, df_exo, drop_cols,
+                         index_timezone)
+    del df_exo
+    measure(records, size, 'read_kor_file', burpro_process.read_kor_file,
+            exo_filename, drop_cols, index_timezone)
+    df_exo_float, grouped = measure(records, size, 'process_data_frame',
+                                    burpro_process.process_data_frame,
+                                    parsed_kor, interval, u'SpCond µS/cm', 60,
+                                    exo_filename, log)
+    if groupby:
+        measure(records, size, 'calc_med_abs_dev',
+                burpro_process.calc_med_abs_dev, log, df_exo_float, grouped,
+                mad_criteria, null_value)
+    exo_mad = measure(records, size, 'calc_med_abs_dev_vectorized',
+                      burpro_process.calc_med_abs_dev_vectorized, log,
+                      df_exo_float, interval, mad_criteria, null_value)
+    measure(records, size, 'write_output', burpro_process.write_output, log,
+            output_dir, exo_filename, exo_mad)
+
+
+def run(args):
+    params = read_json_params()
+    if not os.path.isdir(args.workdir):
+        os.makedirs(args.workdir)
+    logger = logging.getLogger('burpro_benchmark')
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    records = []
+    for name in args.sizes:
+        days = SIZES[name]
+        exo_filename = os.path.join(args.workdir, 'kor_%dd_%dp_s%d.xlsx' %
+                                    (days, args.params, args.seed))
+        if not os.path.isfile(exo_filename):
+            print('Generating', exo_filename)
+            write_kor_file(exo_filename, days=days, n_params=args.params,
+                           seed=args.seed)
+        size = OrderedDict([('size', name), ('days', days),
+                            ('params', args.params),
+                            ('file_mb', round(os.path.getsize(exo_filename) /
+                                              MB, 2))])
+        output_dir = tempfile.mkdtemp()
+        try:
+            benchmark_file(records, size, exo_filename, params, output_dir,
+                           args.groupby)
+        finally:
+            shutil.rmtree(output_dir)
+
+    report = OrderedDict([
+        ('created', datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')),
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('numpy', np.__version__),
+        ('pandas', pd.__version__),
+        ('results', records)])
+    output = args.output or os.path.join(
+        args.workdir, 'burpro_benchmark_%s.json' %
+        datetime.datetime.now().strftime('%Y%m%dT%H%M%S'))
+    with open(output, 'w') as outfile:
+        json.dump(report, outfile, indent=4)
+    print('Results written to', output)
+    return output
+
+
+def compare(old_filename, new_filename):
+    """Print the wall time and peak memory of each stage of a new run
+    relative to an older one"""
+    with open(old_filename) as infile:
+        old = json.load(infile)
+    with open(new_filename) as infile:
+        new = json.load(infile)
+    old_results = dict(((r['size'], r['params'], r['stage']), r)
+                       for r in old['results'])
+    print('%-8s %-28s %10s %10s' % ('size', 'stage', 'time x', 'memory x'))
+    for record in new['results']:
+        key = (record['size'], record['params'], record['stage'])
+        if key not in old_results:
+            continue
+        before = old_results[key]
+        print('%-8s %-28s %10.2f %10.2f' % (
+            record['size'], record['stage'],
+            record['wall_s'] / max(before['wall_s'], 1e-6),
+            record['peak_rss_mb'] / max(before['peak_rss_mb'], 1e-6)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='BurPro stage benchmark')
+    parser.add_argument('--sizes', nargs='+', default=['week', 'month'],
+                        choices=list(SIZES))
+    parser.add_argument('--params', type=int, default=8,
+                        help='number of burst parameter columns')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--groupby', action='store_true',
+                        help='also time the groupby calc_med_abs_dev path')
+    parser.add_argument('--workdir', default=os.path.join(
+                        tempfile.gettempdir(), 'burpro_benchmark'),
+                        help='where generated files and results are kept')
+    parser.add_argument('--output', help='results json filename')
+    parser.add_argument('--compare', metavar='OLD_JSON',
+                        help='compare this run against an earlier result')
+    args = parser.parse_args()
+    output = run(args)
+    if args.compare:
+        compare(args.compare, output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,41 @@
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+from nose.plugins.skip import SkipTest
 from nose.tools import *
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'burpro', 'src'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 import burpro
+import burpro_api
+import burpro_batch
+import burpro_cache
+import burpro_engine
+import burpro_incremental
+import burpro_inspect
+import burpro_manifest
+import burpro_merge
+import burpro_metrics
+import burpro_process
+import burpro_reader
+import burpro_run_mgr
+import burpro_setup
+import burpro_shared
+import burpro_store
+import burpro_watch
+import burpro_writer
+from burpro_run_mgr import read_json_params
+from kor_generator import write_kor_file
+
 
 def setup():
     print "SETUP!"
@@ -8,4 +44,712 @@ def teardown():
     print "TEAR DOWN!"
 
 def test_basic():
-    print "I RAN!"
\ No newline at end of file
+    print "I RAN!"
+
+
+def make_burst_frame(seed=0, n_bursts=12, null_value=-9999):
+    """Shuffled burst frame with gaps, short bursts and null values"""
+    rng = np.random.RandomState(seed)
+    start = pd.Timestamp('2017-03-01 07:00:07')
+    index = []
+    for burst in sorted(rng.choice(40, n_bursts, replace=False)):
+        for second in range(rng.randint(1, 40)):
+            index.append(start + pd.Timedelta(minutes=15 * burst,
+                                              seconds=second))
+    values = np.round(rng.randn(len(index), 3) * 10, 1) + 100
+    values[rng.rand(*values.shape) < 0.05] = null_value
+    frame = pd.DataFrame(values, columns=['Temp', 'pH', 'ODO mg/L'],
+                         index=pd.DatetimeIndex(index, name='Datetime (PST)'))
+    return frame.sample(frac=1, random_state=seed)
+
+
+def test_vectorized_mad_matches_groupby():
+    log = logging.getLogger('BurPro')
+    for seed in range(5):
+        frame = make_burst_frame(seed)
+        grouped = frame.groupby(pd.TimeGrouper('15Min'), sort=False)
+        expected = burpro_process.calc_med_abs_dev(log, frame, grouped,
+                                                   2.5, -9999)
+        result = burpro_process.calc_med_abs_dev_vectorized(log, frame, 15,
+                                                            2.5, -9999)
+        pd.util.testing.assert_frame_equal(result, expected,
+                                           check_exact=True)
+
+
+def test_float32_and_nan_input_match_sentinel_input():
+    log = logging.getLogger('BurPro')
+    for seed in range(3):
+        sentinel = make_burst_frame(seed)
+        frame = make_burst_frame(seed, null_value=np.nan)
+        expected = burpro_process.calc_med_abs_dev_vectorized(
+                       log, sentinel, 15, 2.5, -9999)
+        result = burpro_process.calc_med_abs_dev_vectorized(
+                     log, frame, 15, 2.5, -9999)
+        pd.util.testing.assert_frame_equal(result, expected,
+                                           check_exact=True)
+        result = burpro_process.calc_med_abs_dev_vectorized(
+                     log, frame.astype(np.float32), 15, 2.5, -9999)
+        assert_true(np.allclose(result.values, expected.values,
+                                rtol=burpro_engine.FLOAT32_RTOL, atol=0,
+                                equal_nan=True))
+
+
+def test_gap_segments_keep_bursts_whole():
+    start = pd.Timestamp('2017-03-01 07:14:30')
+    # a burst across the 07:15 edge, a two day outage, then two bursts
+    stamps = ([start + pd.Timedelta(seconds=s) for s in range(60)] +
+              [start + pd.Timedelta(days=2, minutes=m, seconds=s)
+               for m in (1, 16) for s in range(10)])
+    index = pd.DatetimeIndex(stamps).take(np.random.RandomState(0)
+                                          .permutation(len(stamps)))
+    order, offsets, labels = burpro_engine.gap_segments(index, 15, 60)
+    assert_equal(np.diff(offsets).tolist(), [60, 10, 10])
+    assert_equal(labels.tolist(), [pd.Timestamp('2017-03-01 07:00'),
+                                   pd.Timestamp('2017-03-03 07:15'),
+                                   pd.Timestamp('2017-03-03 07:30')])
+    assert_true((np.diff(index.asi8[order]) >= 0).all())
+    order, offsets, labels = burpro_engine.interval_bins(index, 15)
+    assert_equal(np.diff(offsets).tolist(), [30, 30, 10, 10])
+
+
+def test_threaded_mad_is_deterministic_and_ordered():
+    log = logging.getLogger('burpro_threads')
+    handler = logging.handlers.BufferingHandler(100)
+    log.addHandler(handler)
+    level = log.level
+    log.setLevel(logging.INFO)
+    try:
+        frame = make_burst_frame(6)
+        grouped = frame.groupby(pd.TimeGrouper('15Min'), sort=False)
+        for mad_engine in ['groupby', 'vectorized']:
+            expected = burpro_process.calc_mad(log, frame, grouped, 15, 2.5,
+                                               mad_engine, -9999)
+            del handler.buffer[:]
+            result = burpro_process.calc_mad(log, frame, grouped, 15, 2.5,
+                                             mad_engine, -9999, threads=3)
+            pd.util.testing.assert_frame_equal(result, expected,
+                                               check_exact=True)
+            assert_equal([record.getMessage() for record in handler.buffer],
+                         ['Parameter: ' + col for col in frame.columns])
+    finally:
+        log.setLevel(level)
+        log.removeHandler(handler)
+
+
+def test_shared_processes_match_single_process():
+    log = logging.getLogger('burpro_processes')
+    frame = make_burst_frame(7, n_bursts=20)
+    frame[frame == -9999] = np.nan
+    work_dir = tempfile.mkdtemp()
+    try:
+        expected = burpro_process.calc_med_abs_dev_sweep(log, frame, 15,
+                                                         [2., 3.], -9999)
+        result = burpro_process.calc_med_abs_dev_sweep(log, frame, 15,
+                                                       [2., 3.], -9999,
+                                                       processes=3,
+                                                       scratch_dir=work_dir)
+        for expected_mad, mad in zip(expected[0], result[0]):
+            pd.util.testing.assert_frame_equal(mad, expected_mad,
+                                               check_exact=True)
+        pd.util.testing.assert_frame_equal(result[1], expected[1],
+                                           check_exact=True)
+        for (_, expected_qa), (_, qa) in zip(expected[2], result[2]):
+            pd.util.testing.assert_frame_equal(qa, expected_qa,
+                                               check_exact=True)
+        # scratch files are removed
+        assert_equal(os.listdir(work_dir), [])
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def test_batch_jobs_with_shared_processes():
+    work_dir = tempfile.mkdtemp()
+    read_params = burpro_run_mgr.read_json_params
+
+    def shared_params():
+        params = read_params()
+        params.update(parse_cache=False, mad_processes=2)
+        return params
+
+    burpro_run_mgr.read_json_params = shared_params
+    try:
+        files = [os.path.join(work_dir, 'site%d.xlsx' % seed)
+                 for seed in range(2)]
+        for seed, exo_filename in enumerate(files):
+            write_kor_file(exo_filename, days=0.25, n_params=4, seed=seed)
+        # pool workers are daemonic and reduce in process
+        results = burpro_batch.run_batch(files, 'test', 2)
+        assert_equal([result['status'] for result in results],
+                     ['ok', 'ok'])
+    finally:
+        burpro_run_mgr.read_json_params = read_params
+        shutil.rmtree(work_dir)
+
+
+def test_burst_slices():
+    assert_equal(burpro_shared.burst_slices(10, 3), [(0, 3), (3, 6), (6, 10)])
+    assert_equal(burpro_shared.burst_slices(2, 4), [(0, 1), (1, 2)])
+    assert_equal(burpro_shared.burst_slices(1000, 1, 400),
+                 [(0, 333), (333, 666), (666, 1000)])
+
+
+def test_merge_sorted_runs_keeps_first_of_each_timestamp():
+    runs = [np.array([1, 3, 5, 7]), np.array([2, 3, 4]), np.array([]),
+            np.array([0, 7, 8])]
+    rows = burpro_merge.merge_sorted_runs([run.astype(np.int64)
+                                           for run in runs])
+    # row numbers in the concatenation: 0-3, 4-6, 7-9
+    assert_equal(rows.tolist(), [7, 0, 4, 1, 6, 2, 3, 9])
+
+
+def test_merge_overlapping_exports():
+    log = logging.getLogger('burpro_merge')
+    frame = make_burst_frame(3).sort_index()
+    frame = frame[~frame.index.duplicated()]
+    devices = [{'Device Name': u'EXO2 Sonde', 'Serial Number': u'1',
+                'Firmware Version': u'2.0'},
+               {'Device Name': u'pH', 'Serial Number': u'2',
+                'Firmware Version': u'2.1'}]
+    first = frame.iloc[:len(frame) * 2 // 3][['Temp', 'pH']]
+    # the second download repeats part of the first, out of order
+    second = frame.iloc[len(frame) // 3:].sample(frac=1, random_state=0)
+    parsed = [burpro_process.ParsedKorFile(devices, [['Temp'], ['pH']],
+                                           first),
+              burpro_process.ParsedKorFile(devices[:1],
+                                           [['Temp', 'ODO mg/L']], second)]
+    merged = burpro_merge.merge_parsed_files(log, parsed, ['a', 'b'])
+    # repeated rows come from the first file, without the ODO column
+    expected = frame.copy()
+    expected.loc[first.index, 'ODO mg/L'] = np.nan
+    pd.util.testing.assert_frame_equal(merged.data, expected,
+                                       check_exact=True, check_names=False)
+    assert_equal(merged.device_columns, [['Temp', 'ODO mg/L'], ['pH']])
+
+
+def test_results_store_round_trip():
+    work_dir = tempfile.mkdtemp()
+    try:
+        db_path = os.path.join(work_dir, 'results.db')
+        index = pd.date_range('2017-03-01', periods=6, freq='15Min',
+                              name='Datetime (PST)')
+        exo_mad = pd.DataFrame({'Temp': [10., 11., np.nan, 13., 14., 15.],
+                                u'SpCond \xb5S/cm': np.arange(6.)},
+                               index=index)
+        devices = [{'Device Name': u'EXO2 Sonde', 'Serial Number': u'15A1',
+                    'Firmware Version': u'2.0'}]
+        site, stored = burpro_store.store_run(db_path, 'missing.xlsx',
+                                              work_dir, exo_mad, devices,
+                                              2.5, [])
+        assert_equal((site, stored), (u'15A1', 11))
+        # a later run replaces the medians it repeats
+        burpro_store.store_run(db_path, 'missing.xlsx', work_dir,
+                               exo_mad.iloc[4:] + 100, devices, 2.5, [])
+        result = burpro_store.query(db_path, u'15A1', ['Temp'],
+                                    '2017-03-01 00:15', '2017-03-01 01:00')
+        assert_equal(result['Temp'].tolist(), [11., 13., 114.])
+        assert_equal(result.index.tolist(), [index[1], index[3], index[4]])
+        listing = burpro_store.list_sites(db_path)
+        assert_equal(listing['medians'].tolist(), [6, 5])
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def test_manifest_skips_unchanged_files():
+    work_dir = tempfile.mkdtemp()
+    try:
+        exo_filename = os.path.join(work_dir, 'site.xlsx')
+        with open(exo_filename, 'wb') as outfile:
+            outfile.write(b'first export')
+        manifest = burpro_manifest.Manifest(work_dir, 'params')
+        assert_equal(manifest.pending([exo_filename]), ([exo_filename], []))
+        manifest.record(exo_filename, 'out')
+        # a new run reads the manifest back
+        manifest = burpro_manifest.Manifest(work_dir, 'params')
+        assert_equal(manifest.pending([exo_filename]), ([], [exo_filename]))
+        assert_equal(manifest.output_dir(exo_filename), 'out')
+        # touched without changes
+        os.utime(exo_filename, (0, 0))
+        assert_true(manifest.is_current(exo_filename))
+        assert_false(burpro_manifest.Manifest(work_dir,
+                                              'other').is_current(
+                                                  exo_filename))
+        with open(exo_filename, 'wb') as outfile:
+            outfile.write(b'later export')
+        assert_false(manifest.is_current(exo_filename))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def test_in_memory_api_matches_batch():
+    work_dir = tempfile.mkdtemp()
+    try:
+        exo_filename = os.path.join(work_dir, 'synthetic.xlsx')
+        write_kor_file(exo_filename, days=0.5, n_params=6, seed=5)
+        log = logging.getLogger('burpro_tests')
+        params = read_json_params()
+        params.update(parse_cache=False, mad_criteria=[2.0, 3.0])
+        batch = burpro_process.process_batch(log, log, exo_filename, params,
+                                             burpro_process.SC_COL,
+                                             burpro_process.SC_CUTOFF,
+                                             burpro_process.NULL_VALUE,
+                                             burpro_metrics.RunMetrics())
+        with open(exo_filename, 'rb') as infile:
+            workbook = infile.read()
+        handlers = logging.getLogger().handlers[:]
+        results = [burpro_api.process_workbook(workbook, params),
+                   burpro_api.process_frame(pd.read_excel(exo_filename,
+                                                          header=None),
+                                            params)]
+        assert_equal(logging.getLogger().handlers, handlers)
+        for result in results:
+            for expected, exo_mad in zip(batch[1], result.exo_mads):
+                pd.util.testing.assert_frame_equal(exo_mad, expected)
+            pd.util.testing.assert_frame_equal(result.rejected, batch[2])
+            assert_equal(result.burst_completion, batch[3])
+            assert_equal(list(result.qa), [name for name, _ in batch[4]])
+            assert_equal(result.devices, batch[0].device_table(True))
+        params['incremental'] = True
+        assert_raises(ValueError, burpro_api.process_workbook, workbook,
+                      params)
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def test_hampel_filter_matches_reference():
+    rng = np.random.RandomState(4)
+    index = pd.date_range('2017-03-01', periods=200, freq='S')
+    values = rng.randn(200, 2)
+    values[rng.rand(200, 2) < 0.05] = np.nan
+    values[[20, 90, 150], 0] = 50.
+    frame = pd.DataFrame(values, index=index, columns=['Temp', 'pH'])
+    window = 11
+    despiked, spikes = burpro_engine.hampel_filter(frame.iloc[::-1], window,
+                                                   2.5)
+    assert_true(spikes['Temp'].iloc[[20, 90, 150]].all())
+
+    for col in frame.columns:
+        data = frame[col].values
+        expected = data.copy()
+        # brute force Hampel filter, the MAD of each window on its own
+        for i in range(len(data)):
+            part = data[max(i - window // 2, 0):i + window // 2 + 1]
+            part = part[~np.isnan(part)]
+            if len(part) <= window // 2:
+                continue
+            median = np.median(part)
+            mad = burpro_engine.median_abs_deviation(part)
+            if np.fabs(data[i] - median) > mad * 2.5:
+                expected[i] = median
+        np.testing.assert_allclose(despiked[col].values, expected)
+    # windows sorted a few at a time give the same result
+    blocked, _ = burpro_engine.hampel_filter(frame, window, 2.5,
+                                             block_rows=7)
+    pd.util.testing.assert_frame_equal(blocked, despiked)
+
+
+def test_despiked_output_is_not_found_as_input():
+    work_dir = tempfile.mkdtemp()
+    try:
+        exo_filename = os.path.join(work_dir, 'site.xlsx')
+        write_kor_file(exo_filename, days=0.25, n_params=4, seed=6)
+        output_dir = os.path.join(work_dir, 'BurPro_test')
+        os.mkdir(output_dir)
+        params = read_json_params()
+        params.update(parse_cache=False, despike_window=5)
+        burpro_process.process(exo_filename, output_dir, params)
+        assert_true(os.path.isfile(os.path.join(output_dir,
+                                                'site_mad_despiked.xlsx')))
+        # a rerun of the directory finds only the export
+        assert_equal(burpro_setup.find_kor_files(work_dir), [exo_filename])
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def test_rename_duplicate_columns():
+    names = ['Temp', 'Turbidity FNU', 'pH', 'Turbidity FNU', 'Turbidity FNU']
+    assert_equal(burpro_process.rename_duplicate_columns(names),
+                 ['Temp', 'Turbidity FNU', 'pH', 'Turbidity FNU.1',
+                  'Turbidity FNU.2'])
+
+
+def test_read_header_block_stops_at_header():
+    rows = iter([(u'KOR Export File',),
+                 (u'EXO2 Sonde', u'15A100001', u'2.0.0'),
+                 (),
+                 (u'Date (MM/DD/YYYY)', u'Time (HH:MM:SS)', u'Temp', u'pH'),
+                 (None, None, 1.0, 7.5)])
+    block = burpro_reader.read_header_block(rows, u'Date (MM/DD/YYYY)')
+    assert_equal(len(block), 4)
+    assert_equal(set(len(row) for row in block), set([4]))
+    objects, floats = burpro_reader.read_data_columns(rows, [0], [2, 3])
+    assert_equal(objects, [[None]])
+    assert_equal([list(values) for values in floats], [[1.0], [7.5]])
+
+
+def test_cache_roundtrip_and_eviction():
+    cache_dir = tempfile.mkdtemp()
+    try:
+        frame = make_burst_frame().sort_index()
+        extra = {'devices': [{'Device Name': u'pH'}],
+                 'device_columns': [[u'pH']]}
+        burpro_cache.store_frame(cache_dir, 'a', frame, extra, 1 << 30)
+        data, metadata = burpro_cache.load_frame(cache_dir, 'a')
+        pd.util.testing.assert_frame_equal(data, frame)
+        assert_equal(metadata, extra)
+        os.utime(burpro_cache.cache_path(cache_dir, 'a'), (0, 0))
+        burpro_cache.store_frame(cache_dir, 'b', frame, extra, 1)
+        assert_equal(burpro_cache.load_frame(cache_dir, 'a'), None)
+        assert_equal(burpro_cache.clear_cache(cache_dir), 1)
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def test_criteria_sweep_matches_single_runs():
+    log = logging.getLogger('BurPro')
+    frame = make_burst_frame(3)
+    criteria = [2.0, 2.5, 3.0]
+    exo_mads, rejected, qa = burpro_process.calc_med_abs_dev_sweep(
+                                 log, frame, 15, criteria, -9999)
+    grouped = frame.groupby(pd.TimeGrouper('15Min'), sort=False)
+    for mad_criteria, exo_mad in zip(criteria, exo_mads):
+        expected = burpro_process.calc_med_abs_dev(log, frame, grouped,
+                                                   mad_criteria, -9999)
+        pd.util.testing.assert_frame_equal(exo_mad, expected,
+                                           check_exact=True)
+    assert_equal(rejected.index.tolist(), criteria)
+    assert_true((rejected.diff().iloc[1:] <= 0).all().all())
+
+
+def test_sweep_rejected_leaves_out_missing_samples():
+    log = logging.getLogger('BurPro')
+    values = np.linspace(99., 101., 30)
+    values[[3, 12, 25]] = np.nan
+    frame = pd.DataFrame({'Temp': values}, index=pd.date_range(
+        '2017-03-01 07:00', periods=30, freq='S', name='Datetime (PST)'))
+    rejected = burpro_process.calc_med_abs_dev_sweep(log, frame, 15,
+                                                     [2.0, 3.0], -9999)[1]
+    assert_equal(rejected['Temp'].tolist(), [0., 0.])
+    # the fraction of the first criteria is that of the QA sheets
+    frame = make_burst_frame(5)
+    exo_mads, rejected, qa = burpro_process.calc_med_abs_dev_sweep(
+                                 log, frame, 15, [2.5, 3.0], -9999)
+    qa = dict(qa)
+    pd.util.testing.assert_series_equal(
+        rejected.loc[2.5], qa['rejected'].sum() / qa['samples'].sum(),
+        check_names=False)
+
+
+def test_burst_qa_matches_per_burst_numpy():
+    log = logging.getLogger('BurPro')
+    frame = make_burst_frame(4)
+    exo_mads, rejected, qa = burpro_process.calc_med_abs_dev_sweep(
+                                 log, frame, 15, [2.5], -9999)
+    qa = dict(qa)
+    for label, burst in frame.groupby(pd.TimeGrouper('15Min')):
+        for col in frame.columns:
+            values = burst[col].values
+            if not len(values):
+                assert_equal(qa['samples'].loc[label, col], 0)
+                continue
+            # statistics other than the filtered median leave out missing
+            # samples
+            measured = values[values != -9999]
+            assert_equal(qa['samples'].loc[label, col], len(measured))
+            assert_equal(qa['missing'].loc[label, col],
+                         len(values) - len(measured))
+            k = burpro_engine.median_abs_deviation(values) * 2.5
+            outside = np.fabs(measured - np.median(values)) > k
+            assert_equal(qa['rejected'].loc[label, col], outside.sum())
+            kept = burpro_process.custom_mad(values, 2.5)
+            if kept != -9999:
+                assert_almost_equal(qa['filtered_median'].loc[label, col],
+                                    kept)
+            if not len(measured):
+                assert_true(np.isnan(qa['min'].loc[label, col]))
+                continue
+            q25, q75 = np.percentile(measured, [25, 75])
+            assert_almost_equal(qa['median'].loc[label, col],
+                                np.median(measured))
+            assert_almost_equal(qa['mad'].loc[label, col],
+                                burpro_engine.median_abs_deviation(measured))
+            assert_almost_equal(qa['min'].loc[label, col], measured.min())
+            assert_almost_equal(qa['max'].loc[label, col], measured.max())
+            assert_almost_equal(qa['iqr'].loc[label, col], q75 - q25)
+    assert_equal(burpro_process.count_min_n_bursts(
+                     qa['samples'] + qa['missing'], 20),
+                 burpro_process.count_min_n_bursts(
+                     pd.DataFrame(dict((col, frame.groupby(
+                         pd.TimeGrouper('15Min')).size())
+                         for col in frame.columns)), 20))
+
+    # a 30 sample burst missing one sample
+    values = np.linspace(99., 101., 30)
+    values[7] = np.nan
+    frame = pd.DataFrame({'Temp': values}, index=pd.date_range(
+        '2017-03-01 07:00', periods=30, freq='S', name='Datetime (PST)'))
+    qa = dict(burpro_process.calc_med_abs_dev_sweep(log, frame, 15, [2.5],
+                                                    -9999)[2])
+    assert_equal(qa['samples']['Temp'].tolist(), [29])
+    assert_equal(qa['missing']['Temp'].tolist(), [1])
+    assert_equal(qa['rejected']['Temp'].tolist(), [0])
+    assert_almost_equal(qa['min']['Temp'].iloc[0], 99.)
+    assert_almost_equal(qa['mad']['Temp'].iloc[0],
+                        burpro_engine.median_abs_deviation(
+                            values[~np.isnan(values)]))
+
+
+def test_streaming_reader_matches_read_excel():
+    work_dir = tempfile.mkdtemp()
+    try:
+        exo_filename = os.path.join(work_dir, 'synthetic.xlsx')
+        write_kor_file(exo_filename, days=1, n_params=8, seed=1)
+        params = read_json_params()
+        drop_cols = params['drop_cols']
+        streamed = burpro_process.read_kor_file(exo_filename, drop_cols,
+                                                'Datetime (PST)')
+        parsed = burpro_process.parse_kor_frame(
+                     pd.read_excel(exo_filename, header=None), drop_cols,
+                     'Datetime (PST)')
+        pd.util.testing.assert_frame_equal(streamed.data, parsed.data)
+        assert_equal(streamed.device_table(True), parsed.device_table(True))
+        assert_true([u'Turbidity FNU.1', u'TSS mg/L.1'] in
+                    streamed.device_columns)
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def write_shared_strings_copy(exo_filename):
+    """Copy a workbook with XlsxWriter, which writes shared strings, date
+    formatted cells and a dimension, as Excel does"""
+    import xlsxwriter
+    copy_filename = exo_filename.replace('.xlsx', '_shared.xlsx')
+    workbook = xlsxwriter.Workbook(copy_filename)
+    sheet = workbook.add_worksheet()
+    date_format = workbook.add_format({'num_format': 'mm/dd/yyyy'})
+    time_format = workbook.add_format({'num_format': 'hh:mm:ss'})
+    for row_number, row in enumerate(
+            burpro_reader.iter_sheet_rows(exo_filename)):
+        for col_number, value in enumerate(row):
+            if isinstance(value, datetime.datetime):
+                sheet.write_datetime(row_number, col_number, value,
+                                     date_format)
+            elif isinstance(value, datetime.time):
+                sheet.write_datetime(row_number, col_number, value,
+                                     time_format)
+            elif value is not None:
+                sheet.write(row_number, col_number, value)
+    workbook.close()
+    return copy_filename
+
+
+def test_inspect_matches_full_read():
+    work_dir = tempfile.mkdtemp()
+    try:
+        inline = os.path.join(work_dir, 'inline.xlsx')
+        write_kor_file(inline, days=0.2, n_params=6, seed=2)
+        files = [inline]
+        try:
+            files.append(write_shared_strings_copy(inline))
+        except ImportError:
+            pass
+        drop_cols = read_json_params()['drop_cols']
+        for exo_filename in files:
+            parsed = burpro_process.read_kor_file(exo_filename, drop_cols,
+                                                  'Datetime (PST)')
+            entry = burpro_inspect.inspect_kor_file(exo_filename, drop_cols,
+                                                    'Datetime (PST)')
+            assert_equal(entry['first'], str(parsed.data.index[0]))
+            assert_equal(entry['last'], str(parsed.data.index[-1]))
+            assert_equal(entry['columns'], parsed.data.columns.tolist())
+            for device, expected in zip(entry['devices'],
+                                        parsed.device_table(True)):
+                assert_equal(device['Start time'], entry['first'])
+                del device['Start time'], device['End time']
+                assert_equal(device, expected)
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def test_run_metrics_records_stages():
+    work_dir = tempfile.mkdtemp()
+    try:
+        metrics = burpro_metrics.RunMetrics()
+        with metrics.stage('mad', rows=10) as stage:
+            stage['bursts'] = 2
+        assert_equal([s['stage'] for s in metrics.stages], ['mad'])
+        assert_equal(metrics.stages[0]['bursts'], 2)
+        filename = os.path.join(work_dir, 'run_metrics.json')
+        metrics.write_json(filename, file='run.xlsx')
+        with open(filename) as infile:
+            report = json.load(infile)
+        assert_equal(report['file'], 'run.xlsx')
+        assert_equal(report['stages'][0]['rows'], 10)
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def test_datetime_index_from_cells_and_strings():
+    start = datetime.datetime(2017, 3, 1, 23, 59, 58)
+    stamps = [start + datetime.timedelta(seconds=i) for i in range(5)]
+    dates = [datetime.datetime(s.year, s.month, s.day) for s in stamps]
+    times = [s.time() for s in stamps]
+    expected = pd.DatetimeIndex(stamps, name='Datetime (PST)')
+    index = burpro_process.datetime_index(dates, times, 'Datetime (PST)')
+    assert_true(index.equals(expected))
+    assert_equal(index.name, 'Datetime (PST)')
+    index = burpro_process.datetime_index(
+                [d.strftime('%m/%d/%Y') for d in dates],
+                [t.strftime('%H:%M:%S') for t in times], 'Datetime (PST)')
+    assert_true(index.equals(expected))
+
+
+def test_watcher_queues_new_complete_files():
+    work_dir = tempfile.mkdtemp()
+    try:
+        write_kor_file(os.path.join(work_dir, 'old.xlsx'), days=0.05)
+        watcher = burpro_watch.FolderWatcher([work_dir], 'test', settle=1.)
+        assert_equal(watcher.scan(now=0.), [])
+        new_file = os.path.join(work_dir, 'new.xlsx')
+        write_kor_file(new_file, days=0.05)
+        with open(os.path.join(work_dir, 'partial.xlsx'), 'wb') as outfile:
+            outfile.write(b'PK\x03\x04 still copying')
+        assert_equal(watcher.scan(now=0.), [])
+        # unchanged files are queued once they settle
+        assert_equal(watcher.scan(now=0.5), [])
+        queued = watcher.scan(now=1.)
+        assert_equal([job['file'] for job in queued], [new_file])
+        assert_equal(watcher.scan(now=2.), [])
+        watcher.write_status()
+        with open(watcher.status_file) as infile:
+            status = json.load(infile)
+        assert_equal(status['queued'][0]['status'], 'queued')
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def test_watcher_stops_its_pool_on_errors():
+    work_dir = tempfile.mkdtemp()
+    try:
+        watcher = burpro_watch.FolderWatcher([work_dir], 'test')
+
+        def scan():
+            raise RuntimeError('scan failed')
+        watcher.scan = scan
+        # the error of the loop is raised, not one of joining the pool
+        assert_raises(RuntimeError, watcher.run)
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def test_incremental_mad_reuses_unchanged_bursts():
+    work_dir = tempfile.mkdtemp()
+    try:
+        log = logging.getLogger('burpro_tests')
+        frame = make_burst_frame(seed=4, n_bursts=20).sort_index()
+        state_file = os.path.join(work_dir, 'site.npz')
+        starts = []
+
+        def calc(df):
+            starts.append(df.index[0])
+            return burpro_process.calc_med_abs_dev_vectorized(log, df, 15,
+                                                              2.5, -9999)
+
+        expected = calc(frame)
+        split = frame.index[len(frame) // 2]
+        burpro_incremental.incremental_mad(log, frame[frame.index < split],
+                                           15, state_file, 'a', calc)
+        del starts[:]
+        result = burpro_incremental.incremental_mad(log, frame, 15,
+                                                    state_file, 'a', calc)
+        pd.util.testing.assert_frame_equal(result, expected)
+        assert_true(starts[0] > frame.index[0])
+        # changed parameters or earlier data recompute every burst
+        for fingerprint, data in [('b', frame), ('b', frame + 1.)]:
+            del starts[:]
+            burpro_incremental.incremental_mad(log, data, 15, state_file,
+                                               fingerprint, calc)
+            assert_equal(starts, [frame.index[0]])
+        # the criteria sweep has no incremental state
+        assert_raises(ValueError, burpro_process.check_batch_params,
+                      {'mad_criteria': [2.0, 3.0], 'incremental': True})
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def test_output_formats_hold_the_same_results():
+    work_dir = tempfile.mkdtemp()
+    try:
+        log = logging.getLogger('burpro_tests')
+        exo_mad = burpro_process.calc_med_abs_dev_vectorized(
+                      log, make_burst_frame(seed=5), 15, 2.5, -9999)
+        burpro_process.write_output(log, work_dir, 'site.xlsx', exo_mad,
+                                    ['xlsx', 'csv'],
+                                    [('qa_samples', exo_mad.notnull())])
+        # the medians keep their name next to the extra sheets
+        assert_equal(sorted(name for name in os.listdir(work_dir)
+                            if name.endswith('.csv')),
+                     ['site_mad.csv', 'site_qa_samples.csv'])
+        from_excel = pd.read_excel(os.path.join(work_dir, 'site_mad.xlsx'),
+                                   index_col=0)
+        from_csv = pd.read_csv(os.path.join(work_dir, 'site_mad.csv'),
+                               index_col=0, parse_dates=True)
+        pd.util.testing.assert_frame_equal(from_excel, exo_mad,
+                                           check_names=False)
+        pd.util.testing.assert_frame_equal(from_csv, exo_mad,
+                                           check_names=False)
+        assert_raises(ValueError, burpro_writer.check_output_formats,
+                      ['xls'])
+        rows = burpro_writer.EXCEL_MAX_ROWS
+        assert_equal(burpro_writer.fit_formats(['xlsx'], rows - 1), ['xlsx'])
+        assert_equal(burpro_writer.fit_formats(['xlsx'], rows), ['csv'])
+        assert_equal(burpro_writer.fit_formats(['xlsx', 'parquet'], rows),
+                     ['parquet'])
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def test_median_abs_deviation_matches_statsmodels():
+    try:
+        import statsmodels.robust.scale as smc
+    except ImportError:
+        raise SkipTest('statsmodels is not installed')
+    rng = np.random.RandomState(6)
+    assert_equal(burpro_engine.MAD_NORMAL_CONSTANT, smc.Gaussian.ppf(3 / 4.))
+    for size in [1, 2, 7, 30]:
+        values = rng.randn(size) * 10
+        assert_equal(burpro_engine.median_abs_deviation(values),
+                     smc.mad(values))
+    values[3] = np.nan
+    assert_true(np.isnan(burpro_engine.median_abs_deviation(values)))
+    matrix = rng.randn(30, 4)
+    np.testing.assert_array_equal(burpro_engine.median_abs_deviation(matrix),
+                                  smc.mad(matrix))
+
+
+def test_streaming_pipeline_matches_batch():
+    work_dir = tempfile.mkdtemp()
+    try:
+        exo_filename = os.path.join(work_dir, 'synthetic.xlsx')
+        write_kor_file(exo_filename, days=1, n_params=6, seed=7)
+        log = logging.getLogger('burpro_tests')
+        params = read_json_params()
+        params.update(parse_cache=False, chunk_rows=101,
+                      mad_criteria=[2.0, 3.0], qa_sheets=True)
+        args = (log, log, exo_filename, params, u'SpCond \xb5S/cm', 60, -9999,
+                burpro_metrics.RunMetrics())
+        batch = burpro_process.process_batch(*args)
+        streamed = burpro_process.process_streaming(*args)
+        for expected, result in zip(batch[1], streamed[1]):
+            pd.util.testing.assert_frame_equal(result, expected)
+        pd.util.testing.assert_frame_equal(streamed[2], batch[2])
+        qa = dict(streamed[4])
+        pd.util.testing.assert_series_equal(
+            streamed[2].loc[2.0], qa['rejected'].sum() / qa['samples'].sum(),
+            check_names=False)
+        assert_equal(streamed[3], batch[3])
+        for (name, expected), (_, result) in zip(batch[4], streamed[4]):
+            pd.util.testing.assert_frame_equal(result, expected)
+        assert_equal(streamed[0].device_table(True),
+                     batch[0].device_table(True))
+    finally:
+        shutil.rmtree(work_dir)
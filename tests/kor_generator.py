@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+:DESCRIPTION: Writes synthetic KOR-EXO burst workbooks for tests and
+              benchmarks.  Files carry the sensor metadata block, a
+              duplicate sensor swap column, outages, missing values,
+              partial bursts and SpCond readings below the cutoff.
+
+:REQUIRES: numpy, openpyxl
+
+:USAGE: python kor_generator.py output.xlsx --days 30 --params 8
+
+:AUTHOR: John Franco Saraceno, John M. Donovan
+:ORGANIZATION: U.S. Geological Survey, United States Department of Interior
+:CONTACT: saraceno@usgs.gov, jmd@usgs.gov
+
+"""
+# =============================================================================
+# IMPORT STATEMENTS
+# =============================================================================
+from __future__ import print_function
+import argparse
+import datetime
+
+import numpy as np
+import openpyxl
+
+DATE_COL = u'Date (MM/DD/YYYY)'
+TIME_COL = u'Time (HH:MM:SS)'
+
+# columns KOR always exports, all listed in drop_cols of run_params.json
+SONDE_COLS = [u'Time (Fract. Sec)', u'Site Name', u'Fault Code',
+              u'Battery V', u'Cable Pwr V']
+# (device name, data columns as (name, mean, standard deviation))
+DEVICES = [
+    (u'Wiped CT', [(u'Temp °C', 18., 2.), (u'SpCond µS/cm', 800., 40.),
+                   (u'Cond µS/cm', 760., 40.), (u'nLF Cond µS/cm', 780., 40.),
+                   (u'Sal psu', 0.4, 0.02), (u'TDS mg/L', 520., 25.)]),
+    (u'pH', [(u'pH', 7.8, 0.1), (u'pH mV', -60., 5.)]),
+    (u'Optical DO', [(u'ODO % sat', 95., 4.), (u'ODO mg/L', 9., 0.5)]),
+    (u'Turbidity', [(u'Turbidity FNU', 12., 3.), (u'TSS mg/L', 15., 4.)]),
+    (u'fDOM', [(u'fDOM QSU', 30., 3.), (u'fDOM RFU', 9., 1.)]),
+    (u'Total Algae', [(u'Chlorophyll RFU', 1.2, 0.3),
+                      (u'Chlorophyll µg/L', 4., 1.),
+                      (u'BGA-PC RFU', 0.5, 0.1), (u'BGA-PC µg/L', 0.4, 0.1)]),
+    (u'ORP', [(u'ORP mV', 210., 10.)]),
+    (u'Depth', [(u'Press psi a', 16., 0.3), (u'Depth m', 1.5, 0.2)]),
+]
+SWAP_DEVICE = u'Turbidity'
+DROPPED_COLS = [u'Cond µS/cm', u'nLF Cond µS/cm', u'Sal psu', u'TDS mg/L',
+                u'TSS mg/L', u'Press psi a', u'Depth m']
+
+
+def parameter_layout(n_params):
+    """Return the devices and their data columns for a file with n_params
+    burst parameter columns, in KOR column order.  Columns that BurPro
+    drops are exported along with their device"""
+    devices = []
+    remaining = n_params
+    for name, cols in DEVICES:
+        if remaining <= 0:
+            break
+        kept = []
+        for col in cols:
+            if col[0] in DROPPED_COLS:
+                kept.append(col)
+            elif remaining > 0:
+                kept.append(col)
+                remaining -= 1
+        devices.append((name, kept))
+    return devices
+
+
+def write_kor_file(filename, days=7, n_params=8, interval=15, burst_len=30,
+                   seed=0, start=datetime.datetime(2017, 3, 1, 0, 0, 3),
+                   outage_rate=0.002, partial_rate=0.05, missing_rate=0.01,
+                   sensor_swap=True):
+    """Write a synthetic KOR export workbook
+    INPUT:
+    output .xlsx filename, deployment length in days, number of burst
+    parameter columns, burst interval in minutes, samples per burst, random
+    seed, first timestamp, probability of an outage starting at a burst,
+    fraction of partial bursts, fraction of missing values, whether one
+    sensor is swapped mid deployment
+    RETURNS:
+    number of data rows written"""
+    rng = np.random.RandomState(seed)
+    devices = parameter_layout(n_params)
+    header = [DATE_COL, TIME_COL] + SONDE_COLS
+    device_rows = [[u'EXO2 Sonde', u'15A100000', u'2.0.0', None]]
+    swap_cols = []
+    for counter, (name, cols) in enumerate(devices):
+        numbers = range(len(header) + 1, len(header) + len(cols) + 1)
+        device_rows.append([name, u'15B1%05d' % counter, u'2.1.0',
+                            u';'.join(str(i) for i in numbers)])
+        header.extend(col[0] for col in cols)
+        if sensor_swap and name == SWAP_DEVICE:
+            # the replacement sensor reports into a second, same named column
+            swap_cols = [header.index(col[0]) for col in cols]
+            numbers = range(len(header) + 1, len(header) + len(cols) + 1)
+            device_rows.append([name, u'15B2%05d' % counter, u'2.1.0',
+                                u';'.join(str(i) for i in numbers)])
+            header.extend(col[0] for col in cols)
+    means = np.array([col[1] for _, cols in devices for col in cols])
+    stds = np.array([col[2] for _, cols in devices for col in cols])
+    param_names = [col[0] for _, cols in devices for col in cols]
+    sc_pos = param_names.index(u'SpCond µS/cm') \
+        if u'SpCond µS/cm' in param_names else None
+
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append([u'KOR Export File'])
+    sheet.append([u'FILE CREATED:', start.strftime('%m/%d/%Y')])
+    sheet.append([u'TIME OFFSET (hh:mm:ss):', u'00:00:00'])
+    sheet.append([u'Device', u'Serial Number', u'Firmware Version',
+                  u'Corresponding Data Column(s)'])
+    for row in device_rows:
+        sheet.append(row)
+    sheet.append([])
+    sheet.append([u'SENSOR DATA'])
+    sheet.append(header)
+
+    n_bursts = int(days * 24 * 60 // interval)
+    swap_burst = n_bursts // 2
+    outage = 0
+    n_rows = 0
+    for burst in range(n_bursts):
+        if outage:
+            outage -= 1
+            continue
+        if rng.rand() < outage_rate:
+            # sensor pull out or battery outage of up to two days
+            outage = rng.randint(1, 2 * 24 * 60 // interval)
+            continue
+        length = burst_len
+        if rng.rand() < partial_rate:
+            length = rng.randint(1, burst_len)
+        t0 = start + datetime.timedelta(minutes=interval * burst)
+        drift = rng.randn(len(means)) * stds * 0.2
+        values = means + drift + rng.randn(length, len(means)) * stds * 0.1
+        # occasional spikes for the MAD filter to reject
+        spikes = rng.rand(length, len(means)) < 0.01
+        values[spikes] += stds[np.nonzero(spikes)[1]] * 10
+        values = np.round(values, 3).astype(object)
+        values[rng.rand(length, len(means)) < missing_rate] = None
+        if sc_pos is not None and rng.rand() < 0.02:
+            # sonde out of water, SpCond below the cutoff
+            values[:, sc_pos] = np.round(rng.rand(length) * 50, 3)
+        for sample in range(length):
+            stamp = t0 + datetime.timedelta(seconds=sample)
+            row = [datetime.datetime(stamp.year, stamp.month, stamp.day),
+                   stamp.time(), 0, u'Synthetic Site', 0,
+                   round(12.0 + rng.rand(), 2), 0.]
+            row.extend(values[sample].tolist())
+            if swap_cols:
+                # before the swap the replacement columns are blank, after
+                # it the original sensor's columns are
+                swapped = [row[i] for i in swap_cols]
+                if burst < swap_burst:
+                    swapped = [None] * len(swap_cols)
+                else:
+                    for i in swap_cols:
+                        row[i] = None
+                row[swap_cols[-1] + 1:swap_cols[-1] + 1] = swapped
+            sheet.append(row)
+            n_rows += 1
+    workbook.save(filename)
+    return n_rows
+
+
+def main():
+    parser = argparse.ArgumentParser(
+             description='Write a synthetic KOR-EXO burst workbook')
+    parser.add_argument('filename')
+    parser.add_argument('--days', type=float, default=7)
+    parser.add_argument('--params', type=int, default=8,
+                        help='number of burst parameter columns')
+    parser.add_argument('--interval', type=int, default=15)
+    parser.add_argument('--burst-len', type=int, default=30)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    rows = write_kor_file(args.filename, days=args.days,
+                          n_params=args.params, interval=args.interval,
+                          burst_len=args.burst_len, seed=args.seed)
+    print('Wrote', rows, 'rows to', args.filename)
+
+
+if __name__ == '__main__':
+    main()